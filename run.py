@@ -1,14 +1,29 @@
 # run.py
-from typing import Optional
+import argparse
 import os
-import json
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from colorama import Fore
 
 from dotenv import load_dotenv
-from src.language_model_client import OpenAIClient, LlamaClient, HermesClient
-
-from src.gmail_service import get_gmail_service, fetch_emails, parse_email_data, get_user_email
-from src.email_processing import process_email, report_statistics
+from src.language_model_client import AsyncOpenAIClient, LlamaClient, HermesClient, LlamaProcessPool, LocalClassifierClient
+from src.local_classifier import LinearEmailClassifier
+
+from src.gmail_service import FetchStats, IncrementalLister, SearchQuery, fetch_email_bodies, get_gmail_service, get_history_id, gmail_connections, parse_email_batch, get_user_email
+from src.email_evaluation import BatchEvaluator, evaluate_email, prompt_version
+from src.checkpoint import CheckpointedLister
+from src.daemon import Daemon, FairScheduler, load_daemon_config, schedule_client
+from src.email_processing import ActionQueue, apply_verdict, report_statistics, restore_emails
+from src.ledger import Ledger
+from src.metrics import MetricsServer, in_current_run, metrics
+from src.pipeline import EmailPipeline
+from src.prefilter import PreFilter
+from src.sender_clusters import SenderClusters
+from src.verdict_cache import VerdictCache
 from src.settings_config import save_user_settings, load_user_settings, ask_to_override_settings
 
 load_dotenv()
@@ -17,6 +32,65 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 LOCAL_LLAMA_LOCATION = os.getenv("LOCAL_LLAMA_LOCATION")
 LOCAL_OPEN_HERMES_LOCATION = os.getenv("LOCAL_OPEN_HERMES_LOCATION")
 
+# Worker counts and queue size of the fetch -> classify -> act pipeline
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "4"))
+CLASSIFY_WORKERS = int(os.getenv("CLASSIFY_WORKERS", "16"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "256"))
+
+# OpenAI request budget; match these to your account's rate limits
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "300000"))
+
+# Seconds a Gmail request may take before it fails and is retried
+GMAIL_HTTP_TIMEOUT = float(os.getenv("GMAIL_HTTP_TIMEOUT", "60"))
+
+# List only the emails added since the last completed run instead of every unread email
+INCREMENTAL_SYNC = os.getenv("INCREMENTAL_SYNC", "true").lower() in ("1", "true", "yes")
+
+# Gmail searches narrowing down a full scan: skip emails older than GMAIL_MAX_AGE_DAYS (0 keeps all)
+# and those with one of GMAIL_EXCLUDE_LABELS, then list GMAIL_CATEGORIES in order before the rest
+GMAIL_MAX_AGE_DAYS = int(os.getenv("GMAIL_MAX_AGE_DAYS", "0"))
+GMAIL_EXCLUDE_LABELS = [label for label in os.getenv("GMAIL_EXCLUDE_LABELS", "").split(",") if label.strip()]
+GMAIL_CATEGORIES = [category.strip() for category in os.getenv("GMAIL_CATEGORIES", "promotions,social,updates,forums").split(",") if category.strip()]
+GMAIL_QUERY = os.getenv("GMAIL_QUERY", "")
+
+# Fetch headers first and download bodies only for the emails the headers don't settle
+TWO_PHASE_FETCH = os.getenv("TWO_PHASE_FETCH", "true").lower() in ("1", "true", "yes")
+
+# Classify a few samples of each sender's near-identical emails and give the rest of them the same verdict
+SENDER_CLUSTERING = os.getenv("SENDER_CLUSTERING", "true").lower() in ("1", "true", "yes")
+CLUSTER_SAMPLE_SIZE = int(os.getenv("CLUSTER_SAMPLE_SIZE", "3"))
+
+# Rule-based pre-filter in front of the model: 'on', 'off', or 'shadow' to only compare it with the model's verdicts
+PREFILTER_MODE = os.getenv("PREFILTER_MODE", "on").lower()
+
+# Size and age limits of the on-disk verdict cache
+VERDICT_CACHE_PATH = os.path.join("cache", "verdict_cache.sqlite3")
+VERDICT_CACHE_MAX_ENTRIES = int(os.getenv("VERDICT_CACHE_MAX_ENTRIES", "200000"))
+VERDICT_CACHE_MAX_AGE_DAYS = float(os.getenv("VERDICT_CACHE_MAX_AGE_DAYS", "90"))
+
+# Emails sent to the model per prompt; 1 evaluates every email on its own
+EMAILS_PER_PROMPT = int(os.getenv("EMAILS_PER_PROMPT", "1"))
+BATCH_TOKEN_BUDGET = int(os.getenv("BATCH_TOKEN_BUDGET", "8000"))
+
+# Saved llama.cpp KV state of the system prompt, so the local models only evaluate the email part of each prompt
+PROMPT_PREFIX_CACHE_DIR = os.getenv("PROMPT_PREFIX_CACHE_DIR", os.path.join("cache", "prompt_prefix"))
+
+# Worker processes for the local models, each running its own llama.cpp context on a share of the CPU cores
+LOCAL_MODEL_WORKERS = int(os.getenv("LOCAL_MODEL_WORKERS", "1"))
+
+# Per-stage latency histograms, token counts and cache hits of every run, written as JSON next to METRICS_PATH
+# with the account in the file name ('' to skip);
+# the daemon also serves them to Prometheus on METRICS_PORT (0 to disable)
+METRICS_PATH = os.getenv("METRICS_PATH", os.path.join("cache", "metrics.json"))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# Local classifier trained on past verdicts: 'auto' uses it once trained, 'on' requires it, 'off' never uses it
+LOCAL_CLASSIFIER = os.getenv("LOCAL_CLASSIFIER", "auto").lower()
+LOCAL_CLASSIFIER_PATH = os.getenv("LOCAL_CLASSIFIER_PATH", os.path.join("cache", "local_classifier.npz"))
+LOCAL_CLASSIFIER_CONFIDENCE = float(os.getenv("LOCAL_CLASSIFIER_CONFIDENCE", "0.9"))
+
 def get_user_name():
     user_first_name = input(Fore.LIGHTYELLOW_EX + "Enter your first name: " + Fore.RESET)
     user_last_name = input(Fore.LIGHTYELLOW_EX + "Enter your last name: " + Fore.RESET)
@@ -26,25 +100,39 @@ class LanguageModelClientFactory:
     @staticmethod
     def get_client(client_type: str, **kwargs):
         if client_type == 'gpt-4-1106-preview':
-            return OpenAIClient(api_key=kwargs.get("api_key"))
-        elif client_type == 'llama-2-7B':
-            return LlamaClient(
-                model_path=kwargs.get("model_path", LOCAL_LLAMA_LOCATION),
-                n_ctx=kwargs.get("n_ctx", 3584),
-                n_batch=kwargs.get("n_batch", 521),
-                chat_format=kwargs.get("chat_format", "llama-2"),
-                verbose=kwargs.get("verbose", False)
+            return AsyncOpenAIClient(
+                api_key=kwargs.get("api_key"),
+                max_concurrency=kwargs.get("max_concurrency", OPENAI_MAX_CONCURRENCY),
+                requests_per_minute=kwargs.get("requests_per_minute", OPENAI_REQUESTS_PER_MINUTE),
+                tokens_per_minute=kwargs.get("tokens_per_minute", OPENAI_TOKENS_PER_MINUTE)
             )
+        elif client_type == 'llama-2-7B':
+            return LanguageModelClientFactory._local_client(LlamaClient, client_type, {
+                'model_path': kwargs.get("model_path", LOCAL_LLAMA_LOCATION),
+                'n_ctx': kwargs.get("n_ctx", 3584),
+                'n_batch': kwargs.get("n_batch", 521),
+                'chat_format': kwargs.get("chat_format", "llama-2"),
+                'verbose': kwargs.get("verbose", False),
+                'prefix_cache_dir': kwargs.get("prefix_cache_dir", PROMPT_PREFIX_CACHE_DIR)
+            }, kwargs.get("workers", LOCAL_MODEL_WORKERS))
         elif client_type == 'openhermes-2.5-mistral-7b':
-            return HermesClient(
-                model_path=kwargs.get("model_path", LOCAL_OPEN_HERMES_LOCATION),
-                n_ctx=kwargs.get("n_ctx", 3584),
-                n_batch=kwargs.get("n_batch", 521),
-                chat_format=kwargs.get("chat_format", "chatml"),
-                verbose=kwargs.get("verbose", False)
-            )
+            return LanguageModelClientFactory._local_client(HermesClient, client_type, {
+                'model_path': kwargs.get("model_path", LOCAL_OPEN_HERMES_LOCATION),
+                'n_ctx': kwargs.get("n_ctx", 3584),
+                'n_batch': kwargs.get("n_batch", 521),
+                'chat_format': kwargs.get("chat_format", "chatml"),
+                'verbose': kwargs.get("verbose", False),
+                'prefix_cache_dir': kwargs.get("prefix_cache_dir", PROMPT_PREFIX_CACHE_DIR)
+            }, kwargs.get("workers", LOCAL_MODEL_WORKERS))
         else:
             raise ValueError(f"Invalid language model type selected: {client_type}")
+
+    @staticmethod
+    def _local_client(client_class, client_type: str, client_kwargs: dict, workers: int):
+        # Several llama.cpp processes use more of a many-core CPU than one context can
+        if workers > 1:
+            return LlamaProcessPool(client_class, client_type, workers, client_kwargs)
+        return client_class(**client_kwargs)
         
 def choose_language_model_client():
     os.system('clear' if os.name == 'posix' else 'cls')
@@ -93,9 +181,219 @@ def get_user_action() -> str:
 
     return actions[choice]
 
+def create_client(client_type, model_path_or_key):
+    client_kwargs = {
+        'api_key': model_path_or_key if client_type == 'gpt-4-1106-preview' else None,
+        'model_path': model_path_or_key if client_type in ['llama-2-7B', 'openhermes-2.5-mistral-7b'] else None
+    }
+    client = LanguageModelClientFactory.get_client(client_type, **client_kwargs)
+    # Answer the emails the local classifier is sure about, and send the rest to the model
+    if LOCAL_CLASSIFIER == 'on' or (LOCAL_CLASSIFIER == 'auto' and os.path.exists(LOCAL_CLASSIFIER_PATH)):
+        client = LocalClassifierClient(LinearEmailClassifier.load(LOCAL_CLASSIFIER_PATH, LOCAL_CLASSIFIER_CONFIDENCE), client)
+    return client
+
+def open_ledger(user_email):
+    # Define the folder name
+    folder_name = "cache"
+    # Create the folder if it doesn't exist
+    if not os.path.exists(folder_name):
+        os.makedirs(folder_name)
+
+    # Processed emails live in one ledger per account, the bodies of actioned emails in its compressed recovery log
+    user_file_name = user_email.replace('@', '_at_')
+    ledger = Ledger(os.path.join(folder_name, f"ledger_{user_file_name}.sqlite3"), recovery_dir=os.path.join("emails_recovery", user_file_name))
+    # Import the JSON files written by earlier versions, once
+    ledger.migrate_legacy_files(
+        os.path.join(folder_name, f"processed_emails_{user_file_name}.json"),
+        os.path.join("emails_recovery", f"processed_emails_details_{user_file_name}.json")
+    )
+    return ledger
+
+def account_metrics_path(user_email):
+    # One file per account, e.g. cache/metrics_ann_at_example.com.json, so the daemon's accounts don't overwrite each other
+    root, extension = os.path.splitext(METRICS_PATH)
+    return f"{root}_{user_email.replace('@', '_at_')}{extension or '.json'}"
+
+def process_account(gmail, gmail_factory, user_email, client, action, user_first_name, user_last_name, on_pipeline=None):
+    """
+    Process the unread emails of one mailbox once. gmail_factory builds a Gmail service
+    for each pipeline thread; on_pipeline, if given, receives the pipeline before it runs.
+    """
+    ledger = open_ledger(user_email)
+    if not len(ledger):
+        print("No processed emails found, starting fresh.")
+
+    def on_actioned(message_ids):
+        ledger.confirm_actions(message_ids)
+        ledger.mark_processed_many(message_ids, True)
+
+    # Collect promotional emails and act on them through bulk Gmail calls; an email is processed, and its recorded
+    # action confirmed, once the action went through
+    action_queue = ActionQueue(gmail, action, on_success=on_actioned)
+
+    # Verdicts are reused across runs for identical emails, keyed on the model and prompt
+    verdict_cache = VerdictCache(
+        VERDICT_CACHE_PATH,
+        model_name=client.model_name,
+        prompt_version=prompt_version(user_first_name, user_last_name),
+        max_entries=VERDICT_CACHE_MAX_ENTRIES,
+        max_age_days=VERDICT_CACHE_MAX_AGE_DAYS
+    )
+
+    # Settle the obvious cases from headers, labels and past verdicts without the model
+    prefilter = PreFilter(user_last_name, mode=PREFILTER_MODE, sender_verdict_counts=verdict_cache.sender_verdict_counts())
+    # The pre-filter only reads headers and labels, so with a two-phase fetch it runs before the bodies are downloaded
+    prefilter_on_metadata = TWO_PHASE_FETCH and prefilter.mode == 'on'
+    fetch_stats = FetchStats()
+
+    def fetch_messages(gmail_handle, messages):
+        parsed_emails = parse_email_batch(gmail_handle, messages, format='metadata' if TWO_PHASE_FETCH else 'full', stats=fetch_stats)
+        ledger.mark_fetched([email_id for email_id, email_data_parsed in parsed_emails.items() if email_data_parsed])
+        return parsed_emails
+
+    def fetch_bodies(gmail_handle, message_ids):
+        return fetch_email_bodies(gmail_handle, message_ids, stats=fetch_stats)
+
+    def classify_metadata(emails):
+        return [prefilter.decide(email_data_parsed) for email_data_parsed in emails]
+
+    def classify(email_data_parsed):
+        decision = prefilter.decide(email_data_parsed) if prefilter.mode != 'off' and not prefilter_on_metadata else None
+        if decision is not None and prefilter.mode == 'on':
+            return decision
+        verdict = evaluate_email(email_data_parsed, user_first_name, user_last_name, client, verdict_cache)
+        prefilter.record_model_verdict(decision, verdict)
+        return verdict
+
+    # Several emails per prompt, for the emails the pre-filter leaves to the model. Not with llama.cpp models:
+    # a few emails fill their context, and switching between batch and single prompts reloads the prompt prefix
+    emails_per_prompt = EMAILS_PER_PROMPT if client.context_tokens is None else 1
+    if emails_per_prompt < EMAILS_PER_PROMPT:
+        print(f"EMAILS_PER_PROMPT is ignored with {client.model_name}, local models get one email per prompt")
+    batch_evaluator = BatchEvaluator(user_first_name, user_last_name, client, verdict_cache, max_emails=emails_per_prompt, token_budget=BATCH_TOKEN_BUDGET)
+
+    def classify_many(emails):
+        decisions = [prefilter.decide(email_data_parsed) if prefilter.mode != 'off' and not prefilter_on_metadata else None for email_data_parsed in emails]
+        verdicts = list(decisions) if prefilter.mode == 'on' else [None] * len(emails)
+        to_model = [index for index, verdict in enumerate(verdicts) if verdict is None]
+        for index, verdict in zip(to_model, batch_evaluator.evaluate([emails[index] for index in to_model])):
+            prefilter.record_model_verdict(decisions[index], verdict)
+            verdicts[index] = verdict
+        return verdicts
+
+    # Local models serve one completion at a time, so don't run more classifiers than the client allows
+    classify_workers = CLASSIFY_WORKERS if client.max_concurrency is None else min(CLASSIFY_WORKERS, client.max_concurrency)
+    sample_executor = ThreadPoolExecutor(max_workers=classify_workers, thread_name_prefix="cluster-samples")
+
+    def classify_samples(emails):
+        if emails_per_prompt > 1:
+            return classify_many(emails)
+        futures = [sample_executor.submit(in_current_run(classify), email_data_parsed) for email_data_parsed in emails]
+        return [future.result() for future in futures]
+
+    # Emails of a sender's template past its first samples skip the model
+    sender_clusters = SenderClusters(classify_samples, sample_size=CLUSTER_SAMPLE_SIZE)
+
+    def classify_clustered(email_data_parsed):
+        verdict = classify(email_data_parsed)
+        sender_clusters.record(email_data_parsed, verdict)
+        return verdict
+
+    def classify_many_clustered(emails):
+        verdicts = classify_many(emails)
+        for email_data_parsed, verdict in zip(emails, verdicts):
+            sender_clusters.record(email_data_parsed, verdict)
+        return verdicts
+
+    def act(message_info, email_data_parsed, is_promotional):
+        # Kept emails are processed now, whatever the result; promotional ones wait for their bulk action,
+        # so an interrupted run leaves them to the next one
+        if is_promotional:
+            ledger.mark_classified(message_info['id'], True)
+        else:
+            ledger.mark_processed(message_info['id'], is_promotional)
+        apply_verdict(gmail, message_info, email_data_parsed, is_promotional, action, ledger, action_queue)
+        action_queue.flush_if_due()
+
+    # Page through new emails since the last run's history ID, or all unread emails on a full scan
+    search_query = SearchQuery(GMAIL_MAX_AGE_DAYS, GMAIL_EXCLUDE_LABELS, GMAIL_CATEGORIES, GMAIL_QUERY)
+    # Mailbox position at the start of the run, stored for the next run once every page has been listed.
+    # Pages are checkpointed in the ledger, so an interrupted run is resumed from its last page
+    lister = CheckpointedLister(
+        IncrementalLister(ledger.get_state('history_id') if INCREMENTAL_SYNC else None, search_query=search_query),
+        ledger,
+        get_history_id(gmail)
+    )
+    unfinished_actions = lister.unfinished_actions()
+    if unfinished_actions:
+        print(f"Retrying the action on {len(unfinished_actions)} emails an earlier run classified as promotional")
+        for email_id in unfinished_actions:
+            action_queue.add(email_id)
+
+    pipeline = EmailPipeline(
+        gmail_factory=gmail_factory,
+        list_page=lister,
+        fetch_messages=fetch_messages,
+        classify=classify_clustered if SENDER_CLUSTERING else classify,
+        act=act,
+        is_processed=lambda email_id: email_id in ledger,
+        classify_batch=client.classify_emails if isinstance(client, LocalClassifierClient) else None,
+        classify_many=(classify_many_clustered if SENDER_CLUSTERING else classify_many) if emails_per_prompt > 1 else None,
+        classify_group_size=emails_per_prompt,
+        classify_metadata=classify_metadata if prefilter_on_metadata else None,
+        classify_clusters=sender_clusters.classify if SENDER_CLUSTERING else None,
+        fetch_bodies=fetch_bodies if TWO_PHASE_FETCH else None,
+        # Queued actions go out after their time limit even while no new promotional email comes in
+        on_idle=action_queue.flush_if_due,
+        fetch_workers=FETCH_WORKERS,
+        classify_workers=classify_workers,
+        queue_size=PIPELINE_QUEUE_SIZE
+    )
+
+    if on_pipeline is not None:
+        on_pipeline(pipeline)
+
+    # This run's own metrics, timed from the start of the pipeline; the process-wide ones keep adding up for Prometheus
+    with metrics.run() as run_metrics:
+        try:
+            pipeline.run()
+            # Emails left unfinished keep the cursor, so the next run goes back for them before moving on
+            if lister.complete and not pipeline.unfinished_emails:
+                lister.finish()
+        finally:
+            # Flush the remaining queued emails, even when the run is interrupted
+            succeeded_ids, _ = action_queue.close()
+            total_marked_as_read = len(succeeded_ids)
+            sample_executor.shutdown()
+            verdict_cache.close()
+            ledger.close()
+
+    run_stats = {
+        **fetch_stats.stats(),
+        **prefilter.stats(),
+        **(sender_clusters.stats() if SENDER_CLUSTERING else {}),
+        **verdict_cache.stats(),
+        **(batch_evaluator.stats() if emails_per_prompt > 1 else {}),
+        **client.stats(),
+        **run_metrics.report()
+    }
+    # The run ID selects this run's emails for `restore --run-id`
+    report_statistics(pipeline.total_unread_emails, pipeline.total_pages_fetched, total_marked_as_read, client.model_name, {'Run ID': ledger.run_id, **run_stats})
+    if METRICS_PATH:
+        run_metrics.write_json(account_metrics_path(user_email), {
+            'account': user_email,
+            'run_id': ledger.run_id,
+            'unread_emails': pipeline.total_unread_emails,
+            'emails_processed': pipeline.total_emails_processed,
+            'emails_actioned': total_marked_as_read,
+            **run_stats
+        })
+
 def main():
     try:
-        gmail = get_gmail_service()
+        # One Gmail handle per pipeline thread, all refreshing the same token
+        connections = gmail_connections(timeout=GMAIL_HTTP_TIMEOUT)
+        gmail = connections()
         user_email = get_user_email(gmail)
         
         if not user_email:
@@ -127,84 +425,318 @@ def main():
                 'user_last_name': user_last_name
             })
 
-        # Define the folder name
-        folder_name = "cache"
-        # Create the folder if it doesn't exist
-        if not os.path.exists(folder_name):
-            os.makedirs(folder_name)
-        
-        # Update the file path to include the cache folder
-        processed_emails_file = os.path.join(folder_name, f"processed_emails_{user_email.replace('@', '_at_')}.json")
-        
-        if os.path.exists(processed_emails_file):
-            with open(processed_emails_file, 'r') as file:
-                processed_emails = json.load(file)
-            
-        else:
-            processed_emails = {}
-            print("No processed emails file found, starting fresh.")
-
-        
-         
-
-        client_kwargs = {
-            'api_key': model_path_or_key if client_type == 'gpt-4-1106-preview' else None,
-            'model_path': model_path_or_key if client_type in ['llama-2-7B', 'openhermes-2.5-mistral-7b'] else None
-        }
-        client = LanguageModelClientFactory.get_client(client_type, **client_kwargs)
-
-        
-
-        page_token: Optional[str] = None
-
-        total_unread_emails = 0
-        total_pages_fetched = 0
-        total_marked_as_read = 0
-
-        # Define the directory name where the JSON file will be stored
-        email_details_folder = "emails_recovery"
-
-        # Create the directory if it doesn't exist
-        if not os.path.exists(email_details_folder):
-            os.makedirs(email_details_folder)
-
-        while True:
-            messages, page_token = fetch_emails(gmail, page_token)
-            total_pages_fetched += 1
-            print(f"Fetched page {total_pages_fetched} of emails")
-
-            total_unread_emails += len(messages)
-
-            for message_info in messages:
-                email_id = message_info['id']
-                if email_id in processed_emails:
-                    print(f"Skipping already looked at email with ID: {email_id}")
-                    continue
-
-                email_data_parsed = parse_email_data(gmail, message_info)
-                
-                # Mark the email as processed regardless of the processing result
-                processed_emails[email_id] = True
-                try:
-                    with open(processed_emails_file, 'w') as file:
-                        json.dump(processed_emails, file)
-                except Exception as e:
-                    print(f"Failed to write to file: {e}")
-
+        client = create_client(client_type, model_path_or_key)
+        try:
+            process_account(gmail, connections, user_email, client, action, user_first_name, user_last_name)
+        finally:
+            client.close()
 
+    except Exception as e:
+        print(f"An error occurred: {e}")
 
-                # Update the file path to include the new directory
-                processed_emails_file_path = os.path.join(email_details_folder, f"processed_emails_details_{user_email.replace('@', '_at_')}.json")
-                total_marked_as_read += process_email(gmail, message_info, email_data_parsed, user_first_name, user_last_name, client, action, processed_emails_file_path)
-
-            if not page_token:
-                break
+def run_daemon(accounts_path):
+    """
+    Poll every account of the account file on its own interval, sharing one model client
+    and its rate limits, until SIGTERM or Ctrl+C.
+    """
+    client_type, model_path_or_key, accounts = load_daemon_config(accounts_path)
+    if model_path_or_key is None:
+        model_path_or_key = {
+            'gpt-4-1106-preview': OPENAI_API_KEY,
+            'llama-2-7B': LOCAL_LLAMA_LOCATION,
+            'openhermes-2.5-mistral-7b': LOCAL_OPEN_HERMES_LOCATION
+        }[client_type]
+    client = create_client(client_type, model_path_or_key)
+    # Accounts take turns for the model, so one large backlog cannot hold up the others
+    model_slots = client.max_concurrency or OPENAI_MAX_CONCURRENCY
+    scheduler = FairScheduler(model_slots)
+
+    # Kept across polls, so each account loads and refreshes its token once for all its workers
+    account_connections = {}
+
+    def process(account, on_pipeline):
+        if account.name not in account_connections:
+            account_connections[account.name] = gmail_connections(account.token_path, interactive=False, timeout=GMAIL_HTTP_TIMEOUT)
+        gmail_factory = account_connections[account.name]
+        gmail = gmail_factory()
+        user_email = get_user_email(gmail)
+        if not user_email:
+            raise Exception("Failed to retrieve user email address.")
+        print(f"Checking {user_email} ({account.name})")
+        process_account(gmail, gmail_factory, user_email, schedule_client(client, scheduler, account.name), account.action, account.user_first_name, account.user_last_name, on_pipeline)
 
-        report_statistics(total_unread_emails, total_pages_fetched, total_marked_as_read, client.model_name)
+    # Scrape http://127.0.0.1:METRICS_PORT/metrics while the daemon runs
+    metrics_server = MetricsServer(metrics, METRICS_PORT).start() if METRICS_PORT else None
+    try:
+        Daemon(accounts, process).run()
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        client.close()
+
+def authorize(token_path):
+    """Run the OAuth flow for one account and save its token, for use by the daemon."""
+    os.makedirs(os.path.dirname(token_path) or '.', exist_ok=True)
+    gmail = get_gmail_service(token_path)
+    print(Fore.LIGHTGREEN_EX + f"Saved the token of {get_user_email(gmail)} to {token_path}" + Fore.RESET)
+
+def parse_time(value):
+    # Local date or date and time, e.g. 2024-03-01 or 2024-03-01T14:30
+    return datetime.fromisoformat(value).timestamp() if value else None
+
+def list_runs(ledger):
+    runs = ledger.runs()
+    if not runs:
+        print("No run has actioned any emails yet.")
+    for run in runs:
+        started = datetime.fromtimestamp(run['started_at']).strftime('%Y-%m-%d %H:%M')
+        print(f"{Fore.LIGHTYELLOW_EX}{run['run_id']:<20}{Fore.RESET}{started}  {run['read']} read, {run['deleted']} deleted, {run['restored']} restored")
+
+def restore(token_path, since=None, until=None, sender_pattern=None, run_id=None, workers=4, show_runs=False):
+    """
+    Mark the emails an earlier run marked as read unread again, selected by time range,
+    sender pattern or run ID. Restored emails stay processed, so later runs leave them alone.
+    show_runs lists the runs and their IDs instead.
+    """
+    connections = gmail_connections(token_path, timeout=GMAIL_HTTP_TIMEOUT)
+    gmail = connections()
+    user_email = get_user_email(gmail)
+    ledger = open_ledger(user_email)
+    try:
+        if show_runs:
+            list_runs(ledger)
+            return
+        selection = dict(since=parse_time(since), until=parse_time(until), sender_pattern=sender_pattern, run_id=run_id, with_contents=False)
+        # An email can have been actioned by several runs, restore it once
+        message_ids = list(dict.fromkeys(details['id'] for details in ledger.iter_actions(action='read', restored=False, **selection)))
+        deleted = sum(1 for _ in ledger.iter_actions(action='delete', **selection))
+        if deleted:
+            print(Fore.LIGHTRED_EX + f"{deleted} matching emails were deleted, Gmail deletes permanently so they can't be restored" + Fore.RESET)
+        if not message_ids:
+            print("No emails to restore.")
+            return
+        print(f"Restoring {len(message_ids)} emails of {user_email}...")
+        started = time.perf_counter()
+        restored, failed = restore_emails(connections, ledger, message_ids, workers=workers)
+        print(Fore.LIGHTGREEN_EX + f"Restored {restored} emails in {time.perf_counter() - started:.1f}s" + Fore.RESET)
+        if failed:
+            print(Fore.LIGHTRED_EX + f"{failed} emails could not be restored, run the same command again to retry them" + Fore.RESET)
+    finally:
+        ledger.close()
+
+def load_verdicts():
+    verdict_cache = VerdictCache(VERDICT_CACHE_PATH, model_name='', prompt_version='', max_entries=VERDICT_CACHE_MAX_ENTRIES, max_age_days=VERDICT_CACHE_MAX_AGE_DAYS)
+    samples = list(verdict_cache.iter_verdicts())
+    verdict_cache.close()
+    return samples, [sample['verdict'] for sample in samples]
+
+def print_classifier_metrics(title, metrics):
+    print(f"{Fore.LIGHTCYAN_EX}{title.center(50)}{Fore.RESET}")
+    print(f"{Fore.LIGHTCYAN_EX}{'-' * 50}{Fore.RESET}")
+    for key, value in metrics.items():
+        formatted = f"{int(value)}" if key == 'samples' else f"{value:.1%}"
+        print(f"{Fore.LIGHTYELLOW_EX}{key:<35}{Fore.RESET}{formatted:<15}")
+    print(f"{Fore.LIGHTCYAN_EX}{'-' * 50}{Fore.RESET}")
+
+def train_classifier(holdout: float):
+    """
+    Train the local classifier on the verdicts in the verdict cache, report its agreement
+    with the language model on a held-out share, then save a model fitted on every verdict.
+    """
+    emails, verdicts = load_verdicts()
+    if len(emails) < 50:
+        print(Fore.LIGHTRED_EX + f"Only {len(emails)} verdicts recorded, run the language model on more emails first." + Fore.RESET)
+        return
+    order = list(range(len(emails)))
+    random.Random(0).shuffle(order)
+    split = int(len(order) * (1 - holdout))
+    train, test = order[:split], order[split:]
+
+    classifier = LinearEmailClassifier(confidence=LOCAL_CLASSIFIER_CONFIDENCE)
+    classifier.fit([emails[i] for i in train], [verdicts[i] for i in train])
+    print_classifier_metrics("Held-out agreement with the model", classifier.evaluate([emails[i] for i in test], [verdicts[i] for i in test]))
+
+    classifier = LinearEmailClassifier(confidence=LOCAL_CLASSIFIER_CONFIDENCE).fit(emails, verdicts)
+    os.makedirs(os.path.dirname(LOCAL_CLASSIFIER_PATH) or '.', exist_ok=True)
+    classifier.save(LOCAL_CLASSIFIER_PATH)
+    print(Fore.LIGHTGREEN_EX + f"Saved local classifier trained on {len(emails)} verdicts to {LOCAL_CLASSIFIER_PATH}" + Fore.RESET)
+
+def evaluate_classifier():
+    """Report the saved local classifier's agreement with every verdict in the verdict cache."""
+    classifier = LinearEmailClassifier.load(LOCAL_CLASSIFIER_PATH, LOCAL_CLASSIFIER_CONFIDENCE)
+    emails, verdicts = load_verdicts()
+    print_classifier_metrics("Agreement with the model", classifier.evaluate(emails, verdicts))
+
+def compare_batch_prompting(sample_size: int):
+    """
+    Evaluate a sample of past emails one per prompt and several per prompt with the
+    chosen model, then compare the verdicts, request counts and prompt tokens.
+    """
+    emails, cached_verdicts = load_verdicts()
+    if not emails:
+        print(Fore.LIGHTRED_EX + "No verdicts recorded yet, run the language model on some emails first." + Fore.RESET)
+        return
+    sample = random.Random(0).sample(range(len(emails)), min(sample_size, len(emails)))
+    # The verdict cache does not keep recipients
+    emails = [{'to': '', 'cc': '', **emails[i]} for i in sample]
+    cached_verdicts = [cached_verdicts[i] for i in sample]
+
+    settings = load_user_settings()
+    if settings:
+        client_type, model_path_or_key = settings['client_type'], settings['model_path_or_key']
+        user_first_name, user_last_name = settings['user_first_name'], settings['user_last_name']
+    else:
+        client_type, model_path_or_key = choose_language_model_client()
+        user_first_name, user_last_name = get_user_name()
+    client = LanguageModelClientFactory.get_client(client_type, **{
+        'api_key': model_path_or_key if client_type == 'gpt-4-1106-preview' else None,
+        'model_path': model_path_or_key if client_type in ['llama-2-7B', 'openhermes-2.5-mistral-7b'] else None
+    })
+
+    usage = {'requests': 0, 'prompt_tokens': 0}
+    create_chat_completion = client.create_chat_completion
+
+    def counting_chat_completion(messages, max_tokens):
+        completion = create_chat_completion(messages=messages, max_tokens=max_tokens)
+        usage['requests'] += 1
+        if isinstance(completion, dict):
+            usage['prompt_tokens'] += completion.get('usage', {}).get('prompt_tokens', 0)
+        elif getattr(completion, 'usage', None) is not None:
+            usage['prompt_tokens'] += completion.usage.prompt_tokens
+        return completion
+
+    client.create_chat_completion = counting_chat_completion
+    results = {}
+    try:
+        for mode in ('single', 'batched'):
+            usage.update(requests=0, prompt_tokens=0)
+            started = time.perf_counter()
+            if mode == 'single':
+                verdicts = [evaluate_email(email_data, user_first_name, user_last_name, client) for email_data in emails]
+            else:
+                batch_evaluator = BatchEvaluator(user_first_name, user_last_name, client, max_emails=max(2, EMAILS_PER_PROMPT), token_budget=BATCH_TOKEN_BUDGET)
+                verdicts = batch_evaluator.evaluate(emails)
+            results[mode] = (verdicts, dict(usage), time.perf_counter() - started)
+    finally:
+        client.close()
+
+    single_verdicts, batched_verdicts = results['single'][0], results['batched'][0]
+    print(f"{Fore.LIGHTCYAN_EX}{'Single vs batched prompting'.center(50)}{Fore.RESET}")
+    print(f"{Fore.LIGHTCYAN_EX}{'-' * 50}{Fore.RESET}")
+    print(f"{Fore.LIGHTYELLOW_EX}{'':<26}{'single':>12}{'batched':>12}{Fore.RESET}")
+    rows = {
+        'Emails': (len(emails), len(emails)),
+        'Requests': (results['single'][1]['requests'], results['batched'][1]['requests']),
+        'Prompt tokens': (results['single'][1]['prompt_tokens'], results['batched'][1]['prompt_tokens']),
+        'Seconds': (f"{results['single'][2]:.1f}", f"{results['batched'][2]:.1f}"),
+        'Agreement with cache': tuple(
+            f"{sum(a == b for a, b in zip(verdicts, cached_verdicts)) / len(emails):.1%}" for verdicts in (single_verdicts, batched_verdicts)
+        ),
+    }
+    for key, (single, batched) in rows.items():
+        print(f"{Fore.LIGHTYELLOW_EX}{key:<26}{Fore.RESET}{single:>12}{batched:>12}")
+    agreement = sum(a == b for a, b in zip(single_verdicts, batched_verdicts)) / len(emails)
+    print(f"{Fore.LIGHTYELLOW_EX}{'Single/batched agreement':<26}{Fore.RESET}{agreement:>24.1%}")
+    print(f"{Fore.LIGHTCYAN_EX}{'-' * 50}{Fore.RESET}")
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        print("Current state of processed emails at error:", processed_emails)
+def peak_rss_megabytes():
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def run_benchmark(email_count, gmail_latency, throttle_rate, model_delay, model_concurrency, action='read', seed=0):
+    """
+    Run the whole pipeline against a synthetic mailbox served by FakeGmail and a stub model,
+    without network access, in a scratch directory so no real ledger or cache is touched.
+    Returns:
+        dict: Throughput, call counts, peak memory and how many verdicts were right.
+    """
+    from src.benchmark import FakeGmail, StubLanguageModelClient, generate_mailbox
+    user_email = 'benchmark@example.com'
+    mailbox = generate_mailbox(email_count, user_email, 'Smith', seed)
+    gmail = FakeGmail(mailbox, user_email, latency=gmail_latency, throttle_rate=throttle_rate, seed=seed)
+    client = StubLanguageModelClient(delay=model_delay, max_concurrency=model_concurrency)
+
+    working_directory = os.getcwd()
+    started = time.perf_counter()
+    with tempfile.TemporaryDirectory() as scratch_directory:
+        os.chdir(scratch_directory)
+        try:
+            process_account(gmail, lambda: gmail, user_email, client, action, 'Ann', 'Smith')
+        finally:
+            os.chdir(working_directory)
+    elapsed = time.perf_counter() - started
+
+    actioned = set(gmail.actioned_ids())
+    promotional = {message_id for message_id, message in mailbox.items() if message['promotional']}
+    results = {
+        'Emails': email_count,
+        'Seconds': f"{elapsed:.2f}",
+        'Emails per second': f"{email_count / elapsed:.1f}",
+        'Gmail HTTP requests': gmail.http_requests,
+        **{f'Gmail {endpoint} calls': count for endpoint, count in sorted(gmail.calls.items())},
+        'Model requests': client.requests,
+        'Peak RSS': f"{peak_rss_megabytes():.0f} MB" if peak_rss_megabytes() is not None else "n/a",
+        'Promotional emails actioned': f"{len(actioned & promotional)}/{len(promotional)}",
+        'Other emails actioned': len(actioned - promotional),
+    }
+    print(f"{Fore.LIGHTCYAN_EX}{'Benchmark'.center(50)}{Fore.RESET}")
+    print(f"{Fore.LIGHTCYAN_EX}{'-' * 50}{Fore.RESET}")
+    for key, value in results.items():
+        print(f"{Fore.LIGHTYELLOW_EX}{key:<35}{Fore.RESET}{value:<15}")
+    print(f"{Fore.LIGHTCYAN_EX}{'-' * 50}{Fore.RESET}")
+    return results
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Filter promotional emails out of your Gmail inbox.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help="Process unread emails (default)")
+    train_parser = subparsers.add_parser('train-classifier', help="Train the local classifier on past model verdicts")
+    train_parser.add_argument('--holdout', type=float, default=0.2, help="Share of verdicts held out to measure agreement")
+    subparsers.add_parser('evaluate-classifier', help="Measure the local classifier's agreement with past model verdicts")
+    daemon_parser = subparsers.add_parser('daemon', help="Keep polling several accounts without prompts")
+    daemon_parser.add_argument('--accounts', default=os.path.join('settings', 'accounts.json'), help="Account file, see accounts.example.json")
+    authorize_parser = subparsers.add_parser('authorize', help="Authorize a Gmail account for the daemon")
+    authorize_parser.add_argument('--token', required=True, help="Where to save the account's token, e.g. tokens/ann.json")
+    compare_parser = subparsers.add_parser('compare-batch', help="Compare single-email and batched prompting on past emails")
+    compare_parser.add_argument('--samples', type=int, default=100, help="Number of past emails to evaluate")
+    benchmark_parser = subparsers.add_parser('benchmark', help="Measure throughput offline, against a synthetic mailbox and a stub model")
+    benchmark_parser.add_argument('--emails', type=int, default=2000, help="Size of the synthetic mailbox")
+    benchmark_parser.add_argument('--gmail-latency', type=float, default=0.05, help="Seconds per Gmail HTTP request")
+    benchmark_parser.add_argument('--throttle-rate', type=float, default=0.0, help="Share of Gmail calls failing with 429")
+    benchmark_parser.add_argument('--model-delay', type=float, default=0.2, help="Seconds per model completion")
+    benchmark_parser.add_argument('--model-concurrency', type=int, default=None, help="Concurrent completions the stub model allows, e.g. 1 like a local model")
+    restore_parser = subparsers.add_parser('restore', help="Mark emails that were marked as read unread again")
+    restore_parser.add_argument('--since', help="Only emails actioned at or after this local time, e.g. 2024-03-01 or 2024-03-01T14:30")
+    restore_parser.add_argument('--until', help="Only emails actioned before this local time")
+    restore_parser.add_argument('--sender', help="Only emails whose sender matches this SQL LIKE pattern, e.g. %%@shop.example%%")
+    restore_parser.add_argument('--run-id', help="Only emails actioned by this run, e.g. 20240301-143000")
+    restore_parser.add_argument('--list-runs', action='store_true', help="List the runs that actioned emails, with their IDs, and restore nothing")
+    restore_parser.add_argument('--token', default='token.json', help="Token file of the account")
+    restore_parser.add_argument('--workers', type=int, default=4, help="Concurrent batchModify calls")
+    args = parser.parse_args(argv)
+
+    if args.command == 'train-classifier':
+        train_classifier(args.holdout)
+    elif args.command == 'evaluate-classifier':
+        evaluate_classifier()
+    elif args.command == 'daemon':
+        run_daemon(args.accounts)
+    elif args.command == 'authorize':
+        authorize(args.token)
+    elif args.command == 'compare-batch':
+        compare_batch_prompting(args.samples)
+    elif args.command == 'restore':
+        restore(args.token, args.since, args.until, args.sender, args.run_id, args.workers, args.list_runs)
+    elif args.command == 'benchmark':
+        run_benchmark(args.emails, args.gmail_latency, args.throttle_rate, args.model_delay, args.model_concurrency)
+    else:
+        main()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    cli()
\ No newline at end of file
@@ -0,0 +1,383 @@
+import base64
+import random
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from src.email_text import estimate_tokens
+from src.language_model_client import LanguageModelClient
+
+# Gmail's page size for messages.list when maxResults is not given, and its upper limit
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+WORDS = (
+    "meeting project weekend dinner family update schedule photos trip garden coffee review report "
+    "order account delivery invoice team question thanks call tomorrow plans birthday school friday"
+).split()
+PROMOTION_LINES = [
+    "Save 40% off everything this weekend only!",
+    "Exclusive offer: 25% off your next order with code SAVE25.",
+    "Flash sale: new arrivals at 50% off, today only.",
+]
+FIRST_NAMES = ['Alice', 'Ben', 'Chloe', 'David', 'Emma', 'Farid', 'Grace', 'Hiro']
+SHOPS = ['shop.example', 'deals.example', 'news.example', 'travel.example']
+
+
+def _encode(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _text_part(mime_type: str, text: str) -> dict:
+    return {
+        'mimeType': mime_type,
+        'filename': '',
+        'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset="UTF-8"'}],
+        'body': {'size': len(text), 'data': _encode(text)},
+    }
+
+
+def _paragraphs(rng: random.Random, count: int) -> List[str]:
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 60))).capitalize() + '.' for _ in range(count)]
+
+
+def generate_message(rng: random.Random, message_id: str, user_email: str, user_last_name: str) -> Dict[str, object]:
+    """
+    One synthetic message in the shape of a users.messages.get format=full response, drawn from
+    the layouts found in a real inbox: plain personal mail, multipart/alternative newsletters,
+    HTML-only promotions with inline images, and receipts with a PDF attachment.
+    Returns:
+        Dict: The message, with an extra 'promotional' key telling what a good classifier should say.
+    """
+    kind = rng.choices(['personal', 'newsletter', 'promotion', 'receipt'], weights=[3, 3, 3, 1])[0]
+    headers = [{'name': 'To', 'value': user_email}, {'name': 'Date', 'value': 'Mon, 1 Jan 2024 09:00:00 +0000'}]
+    labels = ['UNREAD', 'INBOX']
+    paragraphs = _paragraphs(rng, rng.randint(1, 6))
+
+    if kind == 'personal':
+        name = rng.choice(FIRST_NAMES)
+        surname = user_last_name if rng.random() < 0.3 else 'Taylor'
+        headers += [{'name': 'From', 'value': f'{name} {surname} <{name.lower()}@mail.example>'}, {'name': 'Subject', 'value': f'Re: {rng.choice(WORDS)} {rng.choice(WORDS)}'}]
+        text = f"Hi,\n\n" + '\n\n'.join(paragraphs) + f"\n\n{name}\n\nOn Sun, 31 Dec 2023 someone wrote:\n> earlier message"
+        payload = _text_part('text/plain', text)
+        labels.append('CATEGORY_PERSONAL')
+    elif kind == 'receipt':
+        shop = rng.choice(SHOPS)
+        headers += [{'name': 'From', 'value': f'Orders <orders@{shop}>'}, {'name': 'Subject', 'value': f'Your receipt for order #{rng.randint(10000, 99999)}'}]
+        text = "Thank you for your order.\n\n" + paragraphs[0]
+        payload = {
+            'mimeType': 'multipart/mixed',
+            'filename': '',
+            'headers': [{'name': 'Content-Type', 'value': 'multipart/mixed; boundary="outer"'}],
+            'body': {'size': 0},
+            'parts': [
+                {
+                    'mimeType': 'multipart/alternative',
+                    'filename': '',
+                    'headers': [],
+                    'body': {'size': 0},
+                    'parts': [_text_part('text/plain', text), _text_part('text/html', f"<html><body><p>{text}</p></body></html>")],
+                },
+                {
+                    'mimeType': 'application/pdf',
+                    'filename': 'receipt.pdf',
+                    'headers': [{'name': 'Content-Disposition', 'value': 'attachment; filename="receipt.pdf"'}],
+                    'body': {'size': 48213, 'attachmentId': f'attachment-{message_id}'},
+                },
+            ],
+        }
+        labels.append('CATEGORY_UPDATES')
+    else:
+        shop = rng.choice(SHOPS)
+        offer = rng.choice(PROMOTION_LINES)
+        # A shop sends the same campaign many times over, with only the numbers changing
+        paragraphs = _paragraphs(random.Random(f'{shop} {offer}'), 4) + [f"You have {rng.randint(100, 9999)} reward points, valid until {rng.randint(1, 28)} March."]
+        headers += [
+            {'name': 'From', 'value': f'{shop.split(".")[0].title()} <news@{shop}>'},
+            {'name': 'Subject', 'value': offer},
+            {'name': 'List-Unsubscribe', 'value': f'<https://{shop}/unsubscribe?id={message_id}>'},
+        ]
+        footer = f"You are receiving this email because you signed up at {shop}.\nUnsubscribe: https://{shop}/unsubscribe?id={message_id}"
+        html = (
+            "<html><head><style>p {font-family: Arial}</style></head><body>"
+            f"<h1>{offer}</h1>" + ''.join(f"<p>{paragraph}</p>" for paragraph in paragraphs) +
+            f"<p><a href=\"https://{shop}/track?c={message_id}&u=123456789\">Shop now</a></p>"
+            f"<p style=\"font-size: 10px\">{footer}</p></body></html>"
+        )
+        if kind == 'newsletter':
+            payload = {
+                'mimeType': 'multipart/alternative',
+                'filename': '',
+                'headers': [{'name': 'Content-Type', 'value': 'multipart/alternative; boundary="alt"'}],
+                'body': {'size': 0},
+                'parts': [_text_part('text/plain', f"{offer}\n\n" + '\n\n'.join(paragraphs) + f"\n\n{footer}"), _text_part('text/html', html)],
+            }
+        else:
+            payload = {
+                'mimeType': 'multipart/related',
+                'filename': '',
+                'headers': [{'name': 'Content-Type', 'value': 'multipart/related; boundary="rel"'}],
+                'body': {'size': 0},
+                'parts': [
+                    _text_part('text/html', html),
+                    {'mimeType': 'image/png', 'filename': 'logo.png', 'headers': [{'name': 'Content-Disposition', 'value': 'inline; filename="logo.png"'}], 'body': {'size': 5120, 'attachmentId': f'logo-{message_id}'}},
+                ],
+            }
+        labels.append('CATEGORY_PROMOTIONS')
+
+    payload = dict(payload, headers=headers + payload['headers'])
+    return {
+        'id': message_id,
+        'threadId': message_id,
+        'labelIds': labels,
+        'snippet': paragraphs[0][:100],
+        'sizeEstimate': len(str(payload)),
+        'payload': payload,
+        'promotional': kind in ('newsletter', 'promotion'),
+    }
+
+
+def generate_mailbox(count: int, user_email: str = 'me@example.com', user_last_name: str = 'Smith', seed: int = 0) -> Dict[str, Dict[str, object]]:
+    rng = random.Random(seed)
+    return {f'{index:012x}': generate_message(rng, f'{index:012x}', user_email, user_last_name) for index in range(count)}
+
+
+def _http_error(status: int) -> HttpError:
+    return HttpError(httplib2.Response({'status': status}), b'{"error": {"message": "Rate limit exceeded"}}')
+
+
+class _FakeRequest:
+    def __init__(self, gmail: 'FakeGmail', endpoint: str, handler: Callable[[], dict]):
+        self.gmail = gmail
+        self.endpoint = endpoint
+        self.handler = handler
+
+    def execute(self) -> dict:
+        self.gmail._http_request(self.endpoint)
+        return self.handler()
+
+
+class _FakeBatch:
+    def __init__(self, gmail: 'FakeGmail', callback: Callable):
+        self.gmail = gmail
+        self.callback = callback
+        self.requests: List[tuple] = []
+
+    def add(self, request: _FakeRequest, request_id: Optional[str] = None) -> None:
+        if len(self.requests) >= 100:
+            raise ValueError("Gmail batch requests are limited to 100 calls")
+        self.requests.append((request_id, request))
+
+    def execute(self) -> None:
+        self.gmail._http_request('batch')
+        for request_id, request in self.requests:
+            self.gmail._count(request.endpoint)
+            if self.gmail._throttled():
+                self.callback(request_id, None, _http_error(429))
+                continue
+            try:
+                response = request.handler()
+            except HttpError as e:
+                self.callback(request_id, None, e)
+                continue
+            self.callback(request_id, response, None)
+
+
+class _FakeMessages:
+    def __init__(self, gmail: 'FakeGmail'):
+        self.gmail = gmail
+
+    def list(self, userId: str, labelIds: Optional[List[str]] = None, pageToken: Optional[str] = None, maxResults: int = DEFAULT_PAGE_SIZE, q: Optional[str] = None) -> _FakeRequest:
+        return _FakeRequest(self.gmail, 'messages.list', lambda: self.gmail._list(labelIds or [], pageToken, maxResults, q))
+
+    def get(self, userId: str, id: str, format: str = 'full', metadataHeaders: Optional[List[str]] = None, fields: Optional[str] = None) -> _FakeRequest:
+        return _FakeRequest(self.gmail, 'messages.get', lambda: self.gmail._get(id, format, metadataHeaders))
+
+    def modify(self, userId: str, id: str, body: dict) -> _FakeRequest:
+        return _FakeRequest(self.gmail, 'messages.modify', lambda: self.gmail._modify([id], body))
+
+    def batchModify(self, userId: str, body: dict) -> _FakeRequest:
+        return _FakeRequest(self.gmail, 'messages.batchModify', lambda: self.gmail._modify(body['ids'], body))
+
+    def delete(self, userId: str, id: str) -> _FakeRequest:
+        return _FakeRequest(self.gmail, 'messages.delete', lambda: self.gmail._delete([id]))
+
+    def batchDelete(self, userId: str, body: dict) -> _FakeRequest:
+        return _FakeRequest(self.gmail, 'messages.batchDelete', lambda: self.gmail._delete(body['ids']))
+
+
+class _FakeHistory:
+    def __init__(self, gmail: 'FakeGmail'):
+        self.gmail = gmail
+
+    def list(self, userId: str, startHistoryId: str, historyTypes: Optional[List[str]] = None, pageToken: Optional[str] = None) -> _FakeRequest:
+        # Nothing changes in the mailbox between runs of a benchmark
+        return _FakeRequest(self.gmail, 'history.list', lambda: {'history': [], 'historyId': self.gmail.history_id})
+
+
+class _FakeUsers:
+    def __init__(self, gmail: 'FakeGmail'):
+        self.gmail = gmail
+
+    def messages(self) -> _FakeMessages:
+        return _FakeMessages(self.gmail)
+
+    def history(self) -> _FakeHistory:
+        return _FakeHistory(self.gmail)
+
+    def getProfile(self, userId: str) -> _FakeRequest:
+        return _FakeRequest(self.gmail, 'getProfile', lambda: {'emailAddress': self.gmail.user_email, 'historyId': self.gmail.history_id, 'messagesTotal': len(self.gmail.mailbox)})
+
+
+class FakeGmail:
+    """
+    In-process stand-in for the Gmail API resource, serving a synthetic mailbox.
+
+    Every HTTP request (a plain call or a whole batch) waits `latency` seconds, and
+    each call fails with a 429 with probability `throttle_rate`, the way Gmail
+    throttles a client that goes over its quota. Request counts per endpoint are
+    kept in `calls`. One instance can be shared by every pipeline thread.
+    """
+
+    def __init__(self, mailbox: Dict[str, Dict[str, object]], user_email: str = 'me@example.com', latency: float = 0.0, throttle_rate: float = 0.0, seed: int = 0):
+        self.mailbox = mailbox
+        self.user_email = user_email
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.history_id = '1000'
+        self.calls: Dict[str, int] = {}
+        self.http_requests = 0
+        self._order = sorted(mailbox)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def users(self) -> _FakeUsers:
+        return _FakeUsers(self)
+
+    def new_batch_http_request(self, callback: Callable) -> _FakeBatch:
+        return _FakeBatch(self, callback)
+
+    def actioned_ids(self) -> List[str]:
+        """IDs of the messages marked as read or deleted so far."""
+        with self._lock:
+            return [message_id for message_id, message in self.mailbox.items() if message.get('deleted') or 'UNREAD' not in message['labelIds']]
+
+    def _http_request(self, endpoint: str) -> None:
+        with self._lock:
+            self.http_requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if endpoint != 'batch':
+            self._count(endpoint)
+            if self._throttled():
+                raise _http_error(429)
+
+    def _count(self, endpoint: str) -> None:
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def _throttled(self) -> bool:
+        with self._lock:
+            return self._rng.random() < self.throttle_rate
+
+    def _list(self, label_ids: List[str], page_token: Optional[str], max_results: int, query: Optional[str] = None) -> dict:
+        # Page tokens are positions in a fixed order, so actions taken between pages don't shift them
+        max_results = max(1, min(max_results, MAX_PAGE_SIZE))
+        position = int(page_token) if page_token else 0
+        messages = []
+        with self._lock:
+            while position < len(self._order) and len(messages) < max_results:
+                message = self.mailbox[self._order[position]]
+                position += 1
+                if not message.get('deleted') and all(label in message['labelIds'] for label in label_ids) and _matches_query(message['labelIds'], query):
+                    messages.append({'id': message['id'], 'threadId': message['threadId']})
+        response = {'messages': messages, 'resultSizeEstimate': len(messages)}
+        if position < len(self._order):
+            response['nextPageToken'] = str(position)
+        return response
+
+    def _get(self, message_id: str, format: str, metadata_headers: Optional[List[str]]) -> dict:
+        message = self.mailbox.get(message_id)
+        if message is None or message.get('deleted'):
+            raise _http_error(404)
+        with self._lock:
+            labels = list(message['labelIds'])
+        payload = message['payload']
+        if format == 'metadata':
+            wanted = {header.lower() for header in metadata_headers or []}
+            headers = [header for header in payload['headers'] if not wanted or header['name'].lower() in wanted]
+            payload = {'mimeType': payload['mimeType'], 'headers': headers}
+        return {'id': message_id, 'threadId': message['threadId'], 'labelIds': labels, 'snippet': message['snippet'], 'sizeEstimate': message['sizeEstimate'], 'payload': payload}
+
+    def _modify(self, message_ids: List[str], body: dict) -> dict:
+        with self._lock:
+            for message_id in message_ids:
+                labels = self.mailbox[message_id]['labelIds']
+                labels[:] = [label for label in labels if label not in body.get('removeLabelIds', [])] + [label for label in body.get('addLabelIds', []) if label not in labels]
+        return {}
+
+    def _delete(self, message_ids: List[str]) -> dict:
+        with self._lock:
+            for message_id in message_ids:
+                self.mailbox[message_id]['deleted'] = True
+        return {}
+
+
+def _matches_query(labels: List[str], query: Optional[str]) -> bool:
+    # Understands the label and category terms of a Gmail search; the synthetic
+    # messages are all recent, so other terms match every message
+    for term in (query or '').split():
+        negated = term.startswith('-')
+        key, _, value = term.lstrip('-').partition(':')
+        if key == 'category':
+            label = 'CATEGORY_PERSONAL' if value == 'primary' else f'CATEGORY_{value.upper()}'
+        elif key in ('label', 'in'):
+            label = value.upper()
+        else:
+            continue
+        if (label in labels) == negated:
+            return False
+    return True
+
+
+class StubLanguageModelClient(LanguageModelClient):
+    """
+    Answers like a model without running one: an email is promotional when it mentions an
+    offer or an unsubscribe link. Each completion takes `delay` seconds, standing in for the
+    latency of a real backend; max_concurrency=1 behaves like a local llama.cpp client.
+    """
+
+    def __init__(self, delay: float = 0.0, max_concurrency: Optional[int] = None, model_name: str = 'stub-model'):
+        super().__init__(model_name=model_name)
+        self.delay = delay
+        self.max_concurrency = max_concurrency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def create_chat_completion(self, messages: list, max_tokens: int):
+        if self.delay:
+            time.sleep(self.delay)
+        content = messages[-1]['content']
+        emails = re.split(r'^Email \d+:\n', content, flags=re.MULTILINE)
+        if len(emails) > 1:
+            reply = '\n'.join(f"{number}: {self._verdict(email)}" for number, email in enumerate(emails[1:], start=1))
+        else:
+            reply = str(self._verdict(content))
+        with self._lock:
+            self.requests += 1
+        return {
+            'model': self.model_name,
+            'choices': [{'message': {'role': 'assistant', 'content': reply}}],
+            'usage': {'prompt_tokens': sum(estimate_tokens(message['content']) for message in messages), 'completion_tokens': estimate_tokens(reply)},
+        }
+
+    def stats(self) -> Dict[str, object]:
+        return {'Stub model requests': self.requests}
+
+    @staticmethod
+    def _verdict(email: str) -> bool:
+        return '% off' in email or '[Unsubscribe link]' in email
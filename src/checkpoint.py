@@ -0,0 +1,138 @@
+import json
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+from src.gmail_service import IncrementalLister
+from src.ledger import CLASSIFIED, FETCHED, LISTED, Ledger
+
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+
+# Ledger state key of the paging cursor of an unfinished run
+CURSOR_STATE_KEY = 'page_cursor'
+# Page token leading from the resumed emails to the first page, as the pipeline stops on an empty token
+FIRST_PAGE = 'first-page'
+# Runs that may retry an email that keeps failing to download, e.g. one deleted since it was listed.
+# Emails whose download went through stay in flight until they are classified, however many runs that takes
+MAX_EMAIL_ATTEMPTS = 3
+# Runs that may retry the action on a promotional email that keeps failing it
+MAX_ACTION_ATTEMPTS = 3
+
+
+class CheckpointedLister:
+    """
+    Page source wrapping an IncrementalLister so a run that crashed or was
+    stopped is picked up where it left off.
+
+    Every page is recorded in the ledger before the pipeline gets it: its new
+    emails as listed, and the token of the next page as the run's cursor.
+    A restarted run first hands out the emails an earlier run listed but
+    never got to classify, then carries on paging from the stored cursor,
+    leaving out emails that are already in flight. An email is handed out
+    again by MAX_EMAIL_ATTEMPTS runs at most while it keeps failing to
+    download, before it is given up on and recorded as processed without a
+    verdict; one that downloads but cannot be classified, e.g. while the
+    model is down, is retried until it is. Classified emails whose action
+    never went through are not listed again; unfinished_actions() gives
+    them to the action queue, for MAX_ACTION_ATTEMPTS runs at most.
+
+    The cursor is only reused by a run listing the same way (same history ID
+    and searches), and history_id becomes the mailbox position the
+    interrupted run started at, so emails that arrived in between are still
+    picked up by the next incremental run. complete tells whether every page
+    has been listed, and finish() stores history_id and drops the cursor.
+    """
+
+    def __init__(self, lister: IncrementalLister, ledger: Ledger, history_id: Optional[str]):
+        self.lister = lister
+        self.ledger = ledger
+        self.history_id = history_id
+        self.listing_done = False
+        self._resume_token: Optional[str] = None
+        self._resuming = False
+
+        cursor = self._load_cursor()
+        if cursor is not None:
+            print(f"Resuming the interrupted run that started at history ID {cursor['history_id']}")
+            self.history_id = cursor['history_id']
+            lister.full_scan = cursor['full_scan']
+            self._resume_token = cursor['page_token']
+            self.listing_done = cursor['listing_done']
+            self._resuming = not self.listing_done
+        # Retried emails go back to listed, so only those whose download kept failing are still listed
+        given_up = ledger.in_flight(LISTED, MAX_EMAIL_ATTEMPTS)
+        if given_up:
+            print(f"Giving up on {len(given_up)} emails that could not be processed in {MAX_EMAIL_ATTEMPTS} runs")
+            ledger.mark_processed_many(given_up, None)
+        self._unfinished = ledger.in_flight(LISTED) + ledger.in_flight(FETCHED)
+
+    @property
+    def complete(self) -> bool:
+        return self.listing_done and self.lister.complete
+
+    def unfinished_actions(self) -> List[str]:
+        """IDs of the promotional emails an earlier run classified but never got to action, counting another attempt at each."""
+        given_up = self.ledger.in_flight(CLASSIFIED, MAX_ACTION_ATTEMPTS)
+        if given_up:
+            print(f"Giving up on the action on {len(given_up)} emails that failed it in {MAX_ACTION_ATTEMPTS} runs")
+            self.ledger.mark_processed_many(given_up, True)
+        email_ids = self.ledger.in_flight(CLASSIFIED)
+        self.ledger.mark_retried(email_ids)
+        return email_ids
+
+    def __call__(self, gmail: 'Resource', page_token: Optional[str]) -> Tuple[List[Dict[str, Union[str, List[str]]]], Optional[str]]:
+        if page_token is None:
+            if self._unfinished:
+                print(f"Picking up {len(self._unfinished)} emails left unfinished by an earlier run")
+                messages = [{'id': email_id} for email_id in self._unfinished]
+                self.ledger.mark_retried(self._unfinished)
+                self._unfinished = []
+                return messages, None if self.listing_done else self._resume_token or FIRST_PAGE
+            if self.listing_done:
+                return [], None
+            page_token = self._resume_token
+        elif page_token == FIRST_PAGE:
+            page_token = None
+
+        messages, next_page_token = self.lister(gmail, page_token)
+        if not self.lister.complete:
+            if self._resuming:
+                # A stored page token Gmail no longer accepts would stop every later run at the same page
+                print("Could not resume from the stored page, the next run starts over")
+                self.ledger.set_state(CURSOR_STATE_KEY, None)
+            return messages, None
+        self._resuming = False
+
+        new_ids = set(self.ledger.mark_listed([message_info['id'] for message_info in messages]))
+        # Emails already in flight were handed out on the resumed page or earlier in this run;
+        # processed ones are left in for the pipeline's skip check
+        messages = [message_info for message_info in messages if message_info['id'] in new_ids or message_info['id'] in self.ledger]
+        self.listing_done = not next_page_token
+        self._save_cursor(next_page_token)
+        return messages, next_page_token
+
+    def finish(self) -> None:
+        """Store the mailbox position for the next run and drop the cursor, once the run is complete."""
+        self.ledger.set_state('history_id', self.history_id)
+        self.ledger.set_state(CURSOR_STATE_KEY, None)
+
+    def _signature(self) -> Dict[str, object]:
+        return {'start_history_id': self.lister.start_history_id, 'searches': self.lister.searches}
+
+    def _load_cursor(self) -> Optional[Dict[str, object]]:
+        stored = self.ledger.get_state(CURSOR_STATE_KEY)
+        if not stored:
+            return None
+        cursor = json.loads(stored)
+        if cursor['signature'] != self._signature():
+            print("Emails are listed differently than in the interrupted run, listing them from the start")
+            return None
+        return cursor
+
+    def _save_cursor(self, next_page_token: Optional[str]) -> None:
+        self.ledger.set_state(CURSOR_STATE_KEY, json.dumps({
+            'signature': self._signature(),
+            'history_id': self.history_id,
+            'full_scan': self.lister.full_scan,
+            'page_token': next_page_token,
+            'listing_done': self.listing_done,
+        }))
@@ -0,0 +1,221 @@
+import asyncio
+import json
+import signal
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from src.language_model_client import LanguageModelClient, LocalClassifierClient
+from src.pipeline import EmailPipeline
+
+ACTIONS = ('read', 'delete')
+
+
+class Account:
+    """One mailbox served by the daemon, with its own token file and polling interval."""
+
+    def __init__(self, name: str, token_path: str, user_first_name: str, user_last_name: str, action: str = 'read', poll_interval_minutes: float = 15):
+        if action not in ACTIONS:
+            raise ValueError(f"Invalid action for account {name}: {action}")
+        self.name = name
+        self.token_path = token_path
+        self.user_first_name = user_first_name
+        self.user_last_name = user_last_name
+        self.action = action
+        self.poll_interval_seconds = poll_interval_minutes * 60
+
+
+def load_daemon_config(path: str) -> Tuple[str, Optional[str], List[Account]]:
+    """
+    Read the daemon's account file:
+
+        {"client_type": "gpt-4-1106-preview",
+         "accounts": [{"name": "ann", "token_path": "tokens/ann.json", "user_first_name": "Ann",
+                       "user_last_name": "Smith", "action": "read", "poll_interval_minutes": 15}]}
+
+    Returns:
+        Tuple[str, Optional[str], List[Account]]: The model client type, its key or model path if
+        given (otherwise taken from .env), and the accounts.
+    """
+    with open(path, 'r') as file:
+        config = json.load(file)
+    accounts = [Account(**account) for account in config.get('accounts', [])]
+    if not accounts:
+        raise ValueError(f"No accounts configured in {path}")
+    names = [account.name for account in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Account names must be unique in {path}")
+    return config['client_type'], config.get('model_path_or_key'), accounts
+
+
+class FairScheduler:
+    """
+    Hands out a fixed number of model slots round-robin between accounts.
+
+    A caller gets a free slot straight away when nobody is waiting. Otherwise
+    every released slot goes to the next account in turn that has a caller
+    waiting, so an account with a huge backlog gets no more of the model than
+    any other account with work to do.
+    """
+
+    def __init__(self, slots: int):
+        self.slots = max(1, slots)
+        self._available = self.slots
+        self._waiting: Dict[str, Deque[threading.Event]] = {}
+        self._turns: Deque[str] = deque()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def turn(self, account: str) -> Iterator[None]:
+        self._acquire(account)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def aturn(self, account: str) -> AsyncIterator[None]:
+        # The wait for a slot runs on a worker thread, so the event loop keeps serving other calls
+        acquiring = asyncio.ensure_future(asyncio.to_thread(self._acquire, account))
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            # The slot is still granted once the wait ends, hand it on then
+            acquiring.add_done_callback(lambda _: self._release())
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _acquire(self, account: str) -> None:
+        with self._lock:
+            if self._available and not self._turns:
+                self._available -= 1
+                return
+            granted = threading.Event()
+            if account not in self._waiting:
+                self._waiting[account] = deque()
+                self._turns.append(account)
+            self._waiting[account].append(granted)
+        granted.wait()
+
+    def _release(self) -> None:
+        with self._lock:
+            if not self._turns:
+                self._available += 1
+                return
+            # The slot passes straight to the next account's oldest caller
+            account = self._turns.popleft()
+            waiting = self._waiting[account]
+            waiting.popleft().set()
+            if waiting:
+                self._turns.append(account)
+            else:
+                del self._waiting[account]
+
+
+class ScheduledClient(LanguageModelClient):
+    """
+    One account's view of a client shared by every account, taking turns through a FairScheduler.
+    Closing it leaves the shared client open.
+    """
+
+    def __init__(self, client: LanguageModelClient, scheduler: FairScheduler, account: str):
+        super().__init__(model_name=client.model_name)
+        self.client = client
+        self.scheduler = scheduler
+        self.account = account
+        self.max_concurrency = client.max_concurrency
+        self.max_body_tokens = client.max_body_tokens
+        self.context_tokens = client.context_tokens
+
+    def count_tokens(self, text: str) -> int:
+        return self.client.count_tokens(text)
+
+    def create_chat_completion(self, messages: list, max_tokens: int):
+        with self.scheduler.turn(self.account):
+            return self.client.create_chat_completion(messages=messages, max_tokens=max_tokens)
+
+    async def acreate_chat_completion(self, messages: list, max_tokens: int):
+        async with self.scheduler.aturn(self.account):
+            return await self.client.acreate_chat_completion(messages=messages, max_tokens=max_tokens)
+
+    def stats(self) -> Dict[str, object]:
+        return self.client.stats()
+
+
+def schedule_client(client: LanguageModelClient, scheduler: FairScheduler, account: str) -> LanguageModelClient:
+    # The local classifier costs nothing to share, only the model behind it takes turns
+    if isinstance(client, LocalClassifierClient):
+        return LocalClassifierClient(client.classifier, ScheduledClient(client.fallback, scheduler, account))
+    return ScheduledClient(client, scheduler, account)
+
+
+class Daemon:
+    """
+    Polls every account on its own interval until SIGTERM or SIGINT.
+
+    process(account, on_pipeline) runs one pass over an account's mailbox and
+    hands its EmailPipeline to on_pipeline, so a shutdown can stop the paging
+    of every running pass and let the emails in flight drain before exiting.
+    An account is polled again poll_interval after its last pass ended.
+    """
+
+    def __init__(self, accounts: List[Account], process: Callable[[Account, Callable[[EmailPipeline], None]], None]):
+        self.accounts = accounts
+        self.process = process
+        self._next_run = {account.name: 0.0 for account in accounts}
+        self._threads: Dict[str, threading.Thread] = {}
+        self._pipelines: Dict[str, EmailPipeline] = {}
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def run(self) -> None:
+        previous_handlers = {sig: signal.signal(sig, self._handle_signal) for sig in (signal.SIGTERM, signal.SIGINT)}
+        print(f"Watching {len(self.accounts)} accounts, stop with Ctrl+C or SIGTERM")
+        try:
+            while not self._stop_event.is_set():
+                now = time.monotonic()
+                for account in self.accounts:
+                    thread = self._threads.get(account.name)
+                    if (thread is None or not thread.is_alive()) and now >= self._next_run[account.name]:
+                        thread = threading.Thread(target=self._run_account, args=(account,), name=f"account-{account.name}", daemon=True)
+                        self._threads[account.name] = thread
+                        thread.start()
+                # Wake up regularly, accounts that finish a pass are due again from then on
+                self._stop_event.wait(min(5.0, max(0.1, min(self._next_run.values()) - time.monotonic())))
+            print("Shutting down, finishing the emails already in flight...")
+            for thread in self._threads.values():
+                thread.join()
+        finally:
+            for sig, handler in previous_handlers.items():
+                signal.signal(sig, handler)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        with self._lock:
+            for pipeline in self._pipelines.values():
+                pipeline.stop()
+
+    def _handle_signal(self, signum, frame) -> None:
+        self.stop()
+
+    def _run_account(self, account: Account) -> None:
+        try:
+            self.process(account, lambda pipeline: self._register(account, pipeline))
+        except Exception as e:
+            print(f"Failed to process account {account.name}: {e}")
+        finally:
+            with self._lock:
+                self._pipelines.pop(account.name, None)
+            self._next_run[account.name] = time.monotonic() + account.poll_interval_seconds
+
+    def _register(self, account: Account, pipeline: EmailPipeline) -> None:
+        with self._lock:
+            self._pipelines[account.name] = pipeline
+            # A shutdown requested while the pass was starting up must still reach it
+            if self._stop_event.is_set():
+                pipeline.stop()
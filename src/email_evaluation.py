@@ -1,42 +1,239 @@
-from typing import Dict, List, Union
-from openai import OpenAI
-from src.language_model_client import OpenAIClient, LlamaClient, HermesClient
+import asyncio
+import hashlib
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Union
+from src.language_model_client import PROMPT_OVERHEAD_TOKENS, AsyncOpenAIClient, LanguageModelClient, LocalClassifierClient
+from src.local_classifier import is_local_prediction
+from src.verdict_cache import VerdictCache
+from src.email_text import estimate_tokens, truncate_to_tokens
+from src.metrics import metrics
 
+# Body budget when no client is given, e.g. for prompt_version
+MAX_BODY_TOKENS = 750
 
+# One "<n>: True/False" verdict of a batched reply; also matches JSON such as {"1": true}
+BATCH_VERDICT_PATTERN = re.compile(r'(?:^|[\s,{\[])"?(?:email\s*)?(\d+)"?\s*[:=).-]\s*"?(true|false)\b', re.IGNORECASE)
 
-def evaluate_email(email_data: Dict[str, Union[str, List[str]]], user_first_name: str, user_last_name: str, client: OpenAI) -> bool:
-    MAX_EMAIL_LEN = 3000
+
+def evaluate_email(email_data: Dict[str, Union[str, List[str]]], user_first_name: str, user_last_name: str, client: LanguageModelClient, verdict_cache: Optional[VerdictCache] = None) -> Optional[bool]:
+    """
+    Returns:
+        Optional[bool]: Whether the email is promotional, or None when the model could not be
+        asked, e.g. once rate limit retries ran out, so the email is left for a later run.
+    """
+    with metrics.time('evaluate'):
+        return _evaluate_email(email_data, user_first_name, user_last_name, client, verdict_cache)
+
+
+def _evaluate_email(email_data: Dict[str, Union[str, List[str]]], user_first_name: str, user_last_name: str, client: LanguageModelClient, verdict_cache: Optional[VerdictCache]) -> Optional[bool]:
+    messages = build_messages(email_data, user_first_name, user_last_name, client)
+    if messages is None:
+        return False
+
+    if verdict_cache is not None:
+        cached_verdict = verdict_cache.get(email_data)
+        if cached_verdict is not None:
+            return cached_verdict
+
+    return _request_verdict(email_data, messages, client, verdict_cache)
+
+
+def _request_verdict(email_data: Dict[str, Union[str, List[str]]], messages: List[Dict[str, str]], client: LanguageModelClient, verdict_cache: Optional[VerdictCache]) -> Optional[bool]:
+    # Send the messages to the model; OpenAI rate limits are retried inside AsyncOpenAIClient
+    try:
+        completion = _complete(client, messages, max_tokens=1)
+    except Exception as e:
+        print(f"Failed to evaluate email: {e}")
+        return None
+    return _verdict(email_data, completion, verdict_cache)
+
+
+def _verdict(email_data: Dict[str, Union[str, List[str]]], completion, verdict_cache: Optional[VerdictCache]) -> bool:
+    verdict = parse_verdict(completion)
+    # Only verdicts the model actually gave are cached, never a local prediction
+    if verdict_cache is not None and not is_local_prediction(completion):
+        verdict_cache.put(email_data, verdict)
+    return verdict
+
+
+def _complete(client: LanguageModelClient, messages: List[Dict[str, str]], max_tokens: int):
+    # Every model call goes through here or _acomplete, so its latency and tokens are recorded per backend
+    started = time.perf_counter()
+    completion = client.create_chat_completion(messages=messages, max_tokens=max_tokens)
+    _record_completion(client, completion, started)
+    return completion
+
+
+async def _acomplete(client: AsyncOpenAIClient, messages: List[Dict[str, str]], max_tokens: int):
+    started = time.perf_counter()
+    completion = await client.acreate_chat_completion(messages=messages, max_tokens=max_tokens)
+    _record_completion(client, completion, started)
+    return completion
+
+
+def _record_completion(client: LanguageModelClient, completion, started: float) -> None:
+    if is_local_prediction(completion):
+        return
+    metrics.observe('model_completion', time.perf_counter() - started)
+    prompt_tokens, completion_tokens = completion_usage(completion)
+    metrics.record_tokens(client.model_name, prompt_tokens, completion_tokens)
+
+
+def prompt_version(user_first_name: str, user_last_name: str, batched: bool = False) -> str:
+    """
+    Fingerprint of the system prompt, so cached verdicts are invalidated whenever
+    the prompt text or the user's name changes; batched, that of the several-emails prompt.
+    """
+    if batched:
+        system_message = build_batch_messages([], user_first_name, user_last_name)[0]
+    else:
+        system_message = build_messages({'body': '', 'subject': '', 'to': '', 'from': '', 'cc': '', 'labels': []}, user_first_name, user_last_name)[0]
+    return hashlib.sha256(system_message['content'].encode('utf-8')).hexdigest()[:16]
+
+
+async def evaluate_many(emails: List[Dict[str, Union[str, List[str]]]], user_first_name: str, user_last_name: str, client: AsyncOpenAIClient, verdict_cache: Optional[VerdictCache] = None) -> List[Optional[bool]]:
+    """
+    Evaluate a list of emails concurrently, like evaluate_email does one by one.
+    Returns:
+        List[Optional[bool]]: The verdicts, in the same order as the emails; None for the
+        emails the model could not be asked about.
+    """
+    async def evaluate_one(email_data):
+        messages = build_messages(email_data, user_first_name, user_last_name, client)
+        if messages is None:
+            return False
+        if verdict_cache is not None:
+            cached_verdict = verdict_cache.get(email_data)
+            if cached_verdict is not None:
+                return cached_verdict
+        try:
+            completion = await _acomplete(client, messages, max_tokens=1)
+        except Exception as e:
+            print(f"Failed to evaluate email: {e}")
+            return None
+        return _verdict(email_data, completion, verdict_cache)
+
+    return list(await asyncio.gather(*(evaluate_one(email_data) for email_data in emails)))
+
+
+class BatchEvaluator:
+    """
+    Evaluates several emails per completion instead of one.
+
+    Emails are packed into prompts of at most max_emails emails whose estimated
+    size stays within token_budget, and within the context window of a local
+    model next to the system prompt. The model answers with one numbered
+    verdict per email. Emails whose verdict is missing, out of range or
+    contradictory in the reply, or whose batch call failed, are evaluated on
+    their own. Verdicts from a batch are cached under the batched prompt's
+    version, apart from those of the single-email prompt, which a batch run
+    reuses as well.
+    """
+
+    def __init__(self, user_first_name: str, user_last_name: str, client: LanguageModelClient, verdict_cache: Optional[VerdictCache] = None, max_emails: int = 10, token_budget: int = 8000):
+        self.user_first_name = user_first_name
+        self.user_last_name = user_last_name
+        self.client = client
+        self.verdict_cache = verdict_cache
+        self.batch_prompt_version = prompt_version(user_first_name, user_last_name, batched=True)
+        self.max_emails = max(1, max_emails)
+        # A budget past a llama.cpp context would truncate every batch, or overflow it
+        self.token_budget = token_budget if client.context_tokens is None else min(token_budget, client.context_tokens - PROMPT_OVERHEAD_TOKENS)
+        self.batch_requests = 0
+        self.batched_emails = 0
+        self.fallback_emails = 0
+        self._lock = threading.Lock()
+
+    def evaluate(self, emails: List[Dict[str, Union[str, List[str]]]]) -> List[Optional[bool]]:
+        """
+        Returns:
+            List[Optional[bool]]: The verdicts, in the same order as the emails; None for the
+            emails the model could not be asked about.
+        """
+        verdicts: List[Optional[bool]] = [None] * len(emails)
+        pending = []
+        for index, email_data in enumerate(emails):
+            if 'body' not in email_data:
+                verdicts[index] = False
+            elif self.verdict_cache is not None:
+                verdicts[index] = self.verdict_cache.get(email_data, prompt_versions=[self.verdict_cache.prompt_version, self.batch_prompt_version])
+            if verdicts[index] is None:
+                pending.append(index)
+
+        client = self.client
+        if isinstance(client, LocalClassifierClient):
+            # Only the emails the local classifier is unsure about are worth a model call
+            for index, prediction in zip(pending, client.classify_emails([emails[index] for index in pending])):
+                verdicts[index] = prediction
+            pending = [index for index in pending if verdicts[index] is None]
+            client = client.fallback
+
+        for group in self._pack(emails, pending):
+            if len(group) == 1:
+                verdicts[group[0]] = self._evaluate_alone(emails[group[0]], client)
+                continue
+            answered = self._evaluate_group([emails[index] for index in group], client)
+            with self._lock:
+                self.batch_requests += 1
+                self.batched_emails += len(answered)
+                self.fallback_emails += len(group) - len(answered)
+            for number, index in enumerate(group, start=1):
+                if number in answered:
+                    verdicts[index] = answered[number]
+                    if self.verdict_cache is not None:
+                        self.verdict_cache.put(emails[index], answered[number], prompt_version=self.batch_prompt_version)
+                else:
+                    verdicts[index] = self._evaluate_alone(emails[index], client)
+        return verdicts
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            'Batched model requests': self.batch_requests,
+            'Emails answered in batches': self.batched_emails,
+            'Emails re-evaluated on their own': self.fallback_emails,
+        }
+
+    def _pack(self, emails: List[Dict[str, Union[str, List[str]]]], indices: List[int]) -> List[List[int]]:
+        groups: List[List[int]] = []
+        group_tokens = 0
+        for index in indices:
+            # Rough prompt size: ~4 characters per token
+            tokens = estimate_tokens(format_email(emails[index], self.client))
+            if not groups or len(groups[-1]) >= self.max_emails or group_tokens + tokens > self.token_budget:
+                groups.append([])
+                group_tokens = 0
+            groups[-1].append(index)
+            group_tokens += tokens
+        return groups
+
+    def _evaluate_alone(self, email_data: Dict[str, Union[str, List[str]]], client: LanguageModelClient) -> Optional[bool]:
+        # The cache was already checked for every email, so go straight to the model
+        messages = build_messages(email_data, self.user_first_name, self.user_last_name, client)
+        return _request_verdict(email_data, messages, client, self.verdict_cache)
+
+    def _evaluate_group(self, emails: List[Dict[str, Union[str, List[str]]]], client: LanguageModelClient) -> Dict[int, bool]:
+        messages = build_batch_messages(emails, self.user_first_name, self.user_last_name, client)
+        try:
+            # About four tokens per "<n>: False" line
+            completion = _complete(client, messages, max_tokens=6 * len(emails) + 4)
+        except Exception as e:
+            print(f"Failed to evaluate email batch: {e}")
+            return {}
+        return parse_batch_verdicts(completion_content(completion), len(emails))
+
+
+def build_messages(email_data: Dict[str, Union[str, List[str]]], user_first_name: str, user_last_name: str, client: Optional[LanguageModelClient] = None) -> Optional[List[Dict[str, str]]]:
+    """
+    Build the system and user chat messages for one email.
+    Returns:
+        Optional[List[Dict[str, str]]]: The chat messages, or None if the email has no body.
+    """
     system_message: Dict[str, str] = {
         "role": "system",
         "content": (
-            "Your task is to assist in managing the Gmail inbox of a busy individual, "
-            f"{user_first_name} {user_last_name}, by filtering out promotional emails "
-            "from their personal (i.e., not work) account. Your primary focus is to ensure "
-            "that emails from individual people, whether they are known family members (with the "
-            f"same last name), close acquaintances, or potential contacts {user_first_name} might be interested "
-            "in hearing from, are not ignored. You need to distinguish between promotional, automated, "
-            "or mass-sent emails and personal communications.\n\n"
-            "Respond with \"True\" if the email is promotional and should be ignored based on "
-            "the below criteria, or \"False\" otherwise. Remember to prioritize personal "
-            "communications and ensure emails from genuine individuals are not filtered out.\n\n"
-            "Criteria for Ignoring an Email:\n"
-            "- The email is promotional: It contains offers, discounts, or is marketing a product "
-            "or service.\n"
-            "- The email is automated: It is sent by a system or service automatically, and not a "
-            "real person.\n"
-            "- The email appears to be mass-sent or from a non-essential mailing list: It does not "
-            f"address {user_first_name} by name, lacks personal context that would indicate it's personally written "
-            "to her, or is from a mailing list that does not pertain to her interests or work.\n\n"
-            "Special Consideration:\n"
-            "- Exception: If the email is from an actual person, especially a family member (with the "
-            f"same last name), a close acquaintance, or a potential contact {user_first_name} might be interested in, "
-            "and contains personalized information indicating a one-to-one communication, do not mark "
-            "it for ignoring regardless of the promotional content.\n\n"
-            "- Additionally, do not ignore emails requiring an action to be taken for important matters, "
-            "such as needing to send a payment via Venmo, but ignore requests for non-essential actions "
-            "like purchasing discounted items or signing up for rewards programs.\n\n"
-            "Be cautious: If there's any doubt about whether an email is promotional or personal, "
-            "respond with \"False\".\n\n"
+            task_description(user_first_name, user_last_name) +
             "The user message you will receive will have the following format:\n"
             "Subject: <email subject>\n"
             "To: <to names, to emails>\n"
@@ -51,35 +248,130 @@ def evaluate_email(email_data: Dict[str, Union[str, List[str]]], user_first_name
         # Check if 'body' key exists in email_data
     if 'body' not in email_data:
         print("Email data is missing the 'body' key.")
-        return False
+        return None
 
-    truncated_body = email_data['body'][:MAX_EMAIL_LEN] + ("..." if len(email_data['body']) > MAX_EMAIL_LEN else "")
     user_message: Dict[str, str] = {
         "role": "user",
+        "content": format_email(email_data, client)
+    }
+
+    return [system_message, user_message]
+
+
+def task_description(user_first_name: str, user_last_name: str) -> str:
+    """The criteria part of the system prompt, shared by single and batched prompts."""
+    return (
+        "Your task is to assist in managing the Gmail inbox of a busy individual, "
+        f"{user_first_name} {user_last_name}, by filtering out promotional emails "
+        "from their personal (i.e., not work) account. Your primary focus is to ensure "
+        "that emails from individual people, whether they are known family members (with the "
+        f"same last name), close acquaintances, or potential contacts {user_first_name} might be interested "
+        "in hearing from, are not ignored. You need to distinguish between promotional, automated, "
+        "or mass-sent emails and personal communications.\n\n"
+        "Respond with \"True\" if the email is promotional and should be ignored based on "
+        "the below criteria, or \"False\" otherwise. Remember to prioritize personal "
+        "communications and ensure emails from genuine individuals are not filtered out.\n\n"
+        "Criteria for Ignoring an Email:\n"
+        "- The email is promotional: It contains offers, discounts, or is marketing a product "
+        "or service.\n"
+        "- The email is automated: It is sent by a system or service automatically, and not a "
+        "real person.\n"
+        "- The email appears to be mass-sent or from a non-essential mailing list: It does not "
+        f"address {user_first_name} by name, lacks personal context that would indicate it's personally written "
+        "to her, or is from a mailing list that does not pertain to her interests or work.\n\n"
+        "Special Consideration:\n"
+        "- Exception: If the email is from an actual person, especially a family member (with the "
+        f"same last name), a close acquaintance, or a potential contact {user_first_name} might be interested in, "
+        "and contains personalized information indicating a one-to-one communication, do not mark "
+        "it for ignoring regardless of the promotional content.\n\n"
+        "- Additionally, do not ignore emails requiring an action to be taken for important matters, "
+        "such as needing to send a payment via Venmo, but ignore requests for non-essential actions "
+        "like purchasing discounted items or signing up for rewards programs.\n\n"
+        "Be cautious: If there's any doubt about whether an email is promotional or personal, "
+        "respond with \"False\".\n\n"
+    )
+
+
+def format_email(email_data: Dict[str, Union[str, List[str]]], client: Optional[LanguageModelClient] = None) -> str:
+    # The body is cut to the client's token budget, counted with its own tokenizer when it has one
+    if isinstance(client, LanguageModelClient):
+        truncated_body = truncate_to_tokens(email_data['body'], client.max_body_tokens, client.count_tokens)
+    else:
+        truncated_body = truncate_to_tokens(email_data['body'], MAX_BODY_TOKENS, estimate_tokens)
+    return (
+        f"Subject: {email_data['subject']}\n"
+        f"To: {email_data['to']}\n"
+        f"From: {email_data['from']}\n"
+        f"Cc: {email_data['cc']}\n"
+        f"Gmail labels: {email_data['labels']}\n"
+        f"Body: {truncated_body}"
+    )
+
+
+def build_batch_messages(emails: List[Dict[str, Union[str, List[str]]]], user_first_name: str, user_last_name: str, client: Optional[LanguageModelClient] = None) -> List[Dict[str, str]]:
+    """Build the chat messages asking for one verdict per email, for emails that all have a body."""
+    system_message: Dict[str, str] = {
+        "role": "system",
         "content": (
-            f"Subject: {email_data['subject']}\n"
-            f"To: {email_data['to']}\n"
-            f"From: {email_data['from']}\n"
-            f"Cc: {email_data['cc']}\n"
-            f"Gmail labels: {email_data['labels']}\n"
-            f"Body: {truncated_body}"
+            task_description(user_first_name, user_last_name) +
+            "The user message you will receive will contain several emails. Each one starts with a line "
+            "\"Email <n>:\" and has the following format:\n"
+            "Subject: <email subject>\n"
+            "To: <to names, to emails>\n"
+            "From: <from name, from email>\n"
+            "Cc: <cc names, cc emails>\n"
+            "Gmail labels: <labels>\n"
+            "Body: <plaintext body of the email>\n\n"
+            "Judge every email on its own. Your response must be one line per email, in order:\n"
+            "<n>: True\n"
+            "or\n"
+            "<n>: False"
         )
     }
+    user_message: Dict[str, str] = {
+        "role": "user",
+        "content": "\n\n".join(f"Email {number}:\n{format_email(email_data, client)}" for number, email_data in enumerate(emails, start=1))
+    }
+    return [system_message, user_message]
+
+
+def parse_verdict(completion) -> bool:
+    return completion_content(completion).replace('\n', '').strip() == "True"
+
+
+def parse_batch_verdicts(content: str, count: int) -> Dict[int, bool]:
+    """
+    Read the per-email verdicts of a batched reply.
+    Returns:
+        Dict[int, bool]: The verdict of every email number (1-based) answered exactly once, or
+        consistently; numbers that are out of range, missing or contradicted are left out.
+    """
+    verdicts: Dict[int, bool] = {}
+    contradicted = set()
+    for match in BATCH_VERDICT_PATTERN.finditer(content):
+        number, verdict = int(match.group(1)), match.group(2).lower() == "true"
+        if not 1 <= number <= count:
+            continue
+        if verdicts.get(number, verdict) != verdict:
+            contradicted.add(number)
+        verdicts[number] = verdict
+    for number in contradicted:
+        del verdicts[number]
+    return verdicts
+
+
+def completion_usage(completion) -> Tuple[int, int]:
+    # Prompt and completion tokens, when the backend reports them
+    usage = completion.get('usage') if isinstance(completion, dict) else getattr(completion, 'usage', None)
+    if not usage:
+        return 0, 0
+    if isinstance(usage, dict):
+        return usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+    return usage.prompt_tokens or 0, usage.completion_tokens or 0
 
-    # Send the messages to GPT-4, TODO add retry logic
-    try:
-        completion = client.create_chat_completion(
-            messages=[system_message, user_message],
-            max_tokens=1
-        )
-    except Exception as e:
-        print(f"Failed to evaluate email: {e}")
-        return False
 
-    # Extract and return the response
-    if isinstance(client, OpenAIClient):
-        return completion.choices[0].message.content.strip() == "True"
-    elif isinstance(client, LlamaClient):
-        return completion['choices'][0]['message']['content'].strip() == "True"
-    elif isinstance(client, HermesClient):
-        return completion['choices'][0]['message']['content'].replace('\n', '').strip() == "True"
+def completion_content(completion) -> str:
+    # OpenAI returns completion objects, llama.cpp and the local classifier return dicts
+    if isinstance(completion, dict):
+        return completion['choices'][0]['message']['content']
+    return completion.choices[0].message.content
@@ -1,34 +1,210 @@
-from typing import Dict, List, Union
-from googleapiclient.discovery import Resource
-from openai import OpenAI
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
+from googleapiclient.errors import HttpError
 
 from colorama import Fore
 from src.email_evaluation import evaluate_email
-import json
+from src.language_model_client import LanguageModelClient
+from src.gmail_service import RETRYABLE_STATUSES
+from src.ledger import Ledger
+from src.metrics import metrics
+import random
+import time
 
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
 
 
-processed_emails_details = []  # Global list to store processed email details
+# batchModify and batchDelete accept at most 1000 message IDs per call
+GMAIL_BULK_ACTION_LIMIT = 1000
+MAX_BULK_ACTION_RETRIES = 3
+# Statuses of a bulk call rejecting the chunk for a bad ID, e.g. a message the user deleted since it was listed
+BAD_ID_STATUSES = (400, 404)
 
 
-def process_email(gmail: Resource, message_info: Dict[str, Union[str, List[str]]], email_data_parsed: Dict[str, Union[str, List[str]]], user_first_name: str, user_last_name: str, client: OpenAI, action: str, processed_emails_file_path: str) -> int:
+class ActionQueue:
+    """
+    Collects message IDs and applies the action to them in bulk through
+    users.messages.batchModify / batchDelete.
+
+    A flush happens when the chunk fills, on close(), and when add() or
+    flush_if_due() finds the oldest queued ID has waited longer than
+    max_wait_seconds; call flush_if_due() regularly, e.g. while no email comes
+    in, for the time limit to hold. on_success, if given, receives
+    the IDs of every chunk that went through. A chunk Gmail rejects for a bad ID
+    is split in halves and sent again, so only the bad ID fails.
+    """
+
+    def __init__(self, gmail: 'Resource', action: str, chunk_size: int = GMAIL_BULK_ACTION_LIMIT, max_wait_seconds: float = 30.0, on_success: Optional[Callable[[List[str]], None]] = None):
+        if action not in ('read', 'delete'):
+            raise ValueError(f"Invalid action: {action}")
+        self.gmail = gmail
+        self.action = action
+        self.chunk_size = max(1, min(chunk_size, GMAIL_BULK_ACTION_LIMIT))
+        self.max_wait_seconds = max_wait_seconds
+        self.on_success = on_success
+        self.pending: List[str] = []
+        self.succeeded: List[str] = []
+        self.failed: List[str] = []
+        self._oldest_pending_at: Optional[float] = None
+
+    def add(self, message_id: str) -> None:
+        if not self.pending:
+            self._oldest_pending_at = time.monotonic()
+        self.pending.append(message_id)
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self) -> None:
+        if self.pending and time.monotonic() - self._oldest_pending_at >= self.max_wait_seconds:
+            self.flush()
+
+    def flush(self) -> Tuple[List[str], List[str]]:
+        """
+        Apply the action to every queued ID.
+        Returns:
+            Tuple[List[str], List[str]]: The IDs that succeeded and the IDs that failed in this flush.
+        """
+        succeeded: List[str] = []
+        failed: List[str] = []
+        chunks = [self.pending[start:start + self.chunk_size] for start in range(0, len(self.pending), self.chunk_size)]
+        self.pending = []
+        while chunks:
+            chunk = chunks.pop(0)
+            error = self._execute(chunk)
+            if error is None:
+                succeeded.extend(chunk)
+                if self.on_success is not None:
+                    self.on_success(chunk)
+            elif len(chunk) > 1 and isinstance(error, HttpError) and error.resp.status in BAD_ID_STATUSES:
+                middle = len(chunk) // 2
+                chunks[:0] = [chunk[:middle], chunk[middle:]]
+            else:
+                failed.extend(chunk)
+        self._oldest_pending_at = None
+
+        self.succeeded.extend(succeeded)
+        self.failed.extend(failed)
+        if succeeded:
+            verb = "deleted" if self.action == 'delete' else "marked as read"
+            print(Fore.LIGHTGREEN_EX + f"{len(succeeded)} emails {verb} successfully" + Fore.RESET)
+        if failed:
+            print(Fore.LIGHTRED_EX + f"Failed to {self.action} {len(failed)} emails: {', '.join(failed)}" + Fore.RESET)
+        return succeeded, failed
+
+    def close(self) -> Tuple[List[str], List[str]]:
+        """
+        Flush whatever is left at shutdown.
+        Returns:
+            Tuple[List[str], List[str]]: Every ID that succeeded and every ID that failed over the queue's lifetime.
+        """
+        self.flush()
+        return self.succeeded, self.failed
+
+    def _execute(self, message_ids: List[str]) -> Optional[Exception]:
+        return _bulk_action_error(self.gmail, self.action, message_ids)
+
+
+def execute_bulk_action(gmail: 'Resource', action: str, message_ids: List[str]) -> bool:
+    """
+    Apply 'read', 'delete' or 'unread' to up to GMAIL_BULK_ACTION_LIMIT messages in one call,
+    retrying rate limits and transient errors. A bulk call either succeeds or fails for the whole chunk.
+    """
+    return _bulk_action_error(gmail, action, message_ids) is None
+
+
+def _bulk_action_error(gmail: 'Resource', action: str, message_ids: List[str]) -> Optional[Exception]:
+    # The error the bulk call finally failed with, None once it went through
+    for attempt in range(MAX_BULK_ACTION_RETRIES + 1):
+        try:
+            with metrics.time('gmail_action'):
+                if action == 'delete':
+                    gmail.users().messages().batchDelete(userId='me', body={'ids': message_ids}).execute()
+                elif action == 'unread':
+                    gmail.users().messages().batchModify(userId='me', body={'ids': message_ids, 'addLabelIds': ['UNREAD']}).execute()
+                else:
+                    gmail.users().messages().batchModify(userId='me', body={'ids': message_ids, 'removeLabelIds': ['UNREAD']}).execute()
+            return None
+        except HttpError as e:
+            error = e
+            if e.resp.status not in RETRYABLE_STATUSES or attempt == MAX_BULK_ACTION_RETRIES:
+                break
+        except Exception as e:
+            error = e
+            break
+        time.sleep(min(2 ** attempt, 32) + random.random())
+    print(Fore.LIGHTRED_EX + f"Bulk {action} failed: {error}" + Fore.RESET)
+    return error
+
+
+def restore_emails(gmail_factory: Callable[[], 'Resource'], ledger: Ledger, message_ids: List[str], workers: int = 4, chunk_size: int = GMAIL_BULK_ACTION_LIMIT) -> Tuple[int, int]:
+    """
+    Mark emails unread again through concurrent batchModify calls, recording every restored
+    chunk in the ledger as soon as it succeeds, so an interrupted restore resumes where it stopped.
+    Adding UNREAD twice is harmless, so re-running a restore is safe.
+    Returns:
+        Tuple[int, int]: How many emails were restored and how many failed.
+    """
+    chunk_size = max(1, min(chunk_size, GMAIL_BULK_ACTION_LIMIT))
+    chunks = [message_ids[start:start + chunk_size] for start in range(0, len(message_ids), chunk_size)]
+    local = threading.local()
+
+    def restore_chunk(chunk: List[str]) -> bool:
+        # The Gmail client's HTTP transport is not thread-safe, so every worker builds its own
+        if not hasattr(local, 'gmail'):
+            local.gmail = gmail_factory()
+        if not execute_bulk_action(local.gmail, 'unread', chunk):
+            return False
+        ledger.mark_restored(chunk)
+        return True
+
+    restored = failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='restore') as executor:
+        futures = {executor.submit(restore_chunk, chunk): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            try:
+                succeeded = future.result()
+            except Exception as e:
+                print(Fore.LIGHTRED_EX + f"Failed to restore {len(futures[future])} emails: {e}" + Fore.RESET)
+                succeeded = False
+            if succeeded:
+                restored += len(futures[future])
+            else:
+                failed += len(futures[future])
+            print(Fore.LIGHTGREEN_EX + f"Restored {restored}/{len(message_ids)} emails" + (f", {failed} failed" if failed else "") + Fore.RESET)
+    return restored, failed
+
+
+def process_email(gmail: 'Resource', message_info: Dict[str, Union[str, List[str]]], email_data_parsed: Dict[str, Union[str, List[str]]], user_first_name: str, user_last_name: str, client: LanguageModelClient, action: str, ledger: Ledger, action_queue: Optional[ActionQueue] = None) -> int:
     # Evaluate email
-    if evaluate_email(email_data_parsed, user_first_name, user_last_name, client):
-        
-        # Prepare email details for tracking
-        email_details = {
-            'id': message_info['id'],
-            'subject': email_data_parsed.get('subject', ''),
-            'from': email_data_parsed.get('from', ''),
-            'email_contents': email_data_parsed['body'],
-            'action': action
-        }
+    is_promotional = evaluate_email(email_data_parsed, user_first_name, user_last_name, client)
+    return apply_verdict(gmail, message_info, email_data_parsed, is_promotional, action, ledger, action_queue)
+
+
+def apply_verdict(gmail: 'Resource', message_info: Dict[str, Union[str, List[str]]], email_data_parsed: Dict[str, Union[str, List[str]]], is_promotional: bool, action: str, ledger: Ledger, action_queue: Optional[ActionQueue] = None) -> int:
+    """
+    Act on an email that has already been classified.
+    Returns:
+        int: 1 if the email was actioned (or queued for a bulk action), 0 otherwise.
+    """
+    if is_promotional:
         
-        if action == 'delete':
+        if action_queue is not None:
+            # Leave the Gmail call to the queue's next bulk flush. The action is recorded first, as pending,
+            # since adding the email may flush the queue and confirm it
+            print(Fore.LIGHTYELLOW_EX + f"Email is not worth the time, queued to {action}" + Fore.RESET)
+            ledger.record_action(message_info['id'], action, email_data_parsed.get('from', ''), email_data_parsed.get('subject', ''), email_data_parsed.get('body', ''), pending=True)
+            action_queue.add(message_info['id'])
+            return 1
+        elif action == 'delete':
             print(Fore.LIGHTYELLOW_EX + "Email is not worth the time, deleting" + Fore.RESET)
             # Delete email
             try:
-                gmail.users().messages().delete(userId='me', id=message_info['id']).execute()
+                with metrics.time('gmail_action'):
+                    gmail.users().messages().delete(userId='me', id=message_info['id']).execute()
                 print(Fore.LIGHTGREEN_EX + "Email deleted successfully" + Fore.RESET)
             except Exception as e:
                 print(Fore.LIGHTRED_EX + f"Failed to delete email: {e}" + Fore.RESET)
@@ -37,22 +213,20 @@ def process_email(gmail: Resource, message_info: Dict[str, Union[str, List[str]]
             print(Fore.LIGHTYELLOW_EX + "Email is not worth the time, marking as read" + Fore.RESET)
             # Remove UNREAD label
             try:
-                gmail.users().messages().modify(userId='me', id=message_info['id'], body={'removeLabelIds': ['UNREAD']}).execute()
+                with metrics.time('gmail_action'):
+                    gmail.users().messages().modify(userId='me', id=message_info['id'], body={'removeLabelIds': ['UNREAD']}).execute()
                 print(Fore.LIGHTGREEN_EX + "Email marked as read successfully" + Fore.RESET)
             except Exception as e:
                 print(Fore.LIGHTRED_EX + f"Failed to mark email as read: {e}" + Fore.RESET)
                 return 0
-        # Append to the global list
-        processed_emails_details.append(email_details)
-        # Write to the file after each action
-        with open(processed_emails_file_path, 'w') as file:
-            json.dump(processed_emails_details, file, indent=4)
+        # Keep the email details for recovery
+        ledger.record_action(message_info['id'], action, email_data_parsed.get('from', ''), email_data_parsed.get('subject', ''), email_data_parsed.get('body', ''))
         return 1
     else:
         print(Fore.LIGHTBLUE_EX + "Email is worth the time, leaving as unread" + Fore.RESET)
     return 0
 
-def report_statistics(total_unread_emails: int, total_pages_fetched: int, total_marked_as_read: int, model_used: str) -> None:
+def report_statistics(total_unread_emails: int, total_pages_fetched: int, total_marked_as_read: int, model_used: str, extra_stats: Optional[Dict[str, object]] = None) -> None:
     print("\n")
     header = "Statistics Report"
     print(f"{Fore.LIGHTCYAN_EX}{header.center(50)}{Fore.RESET}")
@@ -65,6 +239,7 @@ def report_statistics(total_unread_emails: int, total_pages_fetched: int, total_
         'Final number of unread emails': total_unread_emails - total_marked_as_read,
         'Language model used': model_used
     }
+    stats.update(extra_stats or {})
 
     for key, value in stats.items():
         print(f"{Fore.LIGHTYELLOW_EX}{key:<35}{Fore.RESET}{value:<15}")
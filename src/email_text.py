@@ -0,0 +1,201 @@
+import base64
+import re
+from html.parser import HTMLParser
+from typing import Callable, List, Optional, Tuple
+
+# Tags whose text is never shown to the reader
+SKIPPED_TAGS = {'script', 'style', 'head', 'title', 'noscript', 'template'}
+# Tags that end a line of text
+BLOCK_TAGS = {
+    'p', 'div', 'br', 'tr', 'li', 'ul', 'ol', 'table', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'blockquote', 'section', 'article', 'header', 'footer', 'hr', 'center',
+}
+
+URL_PATTERN = re.compile(r'https?://[^\s<>"\')\]]+', re.IGNORECASE)
+# Zero-width and other invisible characters used to pad preview text
+INVISIBLE_CHARACTERS = re.compile('[\u00ad\u034f\u200b-\u200f\u2060\ufeff]')
+QUOTE_HEADER = re.compile(r'^(on .{0,200}wrote:|-{2,}\s*original message\s*-{2,}|-{2,}\s*forwarded message\s*-{2,}|from: .+ sent: .+)$', re.IGNORECASE)
+SIGNATURE_SEPARATOR = re.compile(r'^(--|__+|sent from my \w+.*)$', re.IGNORECASE)
+FOOTER_LINE = re.compile(
+    r'unsubscribe|opt[ -]out|manage (your )?(email )?(preferences|subscriptions?)|view (this email )?in (your |a )?browser|'
+    r'you (are )?receiv(ed|ing) this|all rights reserved|privacy policy|©|\(c\) \d{4}',
+    re.IGNORECASE
+)
+
+
+class HtmlTextExtractor(HTMLParser):
+    """Streams HTML into plain text, keeping line breaks at block elements and dropping hidden content."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._chunks: List[str] = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self._chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in BLOCK_TAGS:
+            self._chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._chunks.append(data)
+
+    def text(self) -> str:
+        return ''.join(self._chunks)
+
+
+def html_to_text(html: str) -> str:
+    extractor = HtmlTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.text()
+
+
+def extract_body(payload: dict) -> str:
+    """
+    Find the best text of a Gmail message payload, walking nested multipart parts.
+    The first non-empty text/plain part wins; HTML is converted to text when there is none.
+    """
+    plain, html = _find_text_parts(payload)
+    if plain:
+        return plain
+    if html:
+        return html_to_text(html)
+    return ''
+
+
+def slim_payload(part: dict) -> Optional[dict]:
+    """
+    Copy of a Gmail message payload keeping only what extract_body reads: the
+    MIME tree without attachments, the part headers giving charset and
+    disposition, and the still-encoded text data.
+    """
+    if _is_attachment(part):
+        return None
+    mime_type = (part.get('mimeType') or '').lower()
+    children = [child for child in (slim_payload(child) for child in part.get('parts', [])) if child is not None]
+    if not children and not mime_type.startswith('text/'):
+        return None
+    slim: dict = {'mimeType': part.get('mimeType')}
+    headers = [header for header in part.get('headers', []) if header['name'].lower() == 'content-type']
+    if headers:
+        slim['headers'] = headers
+    data = part.get('body', {}).get('data')
+    if data:
+        slim['body'] = {'data': data}
+    if children:
+        slim['parts'] = children
+    return slim
+
+
+def clean_body(text: str) -> str:
+    """
+    Reduce an email body to the text that matters for classification: quoted replies,
+    signatures and footer boilerplate are dropped, and URLs are shortened to their domain.
+    """
+    text = INVISIBLE_CHARACTERS.sub('', text)
+    text = URL_PATTERN.sub(_shorten_url, text)
+    lines: List[str] = []
+    had_unsubscribe_footer = False
+    for line in text.splitlines():
+        line = ' '.join(line.split())
+        if line.startswith('>'):
+            continue
+        if QUOTE_HEADER.match(line) or SIGNATURE_SEPARATOR.match(line):
+            break
+        # Footer lines are short; long lines that mention these words are content
+        if len(line) < 200 and FOOTER_LINE.search(line):
+            had_unsubscribe_footer = had_unsubscribe_footer or 'unsubscribe' in line.lower()
+            continue
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    cleaned = '\n'.join(lines).strip()
+    if had_unsubscribe_footer:
+        # Keep the one signal of the footer worth having
+        cleaned += "\n[Unsubscribe link]"
+    return cleaned
+
+
+def estimate_tokens(text: str) -> int:
+    # Rough size for English text: ~4 characters per token
+    return (len(text) + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int, count_tokens: Callable[[str], int] = estimate_tokens) -> str:
+    """Cut text at a word boundary so that it fits in max_tokens tokens, marking the cut with '...'."""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    while tokens > max_tokens and text:
+        # Shrink in proportion to the overshoot, a few tokenizer calls at most
+        cut = int(len(text) * max_tokens / tokens * 0.95)
+        # Drop the word the cut went through; a single word, or only whitespace, is cut as is
+        words = text[:cut].rsplit(None, 1)
+        text = words[0] if len(words) == 2 else text[:cut]
+        tokens = count_tokens(text)
+    return text + "..."
+
+
+def _find_text_parts(part: dict) -> Tuple[Optional[str], Optional[str]]:
+    mime_type = (part.get('mimeType') or '').lower()
+    if _is_attachment(part):
+        return None, None
+    if mime_type.startswith('multipart/'):
+        plain: Optional[str] = None
+        html: Optional[str] = None
+        for child in part.get('parts', []):
+            child_plain, child_html = _find_text_parts(child)
+            plain = plain or child_plain
+            html = html or child_html
+            if plain:
+                break
+        return plain, html
+    if mime_type in ('text/plain', 'text/html'):
+        text = _decode_part(part)
+        if text and text.strip():
+            return (text, None) if mime_type == 'text/plain' else (None, text)
+    # A message/rfc822 or unknown part may still carry text parts
+    for child in part.get('parts', []):
+        child_plain, child_html = _find_text_parts(child)
+        if child_plain or child_html:
+            return child_plain, child_html
+    return None, None
+
+
+def _is_attachment(part: dict) -> bool:
+    if part.get('filename'):
+        return True
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-disposition' and header['value'].lower().startswith('attachment'):
+            return True
+    return False
+
+
+def _decode_part(part: dict) -> str:
+    data = part.get('body', {}).get('data')
+    if not data:
+        return ''
+    raw = base64.urlsafe_b64decode(data.encode('ASCII') + b'=' * (-len(data) % 4))
+    charset = 'utf-8'
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = re.search(r'charset="?([\w.:-]+)"?', header['value'], re.IGNORECASE)
+            if match:
+                charset = match.group(1)
+    try:
+        return raw.decode(charset, errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+
+def _shorten_url(match: re.Match) -> str:
+    # Tracking links are long and carry no meaning for the model, their domain does
+    domain = match.group(0).split('/')[2].split('?')[0].lower()
+    return f"<{domain}>"
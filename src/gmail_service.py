@@ -1,96 +1,426 @@
-import base64
-from typing import Dict, List, Optional, Union, Tuple
-from googleapiclient.discovery import build, Resource
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+import json
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Union, Tuple
+from googleapiclient.errors import HttpError
 import os
-from google.oauth2.credentials import Credentials
+from src.email_message import EmailMessage
+from src.metrics import metrics
+
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+    from src.gmail_transport import GmailConnections, SharedCredentials
 
 
 SCOPES = ['https://mail.google.com/']
 
-def get_user_email(gmail: Resource) -> str:
+# Gmail accepts at most 100 calls in a single batch request
+GMAIL_BATCH_LIMIT = 100
+# Statuses worth retrying inside a batch: rate limiting and transient server errors
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+MAX_BATCH_RETRIES = 5
+# Headers requested with format='metadata', enough for the pre-filter and the prompt's header lines
+METADATA_HEADERS = ['Subject', 'To', 'From', 'Cc', 'List-Unsubscribe', 'Precedence']
+# Partial response of format='full' keeping only what body extraction reads, for up to four levels of nested parts
+_PART_FIELDS = 'mimeType,filename,headers,body/data'
+BODY_FIELDS = f'id,payload({_PART_FIELDS},parts({_PART_FIELDS},parts({_PART_FIELDS},parts({_PART_FIELDS}))))'
+# maxResults of messages.list, the most Gmail allows; its default is 100
+LIST_PAGE_SIZE = 500
+# Labels never worth classifying; messages.list leaves them out already, history.list does not
+SKIPPED_SYSTEM_LABELS = {'SPAM', 'TRASH'}
+
+def get_user_email(gmail: 'Resource') -> str:
     profile = gmail.users().getProfile(userId='me').execute()
     return profile.get('emailAddress', '')
 
-def fetch_emails(gmail: Resource, page_token: Optional[str]) -> Tuple[List[Dict[str, Union[str, List[str]]]], Optional[str]]:
+def fetch_emails(gmail: 'Resource', page_token: Optional[str]) -> Tuple[List[Dict[str, Union[str, List[str]]]], Optional[str]]:
     try:
+        return _list_unread(gmail, page_token)
+    except Exception as e:
+        print(f"Failed to fetch emails: {e}")
+        return [], None
+
+
+def _list_unread(gmail: 'Resource', page_token: Optional[str], query: Optional[str] = None) -> Tuple[List[Dict[str, Union[str, List[str]]]], Optional[str]]:
+    request = {'q': query} if query else {}
+    with metrics.time('gmail_list'):
         results = gmail.users().messages().list(
             userId='me',
             labelIds=['UNREAD'],
-            pageToken=page_token  # Include the page token in the request if there is one
+            maxResults=LIST_PAGE_SIZE,
+            pageToken=page_token,  # Include the page token in the request if there is one
+            **request
         ).execute()
-    except Exception as e:
-        print(f"Failed to fetch emails: {e}")
-        return [], None
 
     messages: List[Dict[str, Union[str, List[str]]]] = results.get('messages', [])
     page_token = results.get('nextPageToken')
     return messages, page_token
 
-def get_gmail_service():
+
+class SearchQuery:
+    """
+    Gmail search expressions narrowing down the unread emails of a full scan, so that
+    emails nobody wants looked at never cost a fetch or a model call.
+
+    The scan is split into one search per category, in the given order, followed by one
+    for the emails in none of them. The emails of the first categories, like promotions,
+    are then classified and acted on first.
+    """
+
+    def __init__(self, max_age_days: int = 0, exclude_labels: Optional[List[str]] = None, categories: Optional[List[str]] = None, extra: str = ''):
+        self.max_age_days = max_age_days
+        self.exclude_labels = exclude_labels or []
+        self.categories = categories or []
+        self.extra = extra
+
+    def base(self) -> str:
+        terms = []
+        if self.max_age_days > 0:
+            terms.append(f"newer_than:{self.max_age_days}d")
+        # Labels with spaces are written with dashes in Gmail searches
+        terms += [f"-label:{label.strip().replace(' ', '-')}" for label in self.exclude_labels if label.strip()]
+        if self.extra:
+            terms.append(self.extra)
+        return ' '.join(terms)
+
+    def segments(self) -> List[Optional[str]]:
+        """The searches of a full scan, in listing order; None lists every unread email."""
+        base = self.base()
+        if not self.categories:
+            return [base or None]
+        searches = [f"{base} category:{category}".strip() for category in self.categories]
+        searches.append(' '.join([base] + [f"-category:{category}" for category in self.categories]).strip())
+        return searches
+
+
+class HistoryExpiredError(Exception):
+    """The stored history ID is too old for users.history.list, a full scan is needed."""
+
+
+def get_history_id(gmail: 'Resource') -> str:
+    profile = gmail.users().getProfile(userId='me').execute()
+    return profile.get('historyId', '')
+
+
+def fetch_history(gmail: 'Resource', start_history_id: str, page_token: Optional[str]) -> Tuple[List[Dict[str, Union[str, List[str]]]], Optional[str]]:
+    """
+    List the unread messages added to the mailbox since start_history_id.
+    Raises:
+        HistoryExpiredError: If Gmail no longer has history that far back.
+    """
+    try:
+        with metrics.time('gmail_history'):
+            results = gmail.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded'],
+                pageToken=page_token
+            ).execute()
+    except HttpError as e:
+        if e.resp.status == 404:
+            raise HistoryExpiredError(f"History ID {start_history_id} has expired") from e
+        raise
+
+    messages: List[Dict[str, Union[str, List[str]]]] = []
+    for record in results.get('history', []):
+        for added in record.get('messagesAdded', []):
+            message = added['message']
+            labels = message.get('labelIds', [])
+            if 'UNREAD' in labels and not SKIPPED_SYSTEM_LABELS.intersection(labels):
+                messages.append({'id': message['id'], 'threadId': message.get('threadId')})
+    return messages, results.get('nextPageToken')
+
+
+class IncrementalLister:
+    """
+    Page source for the pipeline that lists only the unread messages added since
+    the last run's history ID, falling back to a full scan of UNREAD when there
+    is no stored history ID or it has expired. A full scan runs the searches of
+    search_query one after the other; history.list can't search, so new emails
+    are all listed.
+
+    complete tells whether every page was listed without error, i.e. whether the
+    mailbox position taken at the start of the run can be stored for the next one.
+    """
+
+    def __init__(self, start_history_id: Optional[str], search_query: Optional[SearchQuery] = None):
+        self.start_history_id = start_history_id
+        self.full_scan = not start_history_id
+        self.searches = search_query.segments() if search_query else [None]
+        self.complete = True
+
+    def __call__(self, gmail: 'Resource', page_token: Optional[str]) -> Tuple[List[Dict[str, Union[str, List[str]]]], Optional[str]]:
+        try:
+            if not self.full_scan:
+                try:
+                    return fetch_history(gmail, self.start_history_id, page_token)
+                except HistoryExpiredError as e:
+                    print(f"{e}, falling back to a full scan of unread emails")
+                    self.full_scan = True
+                    page_token = None
+            return self._scan(gmail, page_token)
+        except Exception as e:
+            print(f"Failed to fetch emails: {e}")
+            self.complete = False
+            return [], None
+
+
+    def _scan(self, gmail: 'Resource', page_token: Optional[str]) -> Tuple[List[Dict[str, Union[str, List[str]]]], Optional[str]]:
+        # The pipeline's page token is '<search index>:<Gmail page token>'
+        search_index, _, gmail_token = (page_token or '0:').partition(':')
+        search_index = int(search_index)
+        messages, gmail_token = _list_unread(gmail, gmail_token or None, self.searches[search_index])
+        if gmail_token:
+            return messages, f"{search_index}:{gmail_token}"
+        if search_index + 1 < len(self.searches):
+            return messages, f"{search_index + 1}:"
+        return messages, None
+
+
+def load_credentials(token_path: str = 'token.json', interactive: bool = True) -> 'SharedCredentials':
+    # The Google client libraries take a noticeable part of startup, and commands like
+    # benchmark never talk to Gmail
+    from src.gmail_transport import SharedCredentials, save_token
     creds = None
-    # The file token.json stores the user's access and refresh tokens, and is
+    # The token file stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+    if os.path.exists(token_path):
+        creds = SharedCredentials.from_authorized_user_file(token_path, SCOPES)
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
             creds.refresh(Request())
+        elif not interactive:
+            raise Exception(f"No valid credentials in {token_path}, authorize the account with `python run.py authorize --token {token_path}`")
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(
                 'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
+            creds = SharedCredentials.from_authorized_user_info(json.loads(flow.run_local_server(port=0).to_json()), SCOPES)
         # Save the credentials for the next run
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+        save_token(creds, token_path)
+    # Later refreshes are saved by whichever worker makes them
+    creds.token_path = token_path
+    return creds
+
+
+def gmail_connections(token_path: str = 'token.json', interactive: bool = True, timeout: Optional[float] = None) -> 'GmailConnections':
+    """Per-thread Gmail service handles for one account, sharing its credentials. timeout is in seconds per request."""
+    from src.gmail_transport import HTTP_TIMEOUT_SECONDS, GmailConnections
+    return GmailConnections(load_credentials(token_path, interactive), timeout or HTTP_TIMEOUT_SECONDS)
+
 
-    return build('gmail', 'v1', credentials=creds)
+def get_gmail_service(token_path: str = 'token.json', interactive: bool = True) -> 'Resource':
+    return gmail_connections(token_path, interactive)()
 
 
-def parse_email_data(gmail: Resource, message_info: Dict[str, Union[str, List[str]]]) -> Dict[str, Union[str, List[str]]]:
+_discovery_document: Optional[dict] = None
+_discovery_lock = threading.Lock()
+
+
+def gmail_discovery_document() -> dict:
+    """
+    The Gmail API discovery document shipped with googleapiclient, parsed once per process.
+    Workers and daemon accounts each build a service, which would otherwise re-read
+    and re-parse the document every time, and nothing is fetched over the network.
+    """
+    global _discovery_document
+    with _discovery_lock:
+        if _discovery_document is None:
+            from googleapiclient.discovery_cache import get_static_doc
+            _discovery_document = json.loads(get_static_doc('gmail', 'v1'))
+        return _discovery_document
+
+
+def parse_email_data(gmail: 'Resource', message_info: Dict[str, Union[str, List[str]]]) -> Dict[str, Union[str, List[str]]]:
     # Fetch email data with 'full' format
     try:
-        msg = gmail.users().messages().get(
-            userId='me', 
-            id=message_info['id'],
-            format='full'
-        ).execute()
+        with metrics.time('gmail_get'):
+            msg = gmail.users().messages().get(
+                userId='me',
+                id=message_info['id'],
+                format='full'
+            ).execute()
     except Exception as e:
         print(f"Failed to fetch email data: {e}")
         return {}
 
+    with metrics.time('parse'):
+        return _parse_message(msg)
+
+
+class FetchStats:
+    """Messages, response bytes and time spent per kind of messages.get call, shared by the fetcher threads."""
+
+    def __init__(self):
+        self.phases: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, phase: str, messages: int, response_bytes: int, seconds: float) -> None:
+        with self._lock:
+            totals = self.phases.setdefault(phase, [0, 0, 0.0])
+            totals[0] += messages
+            totals[1] += response_bytes
+            totals[2] += seconds
+
+    def stats(self) -> Dict[str, object]:
+        stats: Dict[str, object] = {}
+        total_bytes = 0
+        for phase, (messages, response_bytes, seconds) in self.phases.items():
+            total_bytes += response_bytes
+            # Sizes are only measured on Gmail's own transport, not on fakes
+            stats[f'Fetched {phase}'] = f"{int(messages)} emails" + (f", {response_bytes / 1024:.0f} KB" if response_bytes else "")
+            stats[f'Fetch time per email ({phase})'] = f"{seconds / messages * 1000:.1f} ms" if messages else "n/a"
+        if len(self.phases) > 1 and total_bytes:
+            stats['Fetched in total'] = f"{total_bytes / 1024:.0f} KB"
+        return stats
+
+
+def parse_email_batch(gmail: 'Resource', messages: List[Dict[str, Union[str, List[str]]]], batch_size: int = GMAIL_BATCH_LIMIT, format: str = 'full', stats: Optional[FetchStats] = None) -> Dict[str, Dict[str, Union[str, List[str]]]]:
+    """
+    Fetch and parse a page of messages through Gmail batch requests.
+    Args:
+        gmail: The Gmail API resource.
+        messages: Message stubs as returned by fetch_emails.
+        batch_size: Number of messages sent per batch request, capped at GMAIL_BATCH_LIMIT.
+        format: 'full', or 'metadata' to fetch only METADATA_HEADERS and labels; the parsed emails
+            then have no 'body' key until fetch_email_bodies adds it.
+        stats: Where to record the size and time of the calls, if given.
+    Returns:
+        Dict[str, Dict]: Parsed email data keyed by message ID. Messages that could not be
+        parsed map to an empty dict, like parse_email_data; those that could not be fetched
+        are left out, so they can be tried again.
+    """
+    batch_size = max(1, min(batch_size, GMAIL_BATCH_LIMIT))
+    message_ids = [message_info['id'] for message_info in messages]
+    parsed_emails: Dict[str, Dict[str, Union[str, List[str]]]] = {}
+
+    for start in range(0, len(message_ids), batch_size):
+        raw_messages = _execute_get_batch(gmail, message_ids[start:start + batch_size], format=format, stats=stats)
+        for message_id in message_ids[start:start + batch_size]:
+            msg = raw_messages.get(message_id)
+            if msg is None:
+                continue
+            with metrics.time('parse'):
+                parsed_emails[message_id] = _parse_message(msg, with_body=format != 'metadata') if msg else {}
+
+    return parsed_emails
+
+
+def fetch_email_bodies(gmail: 'Resource', message_ids: List[str], batch_size: int = GMAIL_BATCH_LIMIT, stats: Optional[FetchStats] = None) -> Dict[str, dict]:
+    """
+    Second phase of a metadata-first fetch: download only the text parts of the messages.
+    Returns:
+        Dict[str, dict]: The payload of every message that could be fetched, still encoded;
+        assigned to an EmailMessage's 'body', it is decoded when first read.
+    """
+    batch_size = max(1, min(batch_size, GMAIL_BATCH_LIMIT))
+    payloads: Dict[str, dict] = {}
+    for start in range(0, len(message_ids), batch_size):
+        raw_messages = _execute_get_batch(gmail, message_ids[start:start + batch_size], format='full', fields=BODY_FIELDS, stats=stats, phase='bodies')
+        for message_id, msg in raw_messages.items():
+            payloads[message_id] = msg.get('payload', {})
+    return payloads
+
+
+class _ResponseSizeCounter:
+    """The http object of a batch request, counting the bytes of the responses it receives."""
+
+    def __init__(self, http):
+        self._http = http
+        self.response_bytes = 0
+
+    def request(self, *args, **kwargs):
+        response, content = self._http.request(*args, **kwargs)
+        self.response_bytes += len(content or b'')
+        return response, content
+
+    def __getattr__(self, name):
+        # Credentials and the rest are the wrapped http's
+        return getattr(self._http, name)
+
+
+def _execute_get_batch(gmail: 'Resource', message_ids: List[str], format: str = 'full', fields: Optional[str] = None, stats: Optional[FetchStats] = None, phase: Optional[str] = None) -> Dict[str, dict]:
+    # Send one batch of messages.get calls, re-sending only the items that failed with a retryable status
+    # googleapiclient.http brings in the HTTP stack, which the CLI only loads once it talks to Gmail
+    from googleapiclient.http import HttpRequest
+
+    fetched: Dict[str, dict] = {}
+    pending = list(message_ids)
+    request_args = {'format': format}
+    if format == 'metadata':
+        request_args['metadataHeaders'] = METADATA_HEADERS
+    if fields:
+        request_args['fields'] = fields
+    started = time.perf_counter()
+    response_bytes = 0
+
+    for attempt in range(MAX_BATCH_RETRIES + 1):
+        retry_ids: List[str] = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                fetched[request_id] = response
+            elif isinstance(exception, HttpError) and exception.resp.status in RETRYABLE_STATUSES:
+                retry_ids.append(request_id)
+            else:
+                print(f"Failed to fetch email data for {request_id}: {exception}")
+
+        batch = gmail.new_batch_http_request(callback=callback)
+        for message_id in pending:
+            request = gmail.users().messages().get(userId='me', id=message_id, **request_args)
+            batch.add(request, request_id=message_id)
+
+        try:
+            if stats is not None and isinstance(request, HttpRequest):
+                # Count the bytes of the batch responses on their way in, as received (decompressed)
+                counter = _ResponseSizeCounter(request.http)
+                try:
+                    batch.execute(http=counter)
+                finally:
+                    response_bytes += counter.response_bytes
+            else:
+                batch.execute()
+        except Exception as e:
+            # The whole batch failed, e.g. a 429 on the batch endpoint itself or a network error
+            if isinstance(e, HttpError) and e.resp.status not in RETRYABLE_STATUSES:
+                print(f"Failed to fetch email batch: {e}")
+                break
+            retry_ids = [message_id for message_id in pending if message_id not in fetched]
+
+        if not retry_ids:
+            break
+        pending = retry_ids
+        if attempt < MAX_BATCH_RETRIES:
+            # Exponential backoff with jitter before re-sending the throttled items
+            time.sleep(min(2 ** attempt, 32) + random.random())
+    else:
+        print(f"Giving up on {len(pending)} emails after {MAX_BATCH_RETRIES} retries")
+
+    metrics.observe(f'gmail_batch_{phase or format}', time.perf_counter() - started)
+    if stats is not None:
+        stats.record(phase or format, len(message_ids), response_bytes, time.perf_counter() - started)
+    return fetched
+
+
+def _parse_message(msg: dict, with_body: bool = True) -> Union[EmailMessage, Dict]:
     try:
         headers = msg['payload']['headers']
         subject = next(header['value'] for header in headers if header['name'] == 'Subject')
         to = next(header['value'] for header in headers if header['name'] == 'To')
         sender = next(header['value'] for header in headers if header['name'] == 'From')
         cc = next((header['value'] for header in headers if header['name'] == 'Cc'), None)
+        # Bulk mail headers, used by the pre-filter
+        list_unsubscribe = next((header['value'] for header in headers if header['name'].lower() == 'list-unsubscribe'), None)
+        precedence = next((header['value'] for header in headers if header['name'].lower() == 'precedence'), None)
     except Exception as e:
         print(f"Failed to parse email data: {e}")
         return {}
 
     print(f"Fetched email - Subject: {subject}, Sender: {sender}")
 
-    # Extract the plain text body
-    parts = msg['payload'].get('parts', [])
-    for part in parts:
-        if part['mimeType'] == 'text/plain':
-            body = part['body'].get('data', '')
-            body = base64.urlsafe_b64decode(body.encode('ASCII')).decode('utf-8')
-            break
-    else:
-        body = ''
-
-    # Parse email data
-    email_data_parsed: Dict[str, Union[str, List[str]]] = {
-        'subject': subject,
-        'to': to,
-        'from': sender,
-        'cc': cc,
-        'labels': msg['labelIds'],
-        'body': body,
-    }
-    return email_data_parsed
\ No newline at end of file
+    # The body stays encoded until something reads it
+    return EmailMessage(subject, to, sender, cc, msg['labelIds'], list_unsubscribe, precedence, payload=msg['payload'] if with_body else None)
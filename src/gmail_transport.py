@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Optional
+
+import google_auth_httplib2
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import build_http
+
+from src.gmail_service import gmail_discovery_document
+from src.metrics import metrics
+
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+
+# Seconds a Gmail request may wait on the network before it fails, and is retried by the callers that retry
+HTTP_TIMEOUT_SECONDS = 60.0
+# A token refreshed this recently is kept when another worker asks for a refresh, e.g. after a 401 on the old token
+MIN_REFRESH_INTERVAL_SECONDS = 30.0
+
+
+def save_token(credentials: Credentials, token_path: str) -> None:
+    # Write to a temporary file first, so a crash mid-write never leaves a truncated token behind
+    temporary_path = f"{token_path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w') as token:
+        token.write(credentials.to_json())
+    os.replace(temporary_path, token_path)
+
+
+class SharedCredentials(Credentials):
+    """
+    OAuth credentials shared by every Gmail connection of an account.
+
+    Workers find the access token expired at about the same time. The first
+    one refreshes it and saves it to token_path; the others wait for it and
+    use the new token, instead of each refreshing and rewriting the file.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_path: Optional[str] = None
+        self.refreshes = 0
+        self._refresh_lock = threading.Lock()
+        self._refreshed_at: Optional[float] = None
+
+    def refresh(self, request) -> None:
+        with self._refresh_lock:
+            if self.valid and self._refreshed_at is not None and time.monotonic() - self._refreshed_at < MIN_REFRESH_INTERVAL_SECONDS:
+                return
+            with metrics.time('token_refresh'):
+                super().refresh(request)
+            self._refreshed_at = time.monotonic()
+            self.refreshes += 1
+            if self.token_path:
+                save_token(self, self.token_path)
+
+
+def authorized_http(credentials: Credentials, timeout: float = HTTP_TIMEOUT_SECONDS) -> google_auth_httplib2.AuthorizedHttp:
+    http = build_http()
+    http.timeout = timeout
+    return google_auth_httplib2.AuthorizedHttp(credentials, http=http)
+
+
+class GmailConnections:
+    """
+    Gmail service handles for the threads working on one account.
+
+    googleapiclient services and httplib2 connections are not thread-safe, so
+    each thread gets its own, built once from the shared discovery document.
+    httplib2 keeps the connection to Gmail open between the requests of a
+    thread, so a worker pays for the TLS handshake once rather than once per
+    request. Every handle authorizes with the same SharedCredentials.
+
+    Calling the object returns the calling thread's handle, so it serves as
+    the gmail_factory of EmailPipeline and restore_emails.
+    """
+
+    def __init__(self, credentials: SharedCredentials, timeout: float = HTTP_TIMEOUT_SECONDS):
+        self.credentials = credentials
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __call__(self) -> 'Resource':
+        gmail = getattr(self._local, 'gmail', None)
+        if gmail is None:
+            gmail = build_from_document(gmail_discovery_document(), http=authorized_http(self.credentials, self.timeout))
+            self._local.gmail = gmail
+        return gmail
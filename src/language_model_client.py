@@ -1,20 +1,57 @@
-from llama_cpp import Llama
+import asyncio
+import hashlib
+import multiprocessing
 import os
-from openai import OpenAI
+import pickle
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Union
+from src.email_text import estimate_tokens
+from src.local_classifier import LinearEmailClassifier, local_completion, parse_prompt_email
+from src.metrics import metrics
+
+# The backends are imported by the clients that use them: llama_cpp loads native libraries and
+# openai builds hundreds of models at import, which a run using the other backend never needs
+
+# Room left in a llama.cpp context for the system prompt, the email headers and the answer
+PROMPT_OVERHEAD_TOKENS = 1024
 
 class LanguageModelClient:
+    # Upper bound on concurrent create_chat_completion calls; None means no limit
+    max_concurrency = None
+    # Tokens of an email body sent in a prompt, the rest is cut off
+    max_body_tokens = 750
+    # Size of the model's context window in tokens; None when any prompt fits
+    context_tokens: Optional[int] = None
+
     def __init__(self, model_name: str):
         self.model_name = model_name
 
+    def count_tokens(self, text: str) -> int:
+        return estimate_tokens(text)
+
     def create_chat_completion(self, messages: list, max_tokens: int):
         raise NotImplementedError
+
+    def stats(self) -> Dict[str, object]:
+        return {}
+
+    def close(self) -> None:
+        pass
     
 
 class OpenAIClient(LanguageModelClient):
     def __init__(self, api_key: str):
         super().__init__(model_name="gpt-4-1106-preview")
+        from openai import OpenAI
         self.client = OpenAI(api_key=api_key)
 
+    def count_tokens(self, text: str) -> int:
+        return count_openai_tokens(text)
+
     def create_chat_completion(self, messages: list, max_tokens: int):
         return self.client.chat.completions.create(
             model="gpt-4-1106-preview",
@@ -23,45 +60,457 @@ class OpenAIClient(LanguageModelClient):
             temperature=0.0,
         )
     
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute budget shared by every call of a client.
+
+    Both budgets refill continuously. penalize() pauses all callers for the
+    Retry-After period of a 429 and lowers the request rate, which then climbs
+    back to the configured budget as calls succeed.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.max_requests_per_minute = requests_per_minute
+        self.requests_per_minute = float(requests_per_minute)
+        self.tokens_per_minute = tokens_per_minute
+        self._request_allowance = float(requests_per_minute)
+        self._token_allowance = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int) -> None:
+        # Requests larger than the whole minute budget would wait forever
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0 and self._request_allowance >= 1 and self._token_allowance >= tokens:
+                    self._request_allowance -= 1
+                    self._token_allowance -= tokens
+                    return
+                if wait <= 0:
+                    missing_requests = max(0.0, 1 - self._request_allowance) / self.requests_per_minute
+                    missing_tokens = max(0.0, tokens - self._token_allowance) / self.tokens_per_minute
+                    wait = 60 * max(missing_requests, missing_tokens)
+                await asyncio.sleep(wait)
+
+    def penalize(self, retry_after: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self.requests_per_minute = max(1.0, self.requests_per_minute * 0.8)
+
+    def reward(self) -> None:
+        self.requests_per_minute = min(self.max_requests_per_minute, self.requests_per_minute + 1)
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_allowance = min(self.requests_per_minute, self._request_allowance + elapsed * self.requests_per_minute / 60)
+        self._token_allowance = min(self.tokens_per_minute, self._token_allowance + elapsed * self.tokens_per_minute / 60)
+
+
+class AsyncOpenAIClient(LanguageModelClient):
+    """
+    OpenAI client built on AsyncOpenAI that keeps many completions in flight.
+
+    Calls run on a private event loop thread, bounded by a semaphore and a
+    RateLimiter, with 429s retried after Retry-After and transient errors
+    retried with jittered exponential backoff. create_chat_completion blocks
+    and can be shared by many threads; acreate_chat_completion can be awaited
+    from any event loop.
+    """
+    TRANSIENT_STATUSES = {408, 409, 500, 502, 503, 504}
+
+    def __init__(self, api_key: str, max_concurrency: int = 16, requests_per_minute: int = 500, tokens_per_minute: int = 300000, max_retries: int = 6):
+        super().__init__(model_name="gpt-4-1106-preview")
+        self.api_key = api_key
+        self.concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_lock = threading.Lock()
+
+    def count_tokens(self, text: str) -> int:
+        return count_openai_tokens(text)
+
+    def create_chat_completion(self, messages: list, max_tokens: int):
+        return asyncio.run_coroutine_threadsafe(self._create(messages, max_tokens), self._get_loop()).result()
+
+    async def acreate_chat_completion(self, messages: list, max_tokens: int):
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._create(messages, max_tokens), self._get_loop()))
+
+    def close(self) -> None:
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self.client.close(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="openai-client-loop", daemon=True).start()
+                asyncio.run_coroutine_threadsafe(self._setup(), loop).result()
+                self._loop = loop
+            return self._loop
+
+    async def _setup(self) -> None:
+        from openai import AsyncOpenAI
+        # asyncio primitives and the httpx client belong to the loop they are created on
+        self.client = AsyncOpenAI(api_key=self.api_key, max_retries=0)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self.rate_limiter = RateLimiter(self.requests_per_minute, self.tokens_per_minute)
+
+    async def _create(self, messages: list, max_tokens: int):
+        from openai import APIConnectionError, APIStatusError, RateLimitError
+        # Rough prompt size: ~4 characters per token, plus the completion budget
+        estimated_tokens = sum(len(message['content']) for message in messages) // 4 + max_tokens
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire(estimated_tokens)
+            try:
+                async with self._semaphore:
+                    completion = await self.client.chat.completions.create(
+                        model="gpt-4-1106-preview",
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=0.0,
+                    )
+                self.rate_limiter.reward()
+                return completion
+            except RateLimitError as e:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = _retry_after_seconds(e) or self._backoff(attempt)
+                self.rate_limiter.penalize(retry_after)
+            except APIStatusError as e:
+                if e.status_code not in self.TRANSIENT_STATUSES or attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+            except APIConnectionError:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        # Full jitter keeps concurrent retries from hitting the API in lockstep
+        return random.uniform(0, min(60, 2 ** attempt))
+
+
+def count_openai_tokens(text: str) -> int:
+    # tiktoken is optional, without it the size is estimated
+    try:
+        import tiktoken
+    except ImportError:
+        return estimate_tokens(text)
+    return len(tiktoken.encoding_for_model("gpt-4").encode(text))
+
+
+def _retry_after_seconds(error: 'APIStatusError') -> Optional[float]:
+    headers = error.response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+class PromptPrefixCache:
+    """
+    Reuses the llama.cpp KV state of the system prompt across emails.
+
+    The prefix is the part of the rendered chat prompt that comes before the
+    user message, found by comparing the tokens of two probe prompts, so it
+    works for any chat format. Its state is evaluated once and saved under a
+    key of the model file, chat format and system prompt; a new prompt or user
+    name gives a new key, so a stale state is never restored. llama.cpp then
+    only evaluates the email part of every prompt.
+    """
+
+    def __init__(self, directory: str, model_path: str, chat_format: str):
+        self.directory = directory
+        self.model_path = model_path
+        self.chat_format = chat_format
+        self.key: Optional[str] = None
+        self.prefix_length = 0
+        self.completions = 0
+        self.completion_seconds = 0.0
+
+    def prepare(self, llama: 'Llama', system_prompt: str) -> None:
+        """Make sure the KV cache of the llama context starts with the system prompt's prefix."""
+        key = hashlib.sha256('\x1f'.join([os.path.abspath(self.model_path), self.chat_format, system_prompt]).encode('utf-8')).hexdigest()[:16]
+        if key == self.key:
+            return
+        path = os.path.join(self.directory, f"{os.path.basename(self.model_path)}.{key}.state")
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as state_file:
+                    state = pickle.load(state_file)
+                llama.load_state(state)
+                self.prefix_length = state.n_tokens
+                self.key = key
+                print(f"Restored {self.prefix_length} prompt prefix tokens from {path}")
+                return
+            except Exception as e:
+                print(f"Failed to restore the prompt prefix state, evaluating it again: {e}")
+
+        started = time.perf_counter()
+        self.prefix_length = self._evaluate_prefix(llama, system_prompt)
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file first, so an interrupted save never leaves a truncated state behind
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'wb') as state_file:
+            pickle.dump(llama.save_state(), state_file)
+        os.replace(temporary_path, path)
+        self.key = key
+        print(f"Evaluated {self.prefix_length} prompt prefix tokens in {time.perf_counter() - started:.2f}s, saved to {path}")
+
+    def record(self, response: dict, seconds: float) -> None:
+        self.completions += 1
+        self.completion_seconds += seconds
+        prompt_tokens = response.get('usage', {}).get('prompt_tokens', 0)
+        print(f"Completion in {seconds:.2f}s ({prompt_tokens} prompt tokens, {self.prefix_length} reused from the prefix cache)")
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            'Prompt prefix tokens reused': self.prefix_length,
+            'Average completion time': f"{self.completion_seconds / self.completions:.2f}s" if self.completions else "n/a",
+        }
+
+    def _evaluate_prefix(self, llama: 'Llama', system_prompt: str) -> int:
+        token_runs = []
+        for probe in ("A", "B"):
+            llama.create_chat_completion(
+                messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": probe}],
+                max_tokens=1,
+                temperature=0.0,
+            )
+            token_runs.append(list(llama.input_ids[:llama.n_tokens]))
+        prefix = os.path.commonprefix(token_runs)
+        llama.reset()
+        llama.eval(prefix)
+        return len(prefix)
+
+
 class HermesClient(LanguageModelClient):
-    def __init__(self, model_path: str, n_ctx: int, n_batch: int, chat_format: str, verbose: bool):
+    # A llama.cpp context can only serve one completion at a time
+    max_concurrency = 1
+
+    def __init__(self, model_path: str, n_ctx: int, n_batch: int, chat_format: str, verbose: bool, prefix_cache_dir: str = os.path.join("cache", "prompt_prefix"), n_threads: Optional[int] = None):
         super().__init__(model_name="openhermes-2.5-mistral-7b")
         hermes_params = {
             "model_path": model_path,
             "n_ctx": n_ctx,
             "n_batch": n_batch,
             "chat_format": chat_format,
-            "verbose": verbose
+            "verbose": verbose,
+            # Map the weights instead of reading them, so processes loading the same file share its pages
+            "use_mmap": True
         }
+        if n_threads:
+            hermes_params["n_threads"] = n_threads
         
         operating_system = os.getenv("OPERATING_SYSTEM")
         if operating_system == "Windows":
             hermes_params["n_gpu_layers"] = 50
 
+        from llama_cpp import Llama
         self.client = Llama(**hermes_params)
+        self.prefix_cache = PromptPrefixCache(prefix_cache_dir, model_path, chat_format)
+        self.context_tokens = n_ctx
+        # Long emails must still fit in the context next to the system prompt
+        self.max_body_tokens = min(self.max_body_tokens, n_ctx - PROMPT_OVERHEAD_TOKENS)
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.client.tokenize(text.encode('utf-8'), add_bos=False))
 
     def create_chat_completion(self, messages: list, max_tokens: int):
-        response = self.client.create_chat_completion(messages=messages, max_tokens=3, temperature=0.0)
+        self.prefix_cache.prepare(self.client, messages[0]["content"])
+        started = time.perf_counter()
+        # A single verdict word can take up to three tokens; batched verdicts ask for more
+        response = self.client.create_chat_completion(messages=messages, max_tokens=max(max_tokens, 3), temperature=0.0)
+        self.prefix_cache.record(response, time.perf_counter() - started)
         return response
+
+    def stats(self) -> Dict[str, object]:
+        return self.prefix_cache.stats()
     
 class LlamaClient(LanguageModelClient):
-    def __init__(self, model_path: str, n_ctx: int, n_batch: int, chat_format: str, verbose: bool):
+    # A llama.cpp context can only serve one completion at a time
+    max_concurrency = 1
+
+    def __init__(self, model_path: str, n_ctx: int, n_batch: int, chat_format: str, verbose: bool, prefix_cache_dir: str = os.path.join("cache", "prompt_prefix"), n_threads: Optional[int] = None):
         super().__init__(model_name="llama-2-7B")
         llama_params = {
             "model_path": model_path,
             "n_ctx": n_ctx,
             "n_batch": n_batch,
             "chat_format": chat_format,
-            "verbose": verbose
+            "verbose": verbose,
+            # Map the weights instead of reading them, so processes loading the same file share its pages
+            "use_mmap": True
         }
+        if n_threads:
+            llama_params["n_threads"] = n_threads
         
         operating_system = os.getenv("OPERATING_SYSTEM")
         if operating_system == "Windows":
             llama_params["n_gpu_layers"] = 50
 
+        from llama_cpp import Llama
         self.client = Llama(**llama_params)
+        self.prefix_cache = PromptPrefixCache(prefix_cache_dir, model_path, chat_format)
+        self.context_tokens = n_ctx
+        # Long emails must still fit in the context next to the system prompt
+        self.max_body_tokens = min(self.max_body_tokens, n_ctx - PROMPT_OVERHEAD_TOKENS)
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.client.tokenize(text.encode('utf-8'), add_bos=False))
 
     def create_chat_completion(self, messages: list, max_tokens: int):
-        response = self.client.create_chat_completion(messages=messages, temperature=0.0, max_tokens=2)
+        self.prefix_cache.prepare(self.client, messages[0]["content"])
+        started = time.perf_counter()
+        # A single verdict word can take up to two tokens; batched verdicts ask for more
+        response = self.client.create_chat_completion(messages=messages, temperature=0.0, max_tokens=max(max_tokens, 2))
+        self.prefix_cache.record(response, time.perf_counter() - started)
         
-        return response
\ No newline at end of file
+        return response
+
+    def stats(self) -> Dict[str, object]:
+        return self.prefix_cache.stats()
+
+
+# The client of a LlamaProcessPool worker process, created once when the worker starts
+_pool_worker_client: Optional[LanguageModelClient] = None
+
+
+def _start_pool_worker(client_class: type, client_kwargs: dict) -> None:
+    global _pool_worker_client
+    _pool_worker_client = client_class(**client_kwargs)
+
+
+def _pool_worker_completion(messages: list, max_tokens: int):
+    return _pool_worker_client.create_chat_completion(messages=messages, max_tokens=max_tokens)
+
+
+class LlamaProcessPool(LanguageModelClient):
+    """
+    Runs a llama.cpp client in each of several worker processes.
+
+    Every worker loads the same GGUF file through mmap, so the weights are held
+    once in the page cache, and gets an equal share of the CPU cores as
+    llama.cpp threads. Each call waits on its own future, so a verdict always
+    goes back to the email it was asked for, whichever worker finishes first.
+    When a worker dies, the pool is replaced and the call is retried.
+    """
+
+    def __init__(self, client_class: type, model_name: str, workers: int, client_kwargs: dict, max_restarts: int = 3):
+        super().__init__(model_name=model_name)
+        self.workers = max(1, workers)
+        self.max_concurrency = self.workers
+        self.client_class = client_class
+        self.client_kwargs = {**client_kwargs, 'n_threads': max(1, (os.cpu_count() or 1) // self.workers)}
+        if 'n_ctx' in client_kwargs:
+            self.context_tokens = client_kwargs['n_ctx']
+            self.max_body_tokens = min(self.max_body_tokens, client_kwargs['n_ctx'] - PROMPT_OVERHEAD_TOKENS)
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._executor = self._start()
+
+    def create_chat_completion(self, messages: list, max_tokens: int):
+        for attempt in range(self.max_restarts + 1):
+            executor = self._executor
+            try:
+                return executor.submit(_pool_worker_completion, messages, max_tokens).result()
+            except BrokenProcessPool:
+                if attempt == self.max_restarts:
+                    raise
+                self._restart(executor)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            'Model worker processes': self.workers,
+            'Model worker restarts': self.restarts,
+        }
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    def _start(self) -> ProcessPoolExecutor:
+        # Spawned rather than forked, since the parent runs the pipeline's threads
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_start_pool_worker,
+            initargs=(self.client_class, self.client_kwargs),
+        )
+
+    def _restart(self, broken: ProcessPoolExecutor) -> None:
+        with self._lock:
+            # Every call in flight on the broken pool ends up here, only the first one replaces it
+            if self._executor is broken:
+                print(f"A {self.model_name} worker process died, restarting the pool")
+                broken.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._start()
+                self.restarts += 1
+
+
+class LocalClassifierClient(LanguageModelClient):
+    """
+    Answers from a LinearEmailClassifier trained on past verdicts and hands the
+    emails it is unsure about to the configured language model.
+
+    classify_emails() scores a whole page in one vectorized call;
+    create_chat_completion() keeps the client usable from evaluate_email.
+    """
+
+    def __init__(self, classifier: LinearEmailClassifier, fallback: LanguageModelClient):
+        # Uses the fallback's name so verdict cache lookups still find the model's verdicts
+        super().__init__(model_name=fallback.model_name)
+        self.classifier = classifier
+        self.fallback = fallback
+        self.max_concurrency = fallback.max_concurrency
+        self.max_body_tokens = fallback.max_body_tokens
+        self.context_tokens = fallback.context_tokens
+        self.local_answers = 0
+        self.fallback_calls = 0
+        self._lock = threading.Lock()
+
+    def classify_emails(self, emails: List[Dict[str, Union[str, List[str]]]]) -> List[Optional[bool]]:
+        with metrics.time('local_classifier'):
+            predictions = self.classifier.predict(emails)
+        # Emails whose body failed to fetch are left to the per-email path
+        predictions = [prediction if 'body' in email_data else None for prediction, email_data in zip(predictions, emails)]
+        with self._lock:
+            self.local_answers += sum(prediction is not None for prediction in predictions)
+        return predictions
+
+    def count_tokens(self, text: str) -> int:
+        return self.fallback.count_tokens(text)
+
+    def create_chat_completion(self, messages: list, max_tokens: int):
+        prediction = self.classifier.predict([parse_prompt_email(messages[-1]['content'])])[0]
+        if prediction is None:
+            with self._lock:
+                self.fallback_calls += 1
+            return self.fallback.create_chat_completion(messages=messages, max_tokens=max_tokens)
+        with self._lock:
+            self.local_answers += 1
+        return local_completion(prediction)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            'Local classifier answers': self.local_answers,
+            'Sent to ' + self.fallback.model_name: self.fallback_calls,
+            **self.fallback.stats(),
+        }
+
+    def close(self) -> None:
+        self.fallback.close()
@@ -0,0 +1,356 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Iterator, List, Optional, Union
+
+from src.metrics import metrics
+from src.recovery_log import RecoveryLogReader, RecoveryLogWriter
+
+# Checkpoint the write-ahead log into the main database after this many appends
+COMPACTION_INTERVAL = 5000
+# Rows fetched at a time when streaming actions back
+ACTION_FETCH_SIZE = 500
+# States of an email between being listed and being processed; processed emails leave the inflight table
+LISTED = 'listed'
+FETCHED = 'fetched'
+CLASSIFIED = 'classified'
+
+
+class Ledger:
+    """
+    Per-account record of processed emails and the actions taken on them.
+
+    Backed by SQLite in WAL mode: every record is a single-row insert, so a
+    run's I/O grows linearly with the number of emails, and a crash loses at
+    most the record being written. Processed IDs are also held in memory for
+    the skip check. The bodies of actioned emails go to a compressed recovery
+    log next to the database (recovery_dir), and the actions table only keeps
+    where each one is, so neither the database nor the process grows with them.
+
+    Emails on their way through a run are tracked in the inflight table, as
+    listed, fetched, then classified with their verdict. An email counts as
+    processed only once kept, or once its action has gone through, so an
+    interrupted run leaves behind exactly the emails to pick up again.
+    Likewise, an action queued for a bulk call is recorded as pending and only
+    counts as taken once confirm_actions() reports the call went through.
+    """
+
+    def __init__(self, path: str, run_id: Optional[str] = None, recovery_dir: Optional[str] = None):
+        self.path = path
+        self.run_id = run_id or time.strftime('%Y%m%d-%H%M%S')
+        self.recovery_dir = recovery_dir or os.path.splitext(path)[0] + '_recovery'
+        self._recovery_log = RecoveryLogWriter(self.recovery_dir)
+        self._lock = threading.Lock()
+        self._appends = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS processed ("
+            " id TEXT PRIMARY KEY,"
+            " verdict INTEGER,"
+            " processed_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS actions ("
+            " id TEXT NOT NULL,"
+            " run_id TEXT NOT NULL,"
+            " action TEXT NOT NULL,"
+            " sender TEXT,"
+            " subject TEXT,"
+            " body BLOB,"
+            " actioned_at REAL NOT NULL,"
+            " log_file TEXT,"
+            " log_offset INTEGER,"
+            " restored_at REAL,"
+            " pending INTEGER NOT NULL DEFAULT 0);"
+            "CREATE INDEX IF NOT EXISTS actions_id ON actions (id);"
+            "CREATE INDEX IF NOT EXISTS actions_actioned_at ON actions (actioned_at);"
+            "CREATE INDEX IF NOT EXISTS actions_run_id ON actions (run_id);"
+            "CREATE TABLE IF NOT EXISTS state ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT);"
+            "CREATE TABLE IF NOT EXISTS inflight ("
+            " id TEXT PRIMARY KEY,"
+            " state TEXT NOT NULL,"
+            " verdict INTEGER,"
+            " updated_at REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0);"
+        )
+        # Ledgers from before the recovery log kept bodies in the table, which stay readable
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(actions)")}
+        for column, column_type in (('log_file', 'TEXT'), ('log_offset', 'INTEGER'), ('restored_at', 'REAL'), ('pending', 'INTEGER NOT NULL DEFAULT 0')):
+            if column not in columns:
+                self._connection.execute(f"ALTER TABLE actions ADD COLUMN {column} {column_type}")
+        if 'attempts' not in {row[1] for row in self._connection.execute("PRAGMA table_info(inflight)")}:
+            self._connection.execute("ALTER TABLE inflight ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        self._connection.commit()
+        self._processed_ids = {row[0] for row in self._connection.execute("SELECT id FROM processed")}
+        self._inflight_ids = {row[0] for row in self._connection.execute("SELECT id FROM inflight")}
+
+    def __contains__(self, email_id: str) -> bool:
+        return email_id in self._processed_ids
+
+    def __len__(self) -> int:
+        return len(self._processed_ids)
+
+    def is_in_flight(self, email_id: str) -> bool:
+        return email_id in self._inflight_ids
+
+    def mark_listed(self, email_ids: List[str]) -> List[str]:
+        """
+        Start tracking listed emails.
+        Returns:
+            List[str]: The IDs that were neither processed nor in flight already.
+        """
+        with self._lock, metrics.time('ledger_write'):
+            new_ids = [email_id for email_id in dict.fromkeys(email_ids) if email_id not in self._processed_ids and email_id not in self._inflight_ids]
+            now = time.time()
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO inflight (id, state, updated_at) VALUES (?, ?, ?)",
+                ((email_id, LISTED, now) for email_id in new_ids)
+            )
+            self._commit()
+            self._inflight_ids.update(new_ids)
+        return new_ids
+
+    def mark_fetched(self, email_ids: List[str]) -> None:
+        with self._lock, metrics.time('ledger_write'):
+            now = time.time()
+            self._connection.executemany(
+                # A download that went through starts the count of failed downloads over
+                "UPDATE inflight SET state = ?, updated_at = ?, attempts = 0 WHERE id = ? AND state = ?",
+                ((FETCHED, now, email_id, LISTED) for email_id in email_ids)
+            )
+            self._commit()
+
+    def mark_classified(self, email_id: str, verdict: bool) -> None:
+        with self._lock, metrics.time('ledger_write'):
+            self._connection.execute(
+                "INSERT OR REPLACE INTO inflight (id, state, verdict, updated_at) VALUES (?, ?, ?, ?)",
+                (email_id, CLASSIFIED, int(verdict), time.time())
+            )
+            self._commit()
+            self._inflight_ids.add(email_id)
+
+    def mark_retried(self, email_ids: List[str]) -> None:
+        """
+        Count another attempt at emails an earlier run left unfinished. Emails yet to be
+        classified are downloaded again, so they go back to listed until that went through.
+        """
+        with self._lock, metrics.time('ledger_write'):
+            self._connection.executemany(
+                "UPDATE inflight SET attempts = attempts + 1, state = CASE WHEN state = ? THEN state ELSE ? END WHERE id = ?",
+                ((CLASSIFIED, LISTED, email_id) for email_id in email_ids)
+            )
+            self._commit()
+
+    def in_flight(self, state: Optional[str] = None, min_attempts: int = 0) -> List[str]:
+        """IDs of the emails an earlier run left unfinished, optionally only those in one state or retried min_attempts times."""
+        query = "SELECT id FROM inflight WHERE attempts >= ?" + (" AND state = ?" if state else "") + " ORDER BY updated_at, rowid"
+        with self._lock:
+            return [row[0] for row in self._connection.execute(query, (min_attempts, state) if state else (min_attempts,))]
+
+    def mark_processed(self, email_id: str, verdict: Optional[bool]) -> None:
+        self.mark_processed_many([email_id], verdict)
+
+    def mark_processed_many(self, email_ids: List[str], verdict: Optional[bool]) -> None:
+        with self._lock, metrics.time('ledger_write'):
+            now = time.time()
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO processed (id, verdict, processed_at) VALUES (?, ?, ?)",
+                ((email_id, None if verdict is None else int(verdict), now) for email_id in email_ids)
+            )
+            self._connection.executemany("DELETE FROM inflight WHERE id = ?", ((email_id,) for email_id in email_ids))
+            self._commit()
+            self._processed_ids.update(email_ids)
+            self._inflight_ids.difference_update(email_ids)
+
+    def record_action(self, email_id: str, action: str, sender: Optional[str], subject: Optional[str], body: Optional[str], run_id: Optional[str] = None, pending: bool = False) -> None:
+        """Keep the details of an actioned email; pending ones wait in a bulk action queue until confirm_actions()."""
+        with metrics.time('ledger_write'):
+            self._record_action(email_id, run_id or self.run_id, action, sender, subject, body, time.time(), pending)
+            with self._lock:
+                self._commit()
+
+    def confirm_actions(self, email_ids: List[str]) -> None:
+        """Record that the pending actions on these emails went through."""
+        with self._lock, metrics.time('ledger_write'):
+            # Stay under SQLite's limit on query parameters
+            for start in range(0, len(email_ids), ACTION_FETCH_SIZE):
+                chunk = email_ids[start:start + ACTION_FETCH_SIZE]
+                self._connection.execute(f"UPDATE actions SET pending = 0 WHERE pending = 1 AND id IN ({', '.join('?' * len(chunk))})", chunk)
+            self._commit()
+
+    def _record_action(self, email_id: str, run_id: str, action: str, sender: Optional[str], subject: Optional[str], body: Optional[str], actioned_at: float, pending: bool = False) -> None:
+        log_file, log_offset = self._recovery_log.write({
+            'id': email_id,
+            'run_id': run_id,
+            'action': action,
+            'from': sender,
+            'subject': subject,
+            'email_contents': body or '',
+            'actioned_at': actioned_at,
+        })
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO actions (id, run_id, action, sender, subject, actioned_at, log_file, log_offset, pending) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (email_id, run_id, action, sender, subject, actioned_at, log_file, log_offset, int(pending))
+            )
+
+    def iter_actions(self, since: Optional[float] = None, until: Optional[float] = None, sender_pattern: Optional[str] = None, run_id: Optional[str] = None, with_contents: bool = True, action: Optional[str] = None, restored: Optional[bool] = None) -> Iterator[Dict[str, Union[str, float]]]:
+        """
+        Stream recorded actions, oldest first, a few hundred rows at a time.
+        Pending actions whose bulk call has not gone through are left out.
+        Args:
+            since: Only actions at or after this Unix timestamp.
+            until: Only actions before this Unix timestamp.
+            sender_pattern: SQL LIKE pattern matched against the sender, e.g. '%@shop.example%'.
+            run_id: Only actions taken by this run.
+            with_contents: Read each email's body back from the recovery log as 'email_contents'.
+            action: Only actions of this kind, 'read' or 'delete'.
+            restored: Only actions that were (True) or were not (False) undone by restore.
+        """
+        conditions: List[str] = ["pending = 0"]
+        parameters: List[Union[str, float]] = []
+        for condition, value in (("actioned_at >= ?", since), ("actioned_at < ?", until), ("sender LIKE ?", sender_pattern), ("run_id = ?", run_id), ("action = ?", action)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        if restored is not None:
+            conditions.append("restored_at IS NOT NULL" if restored else "restored_at IS NULL")
+        query = "SELECT id, run_id, action, sender, subject, body, actioned_at, log_file, log_offset, restored_at FROM actions"
+        query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY actioned_at, rowid"
+
+        # Flush the block being written, so the actions of this run can be read back too
+        self._recovery_log.flush()
+        reader = RecoveryLogReader(self.recovery_dir)
+        with self._lock:
+            cursor = self._connection.execute(query, parameters)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(ACTION_FETCH_SIZE)
+            if not rows:
+                break
+            for email_id, row_run_id, row_action, sender, subject, body, actioned_at, log_file, log_offset, restored_at in rows:
+                details: Dict[str, Union[str, float]] = {
+                    'id': email_id,
+                    'run_id': row_run_id,
+                    'action': row_action,
+                    'from': sender,
+                    'subject': subject,
+                    'actioned_at': actioned_at,
+                    'restored_at': restored_at,
+                }
+                if with_contents:
+                    if body:
+                        details['email_contents'] = zlib.decompress(body).decode('utf-8')
+                    else:
+                        record = reader.find(email_id, log_file, log_offset) if log_file else None
+                        details['email_contents'] = record.get('email_contents', '') if record else ''
+                yield details
+
+    def runs(self) -> List[Dict[str, Union[str, float, int]]]:
+        """The runs that actioned emails, oldest first, with when they started and how many emails they read, deleted and had restored."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT run_id, MIN(actioned_at), SUM(action = 'read'), SUM(action = 'delete'), COUNT(restored_at)"
+                " FROM actions WHERE pending = 0 GROUP BY run_id ORDER BY MIN(actioned_at)"
+            ).fetchall()
+        return [
+            {'run_id': run_id, 'started_at': started_at, 'read': read, 'deleted': deleted, 'restored': restored}
+            for run_id, started_at, read, deleted, restored in rows
+        ]
+
+    def mark_restored(self, email_ids: List[str]) -> None:
+        """Record that the actions on these emails were undone, so an interrupted restore can resume."""
+        now = time.time()
+        with self._lock:
+            # Stay under SQLite's limit on query parameters
+            for start in range(0, len(email_ids), ACTION_FETCH_SIZE):
+                chunk = email_ids[start:start + ACTION_FETCH_SIZE]
+                self._connection.execute(
+                    f"UPDATE actions SET restored_at = ? WHERE restored_at IS NULL AND id IN ({', '.join('?' * len(chunk))})",
+                    [now, *chunk]
+                )
+            self._connection.commit()
+
+    def get_state(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key: str, value: Optional[str]) -> None:
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+            self._commit()
+
+    def migrate_legacy_files(self, processed_emails_file: str, processed_emails_details_file: str) -> None:
+        """
+        One-time import of the JSON files written by earlier versions.
+        The imported files are renamed with a .migrated suffix.
+
+        The oldest files recorded True for every email they looked at, later
+        ones the verdict. True is kept as a verdict when the file also holds
+        False verdicts, or when the details file shows the email was actioned;
+        otherwise it is taken for the old "looked at" marker and imported
+        without a verdict.
+        """
+        processed_emails_details = None
+        if os.path.exists(processed_emails_details_file):
+            with open(processed_emails_details_file, 'r') as file:
+                processed_emails_details = json.load(file)
+        actioned_ids = {details['id'] for details in processed_emails_details or []}
+
+        if os.path.exists(processed_emails_file):
+            with open(processed_emails_file, 'r') as file:
+                processed_emails = json.load(file)
+            has_verdicts = any(verdict is False for verdict in processed_emails.values())
+
+            def imported_verdict(email_id: str, verdict: object) -> Optional[bool]:
+                if verdict is False or (verdict is True and (has_verdicts or email_id in actioned_ids)):
+                    return verdict
+                return None
+
+            now = time.time()
+            with self._lock:
+                self._connection.executemany(
+                    "INSERT OR IGNORE INTO processed (id, verdict, processed_at) VALUES (?, ?, ?)",
+                    ((email_id, imported_verdict(email_id, verdict), now) for email_id, verdict in processed_emails.items())
+                )
+                self._connection.commit()
+                self._processed_ids.update(processed_emails)
+            os.replace(processed_emails_file, processed_emails_file + '.migrated')
+            print(f"Migrated {len(processed_emails)} processed emails from {processed_emails_file}")
+
+        if processed_emails_details is not None:
+            now = time.time()
+            for details in processed_emails_details:
+                self._record_action(details['id'], 'legacy-json', details.get('action', ''), details.get('from'), details.get('subject'), details.get('email_contents'), now)
+            with self._lock:
+                self._connection.commit()
+            os.replace(processed_emails_details_file, processed_emails_details_file + '.migrated')
+            print(f"Migrated {len(processed_emails_details)} email details from {processed_emails_details_file}")
+
+    def compact(self) -> None:
+        # Fold the write-ahead log back into the database file and truncate it
+        self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self) -> None:
+        self._recovery_log.close()
+        with self._lock:
+            self._connection.commit()
+            self.compact()
+            self._connection.close()
+
+    def _commit(self) -> None:
+        self._connection.commit()
+        self._appends += 1
+        if self._appends % COMPACTION_INTERVAL == 0:
+            self.compact()
@@ -0,0 +1,188 @@
+import ast
+import re
+import zlib
+from email.utils import parseaddr
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+EmailDict = Dict[str, Union[str, List[str]]]
+
+LOCAL_CLASSIFIER_MODEL_NAME = "hashing-linear"
+N_FEATURES = 2 ** 20
+BODY_LENGTH = 3000
+TOKEN_PATTERN = re.compile(r"[a-z0-9][a-z0-9'$%]+")
+
+
+def email_tokens(email_data: EmailDict) -> List[str]:
+    """Field-prefixed tokens of an email, so 'sale' in a subject and in a body are different features."""
+    display_name, address = parseaddr(email_data.get('from') or '')
+    address = address.lower()
+    local_part, _, domain = address.partition('@')
+    tokens = [f"a:{address}", f"d:{domain}", f"p:{local_part}"]
+    tokens += [f"n:{token}" for token in TOKEN_PATTERN.findall(display_name.lower())]
+    tokens += [f"l:{label}" for label in email_data.get('labels') or []]
+    subject_words = TOKEN_PATTERN.findall((email_data.get('subject') or '').lower())
+    tokens += [f"s:{word}" for word in subject_words]
+    tokens += [f"s:{first} {second}" for first, second in zip(subject_words, subject_words[1:])]
+    tokens += [f"b:{word}" for word in TOKEN_PATTERN.findall((email_data.get('body') or '')[:BODY_LENGTH].lower())]
+    if email_data.get('list_unsubscribe'):
+        tokens.append("h:list-unsubscribe")
+    if email_data.get('precedence'):
+        tokens.append(f"h:precedence:{email_data['precedence'].strip().lower()}")
+    return tokens
+
+
+def vectorize(emails: Iterable[EmailDict], n_features: int = N_FEATURES) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Hash emails into a sparse CSR matrix with signed hashing and L2-normalized rows.
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: The CSR indptr, indices and data arrays.
+    """
+    indptr = [0]
+    indices: List[int] = []
+    data: List[float] = []
+    for email_data in emails:
+        counts: Dict[int, float] = {}
+        for token in email_tokens(email_data):
+            hashed = zlib.crc32(token.encode('utf-8'))
+            # The top bit picks the sign, so colliding features tend to cancel out instead of adding up
+            index = hashed % n_features
+            counts[index] = counts.get(index, 0.0) + (1.0 if hashed & 0x80000000 else -1.0)
+        row_indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        row_data = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+        row_data = np.sign(row_data) * np.log1p(np.abs(row_data))
+        norm = np.sqrt(np.dot(row_data, row_data))
+        if norm:
+            row_data /= norm
+        indices.extend(row_indices.tolist())
+        data.extend(row_data.tolist())
+        indptr.append(len(indices))
+    return np.asarray(indptr, dtype=np.int64), np.asarray(indices, dtype=np.int64), np.asarray(data, dtype=np.float64)
+
+
+class LinearEmailClassifier:
+    """
+    Logistic regression over hashed email features, trained on past LLM verdicts.
+
+    predict_proba() scores a whole batch of emails in a handful of NumPy
+    operations. predict() only answers when the probability is outside
+    [1 - confidence, confidence] and returns None otherwise, so uncertain
+    emails can go to the language model.
+    """
+
+    def __init__(self, n_features: int = N_FEATURES, confidence: float = 0.9):
+        self.n_features = n_features
+        self.confidence = confidence
+        self.weights = np.zeros(n_features, dtype=np.float64)
+        self.bias = 0.0
+
+    def fit(self, emails: List[EmailDict], verdicts: List[bool], epochs: int = 20, batch_size: int = 256, learning_rate: float = 0.5, l2: float = 1e-6, seed: int = 0) -> "LinearEmailClassifier":
+        # Shuffle once up front so contiguous mini-batches are random samples
+        order = np.random.default_rng(seed).permutation(len(emails))
+        indptr, indices, data = vectorize((emails[i] for i in order), self.n_features)
+        labels = np.asarray(verdicts, dtype=np.float64)[order]
+        gradient_squares = np.full(self.n_features, 1e-8)
+        bias_gradient_squares = 1e-8
+
+        for _ in range(epochs):
+            for start in range(0, len(labels), batch_size):
+                stop = min(start + batch_size, len(labels))
+                batch_indices = indices[indptr[start]:indptr[stop]]
+                batch_data = data[indptr[start]:indptr[stop]]
+                row_of_entry = np.repeat(np.arange(stop - start), np.diff(indptr[start:stop + 1]))
+
+                margins = np.bincount(row_of_entry, weights=self.weights[batch_indices] * batch_data, minlength=stop - start) + self.bias
+                residuals = _sigmoid(margins) - labels[start:stop]
+
+                # Adagrad on the features present in the batch, with L2 shrinkage
+                gradient = np.bincount(batch_indices, weights=batch_data * residuals[row_of_entry], minlength=self.n_features) / (stop - start)
+                touched = np.unique(batch_indices)
+                gradient[touched] += l2 * self.weights[touched]
+                gradient_squares[touched] += gradient[touched] ** 2
+                self.weights[touched] -= learning_rate * gradient[touched] / np.sqrt(gradient_squares[touched])
+
+                bias_gradient = residuals.mean()
+                bias_gradient_squares += bias_gradient ** 2
+                self.bias -= learning_rate * bias_gradient / np.sqrt(bias_gradient_squares)
+        return self
+
+    def predict_proba(self, emails: List[EmailDict]) -> np.ndarray:
+        if not emails:
+            return np.zeros(0)
+        indptr, indices, data = vectorize(emails, self.n_features)
+        row_of_entry = np.repeat(np.arange(len(emails)), np.diff(indptr))
+        margins = np.bincount(row_of_entry, weights=self.weights[indices] * data, minlength=len(emails)) + self.bias
+        return _sigmoid(margins)
+
+    def predict(self, emails: List[EmailDict]) -> List[Optional[bool]]:
+        predictions: List[Optional[bool]] = []
+        for probability in self.predict_proba(emails):
+            if probability >= self.confidence:
+                predictions.append(True)
+            elif probability <= 1 - self.confidence:
+                predictions.append(False)
+            else:
+                predictions.append(None)
+        return predictions
+
+    def evaluate(self, emails: List[EmailDict], verdicts: List[bool]) -> Dict[str, float]:
+        """
+        Agreement metrics against the LLM verdicts.
+        Returns:
+            Dict[str, float]: coverage (share of confident predictions), agreement on the confident
+            predictions, overall agreement at 0.5, and precision/recall for promotional emails.
+        """
+        probabilities = self.predict_proba(emails)
+        expected = np.asarray(verdicts, dtype=bool)
+        predicted = probabilities >= 0.5
+        confident = (probabilities >= self.confidence) | (probabilities <= 1 - self.confidence)
+        true_positives = np.sum(predicted & expected)
+        return {
+            'samples': float(len(expected)),
+            'coverage': float(confident.mean()) if len(expected) else 0.0,
+            'confident_agreement': float((predicted[confident] == expected[confident]).mean()) if confident.any() else 0.0,
+            'agreement': float((predicted == expected).mean()) if len(expected) else 0.0,
+            'precision': float(true_positives / predicted.sum()) if predicted.any() else 0.0,
+            'recall': float(true_positives / expected.sum()) if expected.any() else 0.0,
+        }
+
+    def save(self, path: str) -> None:
+        np.savez_compressed(path, weights=self.weights, bias=self.bias, confidence=self.confidence)
+
+    @classmethod
+    def load(cls, path: str, confidence: Optional[float] = None) -> "LinearEmailClassifier":
+        with np.load(path) as saved:
+            model = cls(n_features=len(saved['weights']), confidence=float(saved['confidence']) if confidence is None else confidence)
+            model.weights = saved['weights']
+            model.bias = float(saved['bias'])
+        return model
+
+
+def parse_prompt_email(content: str) -> EmailDict:
+    """Recover the email fields from the user message built by email_evaluation.build_messages."""
+    header_text, _, body = content.partition("\nBody: ")
+    email_data: EmailDict = {'body': body}
+    for line in header_text.split("\n"):
+        name, _, value = line.partition(": ")
+        if name == "Gmail labels":
+            try:
+                email_data['labels'] = ast.literal_eval(value)
+            except (ValueError, SyntaxError):
+                email_data['labels'] = []
+        elif name in ("Subject", "To", "From", "Cc"):
+            email_data[name.lower()] = value
+    return email_data
+
+
+def local_completion(verdict: bool) -> dict:
+    # Same shape as a llama.cpp chat completion, marked so it is never mistaken for a model verdict
+    return {'model': LOCAL_CLASSIFIER_MODEL_NAME, 'choices': [{'message': {'role': 'assistant', 'content': str(verdict)}}]}
+
+
+def is_local_prediction(completion) -> bool:
+    return isinstance(completion, dict) and completion.get('model') == LOCAL_CLASSIFIER_MODEL_NAME
+
+
+def _sigmoid(margins: np.ndarray) -> np.ndarray:
+    return 1.0 / (1.0 + np.exp(-np.clip(margins, -35, 35)))
@@ -0,0 +1,235 @@
+import bisect
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, TypeVar
+
+# Upper bounds in seconds of the latency buckets, from a cache lookup up to a slow local model
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0, 120.0)
+PERCENTILES = (0.5, 0.95, 0.99)
+
+T = TypeVar('T')
+
+# Metrics of the account run the current thread works for, see Metrics.run()
+_current_run: contextvars.ContextVar[Optional['Metrics']] = contextvars.ContextVar('metrics_run', default=None)
+
+
+class Histogram:
+    """
+    Fixed-bucket latency histogram, as Prometheus keeps them. Memory stays constant
+    however long the daemon runs; percentiles are interpolated within a bucket.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                # Never report more than the slowest call seen
+                return min(lower + (upper - lower) * (rank - seen) / bucket_count, self.max)
+            seen += bucket_count
+        return self.max
+
+
+class Metrics:
+    """
+    Process-wide latency histograms per stage, counters, and model tokens per backend,
+    shared by every thread. Stages are timed with `with metrics.time('stage'):`.
+
+    Inside `with metrics.run() as run_metrics:` everything is also recorded in
+    run_metrics, a fresh Metrics for that one run, so the daemon reports each
+    account's run on its own while the process-wide totals keep growing for
+    Prometheus. Work handed to other threads inside the block follows the run
+    when it is wrapped with in_current_run().
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, int] = {}
+        self.tokens: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def run(self) -> Iterator['Metrics']:
+        run_metrics = Metrics()
+        token = _current_run.set(run_metrics)
+        try:
+            yield run_metrics
+        finally:
+            _current_run.reset(token)
+            run_metrics.finished_at = time.time()
+
+    def _run_metrics(self) -> Optional['Metrics']:
+        run_metrics = _current_run.get()
+        return run_metrics if run_metrics is not self else None
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+        run_metrics = self._run_metrics()
+        if run_metrics is not None:
+            run_metrics.observe(stage, seconds)
+
+    def increment(self, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+        run_metrics = self._run_metrics()
+        if run_metrics is not None:
+            run_metrics.increment(counter, amount)
+
+    def record_tokens(self, backend: str, prompt_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            totals = self.tokens.setdefault(str(backend), {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0})
+            totals['requests'] += 1
+            totals['prompt_tokens'] += prompt_tokens
+            totals['completion_tokens'] += completion_tokens
+        run_metrics = self._run_metrics()
+        if run_metrics is not None:
+            run_metrics.record_tokens(backend, prompt_tokens, completion_tokens)
+
+    def snapshot(self) -> Dict[str, object]:
+        """Everything recorded so far, as plain JSON-serializable data."""
+        with self._lock:
+            elapsed = max((self.finished_at or time.time()) - self.started_at, 1e-9)
+            return {
+                'started_at': self.started_at,
+                'elapsed_seconds': elapsed,
+                'stages': {
+                    stage: {
+                        'count': histogram.count,
+                        'total_seconds': histogram.sum,
+                        'per_second': histogram.count / elapsed,
+                        **{f'p{int(q * 100)}_seconds': histogram.percentile(q) for q in PERCENTILES},
+                        'max_seconds': histogram.max,
+                    }
+                    for stage, histogram in sorted(self.histograms.items())
+                },
+                'counters': dict(sorted(self.counters.items())),
+                'tokens': {backend: dict(totals) for backend, totals in sorted(self.tokens.items())},
+            }
+
+    def report(self) -> Dict[str, object]:
+        """Lines for the end-of-run statistics report."""
+        snapshot = self.snapshot()
+        lines: Dict[str, object] = {}
+        for stage, stage_stats in snapshot['stages'].items():
+            lines[f'{stage} p50/p95/p99'] = (
+                f"{stage_stats['p50_seconds'] * 1000:.0f}/{stage_stats['p95_seconds'] * 1000:.0f}/{stage_stats['p99_seconds'] * 1000:.0f} ms"
+                f" ({stage_stats['count']}, {stage_stats['per_second']:.1f}/s)"
+            )
+        for backend, totals in snapshot['tokens'].items():
+            lines[f'Tokens in/out ({backend})'] = f"{totals['prompt_tokens']}/{totals['completion_tokens']} in {totals['requests']} requests"
+        return lines
+
+    def write_json(self, path: str, extra: Optional[Dict[str, object]] = None) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        data = self.snapshot()
+        if extra:
+            data['report'] = extra
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, 'w') as file:
+            json.dump(data, file, indent=2, default=str)
+        os.replace(temporary_path, path)
+
+    def prometheus_text(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        with self._lock:
+            lines.append("# TYPE zinbo_stage_seconds histogram")
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f'zinbo_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'zinbo_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'zinbo_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'zinbo_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+            lines.append("# TYPE zinbo_events_total counter")
+            for counter, value in sorted(self.counters.items()):
+                lines.append(f'zinbo_events_total{{event="{counter}"}} {value}')
+            lines.append("# TYPE zinbo_model_requests_total counter")
+            for backend, totals in sorted(self.tokens.items()):
+                lines.append(f'zinbo_model_requests_total{{backend="{backend}"}} {totals["requests"]}')
+            lines.append("# TYPE zinbo_model_tokens_total counter")
+            for backend, totals in sorted(self.tokens.items()):
+                lines.append(f'zinbo_model_tokens_total{{backend="{backend}",direction="in"}} {totals["prompt_tokens"]}')
+                lines.append(f'zinbo_model_tokens_total{{backend="{backend}",direction="out"}} {totals["completion_tokens"]}')
+        return "\n".join(lines) + "\n"
+
+
+def in_current_run(target: Callable[..., T]) -> Callable[..., T]:
+    """target wrapped to record into the caller's current run from any thread, e.g. as a Thread target."""
+    return functools.partial(contextvars.copy_context().run, target)
+
+
+class MetricsServer:
+    """Serves the Prometheus text of a Metrics on http://host:port/metrics from a background thread."""
+
+    def __init__(self, metrics: Metrics, port: int, host: str = '127.0.0.1'):
+        registry = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes every few seconds would flood the console
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+
+    def start(self) -> 'MetricsServer':
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Shared by every module, like a logger
+metrics = Metrics()
@@ -0,0 +1,327 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
+
+from src.email_message import EmailMessage
+from src.gmail_service import GMAIL_BATCH_LIMIT
+from src.metrics import in_current_run
+
+if TYPE_CHECKING:
+    from googleapiclient.discovery import Resource
+
+EmailDict = Dict[str, Union[str, List[str]]]
+
+# Marks the end of a stage's input; every worker of the next stage receives one
+_DONE = object()
+
+
+class EmailPipeline:
+    """
+    Staged, concurrent version of the run.main loop.
+
+    producer (1 thread)   pages through the UNREAD listing and drops already processed IDs,
+                          listing the next page while the current one is queued
+    fetchers (N threads)  fetch and parse chunks of messages, optionally classifying
+                          each chunk in one batch call (classify_batch). With
+                          fetch_bodies, the chunk is fetched as metadata first;
+                          classify_metadata settles what it can from the headers
+                          and only the other emails' bodies are downloaded.
+                          classify_clusters then settles what it can of the rest
+                          from the verdicts of near-identical emails
+    classifiers (M)       decide whether each remaining email is promotional, one at a
+                          time or, with classify_many, in groups of what is queued
+    action stage (1)      applies the verdict and records the email as processed, and
+                          calls on_idle every idle_seconds while no email comes in
+
+    Emails that could not be fetched, or got no verdict, never reach the action
+    stage; they are counted in unfinished_emails and left for a later run.
+
+    The body of an EmailMessage is released as soon as it is no longer needed:
+    once a verdict keeps the email, or once a promotional email has been acted on.
+
+    Stages are connected by bounded queues, so the number of emails in flight
+    stays constant whatever the size of the mailbox. stop() ends paging and
+    lets the emails already in flight drain through the remaining stages.
+    """
+
+    def __init__(
+        self,
+        gmail_factory: Callable[[], 'Resource'],
+        list_page: Callable[['Resource', Optional[str]], Tuple[List[EmailDict], Optional[str]]],
+        fetch_messages: Callable[['Resource', List[EmailDict]], Dict[str, EmailDict]],
+        classify: Callable[[EmailDict], Optional[bool]],
+        act: Callable[[EmailDict, EmailDict, bool], None],
+        is_processed: Callable[[str], bool] = lambda email_id: False,
+        classify_batch: Optional[Callable[[List[EmailDict]], List[Optional[bool]]]] = None,
+        classify_many: Optional[Callable[[List[EmailDict]], List[Optional[bool]]]] = None,
+        classify_group_size: int = 1,
+        classify_metadata: Optional[Callable[[List[EmailDict]], List[Optional[bool]]]] = None,
+        classify_clusters: Optional[Callable[[List[EmailDict]], List[Optional[bool]]]] = None,
+        fetch_bodies: Optional[Callable[['Resource', List[str]], Dict[str, str]]] = None,
+        fetch_workers: int = 4,
+        classify_workers: int = 4,
+        queue_size: int = 256,
+        fetch_chunk_size: int = GMAIL_BATCH_LIMIT,
+        on_idle: Optional[Callable[[], None]] = None,
+        idle_seconds: float = 1.0,
+    ):
+        self.gmail_factory = gmail_factory
+        self.list_page = list_page
+        self.fetch_messages = fetch_messages
+        self.classify = classify
+        self.act = act
+        self.is_processed = is_processed
+        self.classify_batch = classify_batch
+        self.classify_many = classify_many
+        self.classify_group_size = max(1, classify_group_size)
+        self.classify_metadata = classify_metadata
+        self.classify_clusters = classify_clusters
+        self.fetch_bodies = fetch_bodies
+        self.fetch_workers = max(1, fetch_workers)
+        self.classify_workers = max(1, classify_workers)
+        self.fetch_chunk_size = max(1, fetch_chunk_size)
+        self.on_idle = on_idle
+        self.idle_seconds = idle_seconds
+
+        # Chunks hold up to fetch_chunk_size emails, so size that queue in chunks
+        self._fetch_queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size // self.fetch_chunk_size))
+        self._classify_queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+        self._action_queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+
+        self._stop_event = threading.Event()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._fetchers_running = self.fetch_workers
+        self._classifiers_running = self.classify_workers
+
+        self.total_unread_emails = 0
+        self.total_pages_fetched = 0
+        self.total_emails_processed = 0
+        self.unfinished_emails = 0
+        self.errors: List[Exception] = []
+
+    def run(self) -> None:
+        # Workers record their metrics into the run of the thread that runs the pipeline
+        threads = [threading.Thread(target=in_current_run(self._produce), name="pipeline-producer", daemon=True)]
+        threads += [threading.Thread(target=in_current_run(self._fetch), name=f"pipeline-fetcher-{i}", daemon=True) for i in range(self.fetch_workers)]
+        threads += [threading.Thread(target=in_current_run(self._classify), name=f"pipeline-classifier-{i}", daemon=True) for i in range(self.classify_workers)]
+        threads.append(threading.Thread(target=in_current_run(self._act), name="pipeline-action", daemon=True))
+
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=0.5)
+        except KeyboardInterrupt:
+            print("Interrupted, finishing the emails already in flight...")
+            self.stop()
+            for thread in threads:
+                thread.join()
+            raise
+
+    def stop(self) -> None:
+        """Stop listing new pages; emails already in flight are still processed."""
+        self._stop_event.set()
+
+    def _gmail(self) -> 'Resource':
+        # googleapiclient resources are not thread-safe, so every worker gets its own
+        if not hasattr(self._local, 'gmail'):
+            self._local.gmail = self.gmail_factory()
+        return self._local.gmail
+
+    def _produce(self) -> None:
+        try:
+            # One page is listed ahead, so the wait for messages.list overlaps with queueing
+            # the current page, which blocks whenever the fetchers are behind
+            with ThreadPoolExecutor(max_workers=1, thread_name_prefix="pipeline-lister") as lister:
+                next_page = lister.submit(in_current_run(self._list_page), None)
+                while next_page is not None:
+                    messages, page_token = next_page.result()
+                    next_page = lister.submit(in_current_run(self._list_page), page_token) if page_token and not self._stop_event.is_set() else None
+                    self.total_pages_fetched += 1
+                    self.total_unread_emails += len(messages)
+                    print(f"Fetched page {self.total_pages_fetched} of emails")
+
+                    unprocessed_messages = []
+                    for message_info in messages:
+                        if self.is_processed(message_info['id']):
+                            print(f"Skipping already looked at email with ID: {message_info['id']}")
+                        else:
+                            unprocessed_messages.append(message_info)
+
+                    for start in range(0, len(unprocessed_messages), self.fetch_chunk_size):
+                        self._fetch_queue.put(unprocessed_messages[start:start + self.fetch_chunk_size])
+
+                    if self._stop_event.is_set():
+                        break
+        except Exception as e:
+            print(f"Failed to list emails: {e}")
+            self.errors.append(e)
+        finally:
+            for _ in range(self.fetch_workers):
+                self._fetch_queue.put(_DONE)
+
+    def _list_page(self, page_token: Optional[str]) -> Tuple[List[EmailDict], Optional[str]]:
+        return self.list_page(self._gmail(), page_token)
+
+    def _fetch(self) -> None:
+        while True:
+            chunk = self._fetch_queue.get()
+            if chunk is _DONE:
+                break
+            try:
+                parsed_emails = self.fetch_messages(self._gmail(), chunk)
+            except Exception as e:
+                print(f"Failed to fetch email data: {e}")
+                self.errors.append(e)
+                parsed_emails = {}
+            fetched = []
+            for message_info in chunk:
+                if message_info['id'] in parsed_emails:
+                    fetched.append(message_info)
+                else:
+                    self._leave_unfinished(message_info)
+            chunk = fetched
+            emails = [parsed_emails[message_info['id']] for message_info in chunk]
+            if self.fetch_bodies is not None:
+                chunk, emails = self._fetch_bodies(chunk, emails)
+            verdicts = self._batch_verdicts(self.classify_batch, emails, "Failed to classify email batch")
+            if self.classify_clusters is not None:
+                verdicts = self._cluster_verdicts(emails, verdicts)
+            for message_info, email_data_parsed, is_promotional in zip(chunk, emails, verdicts):
+                # Emails the batch classifier is sure about skip the per-email classifiers
+                if is_promotional is None or not email_data_parsed:
+                    self._classify_queue.put((message_info, email_data_parsed))
+                else:
+                    self._settle(message_info, email_data_parsed, is_promotional)
+
+        with self._lock:
+            self._fetchers_running -= 1
+            last_fetcher = self._fetchers_running == 0
+        if last_fetcher:
+            for _ in range(self.classify_workers):
+                self._classify_queue.put(_DONE)
+
+    def _fetch_bodies(self, chunk: List[EmailDict], emails: List[EmailDict]) -> Tuple[List[EmailDict], List[EmailDict]]:
+        # Emails settled from their metadata go straight to the action stage without a body
+        verdicts = self._batch_verdicts(self.classify_metadata, emails, "Failed to classify email metadata")
+        remaining = []
+        for message_info, email_data_parsed, is_promotional in zip(chunk, emails, verdicts):
+            if is_promotional is None or not email_data_parsed:
+                remaining.append((message_info, email_data_parsed))
+            else:
+                self._settle(message_info, email_data_parsed, is_promotional)
+
+        wanted = [message_info['id'] for message_info, email_data_parsed in remaining if email_data_parsed]
+        try:
+            bodies = self.fetch_bodies(self._gmail(), wanted) if wanted else {}
+        except Exception as e:
+            print(f"Failed to fetch email bodies: {e}")
+            self.errors.append(e)
+            bodies = {}
+        fetched = []
+        for message_info, email_data_parsed in remaining:
+            if message_info['id'] in bodies:
+                email_data_parsed['body'] = bodies[message_info['id']]
+            elif email_data_parsed:
+                # Classifying on the headers alone would settle the email for good
+                self._leave_unfinished(message_info)
+                continue
+            fetched.append((message_info, email_data_parsed))
+        return [message_info for message_info, _ in fetched], [email_data_parsed for _, email_data_parsed in fetched]
+
+    def _cluster_verdicts(self, emails: List[EmailDict], verdicts: List[Optional[bool]]) -> List[Optional[bool]]:
+        unsettled = [index for index, verdict in enumerate(verdicts) if verdict is None and emails[index]]
+        cluster_verdicts = self._batch_verdicts(self.classify_clusters, [emails[index] for index in unsettled], "Failed to classify email clusters")
+        verdicts = list(verdicts)
+        for index, verdict in zip(unsettled, cluster_verdicts):
+            verdicts[index] = verdict
+        return verdicts
+
+    def _batch_verdicts(self, classify: Optional[Callable[[List[EmailDict]], List[Optional[bool]]]], emails: List[EmailDict], failure: str) -> List[Optional[bool]]:
+        if classify is None or not emails:
+            return [None] * len(emails)
+        try:
+            return classify(emails)
+        except Exception as e:
+            print(f"{failure}: {e}")
+            self.errors.append(e)
+            return [None] * len(emails)
+
+    def _classify(self) -> None:
+        done = False
+        while not done:
+            item = self._classify_queue.get()
+            if item is _DONE:
+                break
+            items = [item]
+            if self.classify_many is not None:
+                # Group whatever else is already waiting, without holding back the first email
+                while len(items) < self.classify_group_size:
+                    try:
+                        item = self._classify_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _DONE:
+                        done = True
+                        break
+                    items.append(item)
+            verdicts = self._verdicts([email_data_parsed for _, email_data_parsed in items])
+            for (message_info, email_data_parsed), is_promotional in zip(items, verdicts):
+                self._settle(message_info, email_data_parsed, is_promotional)
+
+        with self._lock:
+            self._classifiers_running -= 1
+            last_classifier = self._classifiers_running == 0
+        if last_classifier:
+            self._action_queue.put(_DONE)
+
+    def _verdicts(self, emails: List[EmailDict]) -> List[Optional[bool]]:
+        try:
+            if self.classify_many is not None:
+                return self.classify_many(emails)
+            return [self.classify(email_data_parsed) for email_data_parsed in emails]
+        except Exception as e:
+            print(f"Failed to evaluate email: {e}")
+            self.errors.extend([e] * len(emails))
+            # No verdict, so the emails are left for a later run
+            return [None] * len(emails)
+
+    def _leave_unfinished(self, message_info: EmailDict) -> None:
+        print(f"Leaving email {message_info['id']} for the next run")
+        with self._lock:
+            self.unfinished_emails += 1
+
+    def _settle(self, message_info: EmailDict, email_data_parsed: EmailDict, is_promotional: Optional[bool]) -> None:
+        if is_promotional is None:
+            self._leave_unfinished(message_info)
+            return
+        # Only promotional emails need their body after the verdict, for the recovery log
+        if not is_promotional and isinstance(email_data_parsed, EmailMessage):
+            email_data_parsed.release()
+        self._action_queue.put((message_info, email_data_parsed, is_promotional))
+
+    def _act(self) -> None:
+        while True:
+            try:
+                item = self._action_queue.get(timeout=self.idle_seconds if self.on_idle is not None else None)
+            except queue.Empty:
+                try:
+                    self.on_idle()
+                except Exception as e:
+                    print(f"Failed to process email: {e}")
+                    self.errors.append(e)
+                continue
+            if item is _DONE:
+                break
+            message_info, email_data_parsed, is_promotional = item
+            try:
+                self.act(message_info, email_data_parsed, is_promotional)
+            except Exception as e:
+                print(f"Failed to process email: {e}")
+                self.errors.append(e)
+            if isinstance(email_data_parsed, EmailMessage):
+                email_data_parsed.release()
+            self.total_emails_processed += 1
@@ -0,0 +1,128 @@
+import re
+import threading
+from email.utils import parseaddr
+from typing import Dict, List, Optional, Tuple, Union
+
+# Mailbox providers shared by many unrelated people, where reputation is tracked per address instead of per domain
+PUBLIC_MAIL_DOMAINS = {
+    'gmail.com', 'googlemail.com', 'outlook.com', 'hotmail.com', 'live.com', 'msn.com',
+    'yahoo.com', 'icloud.com', 'me.com', 'mac.com', 'aol.com', 'proton.me', 'protonmail.com',
+}
+BULK_LOCAL_PART = re.compile(
+    r'^(no[-_.]?reply|do[-_.]?not[-_.]?reply|newsletters?|news|marketing|promo(tions?)?|deals|offers|'
+    r'hello|info|updates?|mailer|bounces?)([-_.+].*)?$'
+)
+BULK_PRECEDENCE = {'bulk', 'list', 'junk'}
+
+MODES = ('off', 'on', 'shadow')
+
+
+class PreFilter:
+    """
+    Cheap rule-based stage in front of the language model.
+
+    decide() answers True (promotional), False (keep) or None (unknown) from
+    the Gmail category labels, the List-Unsubscribe/Precedence headers, the
+    sender domain's past verdicts and a match on the user's last name. Only
+    unknown emails need the model.
+
+    In 'shadow' mode the decisions are only compared against the model's
+    verdicts, to check the rules' accuracy before trusting them ('on').
+    """
+
+    def __init__(self, user_last_name: str, mode: str = 'on', sender_verdict_counts: Optional[Dict[str, Tuple[int, int]]] = None, min_verdicts: int = 5, reputation_threshold: float = 0.95):
+        if mode not in MODES:
+            raise ValueError(f"Invalid pre-filter mode: {mode}")
+        self.user_last_name = user_last_name
+        self.mode = mode
+        self.min_verdicts = min_verdicts
+        self.reputation_threshold = reputation_threshold
+        self.reputation: Dict[str, List[int]] = {}
+        for sender, (promotional, total) in (sender_verdict_counts or {}).items():
+            counts = self.reputation.setdefault(_reputation_key(sender), [0, 0])
+            counts[0] += promotional
+            counts[1] += total
+
+        self.decided_promotional = 0
+        self.decided_keep = 0
+        self.undecided = 0
+        self.agreed = 0
+        self.disagreed = 0
+        self._lock = threading.Lock()
+
+    def decide(self, email_data: Dict[str, Union[str, List[str]]]) -> Optional[bool]:
+        decision = self._decide(email_data)
+        with self._lock:
+            if decision is None:
+                self.undecided += 1
+            elif decision:
+                self.decided_promotional += 1
+            else:
+                self.decided_keep += 1
+        return decision
+
+    def record_model_verdict(self, decision: Optional[bool], verdict: Optional[bool]) -> None:
+        """Compare a shadow-mode decision with the model's verdict."""
+        if decision is None or verdict is None:
+            return
+        with self._lock:
+            if decision == verdict:
+                self.agreed += 1
+            else:
+                self.disagreed += 1
+
+    def stats(self) -> Dict[str, object]:
+        decided = self.decided_promotional + self.decided_keep
+        total = decided + self.undecided
+        stats: Dict[str, object] = {
+            'Pre-filter mode': self.mode,
+            'Pre-filter decided promotional': self.decided_promotional,
+            'Pre-filter decided keep': self.decided_keep,
+            'Pre-filter sent to model': self.undecided,
+        }
+        if self.mode == 'on':
+            stats['Model calls avoided'] = f"{decided / total:.1%}" if total else "n/a"
+        elif self.mode == 'shadow':
+            compared = self.agreed + self.disagreed
+            stats['Pre-filter agreement with model'] = f"{self.agreed / compared:.1%} of {compared}" if compared else "n/a"
+        return stats
+
+    def _decide(self, email_data: Dict[str, Union[str, List[str]]]) -> Optional[bool]:
+        if not email_data:
+            return None
+        display_name, address = parseaddr(email_data.get('from') or '')
+        address = address.lower()
+        local_part = address.partition('@')[0]
+        labels = email_data.get('labels') or []
+        bulk_headers = bool(email_data.get('list_unsubscribe')) or (email_data.get('precedence') or '').strip().lower() in BULK_PRECEDENCE
+        bulk_sender = bool(BULK_LOCAL_PART.match(local_part))
+
+        # A family member shares the user's last name, and writes personally rather than through a mailing list
+        if self.user_last_name and not bulk_headers and not bulk_sender:
+            if self.user_last_name.lower() in re.findall(r'[\w\'-]+', display_name.lower()):
+                return False
+
+        counts = self.reputation.get(_reputation_key(address))
+        if counts and counts[1] >= self.min_verdicts:
+            promotional_rate = counts[0] / counts[1]
+            if promotional_rate >= self.reputation_threshold:
+                return True
+            if promotional_rate <= 1 - self.reputation_threshold:
+                return False
+
+        if 'CATEGORY_PROMOTIONS' in labels and (bulk_headers or bulk_sender):
+            return True
+
+        return None
+
+
+def _reputation_key(sender: str) -> str:
+    address = parseaddr(sender)[1].lower() or sender.lower()
+    domain = address.partition('@')[2]
+    if not domain or domain in PUBLIC_MAIL_DOMAINS:
+        return address
+    # Brands send from subdomains (e.g. email.shop.example), so reputation is kept on the registered domain
+    labels = domain.split('.')
+    if len(labels) >= 3 and len(labels[-1]) == 2 and labels[-2] in ('co', 'com', 'org', 'net', 'ac', 'gov'):
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
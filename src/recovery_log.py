@@ -0,0 +1,173 @@
+import gzip
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+# Start a new log file once the current one is this large, compressed
+MAX_FILE_BYTES = 64 * 1024 * 1024
+# Records compressed together; a lookup decompresses at most one block
+BLOCK_RECORDS = 64
+# A block open for longer than this is closed at the next write, so a slow trickle of records still reaches the file
+FLUSH_INTERVAL_SECONDS = 1.0
+
+FILE_PATTERN = re.compile(r'^recovery-(\d{6})\.jsonl\.gz$')
+
+RecoveryRecord = Dict[str, Union[str, float]]
+
+
+class RecoveryLogWriter:
+    """
+    Append-only log of the emails acted on, as gzip-compressed JSON Lines.
+
+    Records are compressed in blocks of BLOCK_RECORDS, each block a separate
+    gzip member, so the files stay readable by zcat and a single record can be
+    read back by decompressing only its block. write() returns where the
+    record went, for the ledger to keep as an index. A file is rotated once
+    it passes max_file_bytes. Nothing is kept in memory beyond the block
+    being compressed.
+    """
+
+    def __init__(self, directory: str, max_file_bytes: int = MAX_FILE_BYTES, block_records: int = BLOCK_RECORDS, flush_interval_seconds: float = FLUSH_INTERVAL_SECONDS):
+        self.directory = directory
+        self.max_file_bytes = max_file_bytes
+        self.block_records = max(1, block_records)
+        self.flush_interval_seconds = flush_interval_seconds
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_name: Optional[str] = None
+        self._block: Optional[gzip.GzipFile] = None
+        self._block_offset = 0
+        self._block_count = 0
+        self._block_started_at = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, record: RecoveryRecord) -> Tuple[str, int]:
+        """
+        Append one record.
+        Returns:
+            Tuple[str, int]: The log file name and the offset of the block holding the record.
+        """
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._lock:
+            if self._block is None:
+                self._start_block()
+            location = (self._file_name, self._block_offset)
+            self._block.write(line)
+            self._block_count += 1
+            if self._block_count >= self.block_records or time.monotonic() - self._block_started_at >= self.flush_interval_seconds:
+                self._end_block()
+        return location
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._block is not None:
+                self._end_block()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._block is not None:
+                self._end_block()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _start_block(self) -> None:
+        if self._file is None or self._file.tell() >= self.max_file_bytes:
+            if self._file is not None:
+                self._file.close()
+            self._open_file()
+        self._block_offset = self._file.tell()
+        self._block = gzip.GzipFile(fileobj=self._file, mode='wb', mtime=0)
+        self._block_count = 0
+        self._block_started_at = time.monotonic()
+
+    def _end_block(self) -> None:
+        # Closing the member writes its trailer but leaves the file open for the next block
+        self._block.close()
+        self._block = None
+        self._file.flush()
+
+    def _open_file(self) -> None:
+        names = log_files(self.directory)
+        if names and os.path.getsize(os.path.join(self.directory, names[-1])) < self.max_file_bytes:
+            # Gzip members can be appended to a file from an earlier run
+            self._file_name = names[-1]
+        else:
+            number = int(FILE_PATTERN.match(names[-1]).group(1)) + 1 if names else 1
+            self._file_name = f"recovery-{number:06d}.jsonl.gz"
+        self._file = open(os.path.join(self.directory, self._file_name), 'ab')
+
+
+class RecoveryLogReader:
+    """
+    Reads a recovery log back: every record in write order, or one record by ID
+    given the location the writer returned. The last block read is kept, so
+    looking up records in the order they were written decompresses each block once.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._cached_block: Optional[Tuple[str, int]] = None
+        self._cached_records: Dict[str, RecoveryRecord] = {}
+
+    def __iter__(self) -> Iterator[RecoveryRecord]:
+        for name in log_files(self.directory):
+            yield from self._read_lines(name, 0)
+
+    def find(self, email_id: str, file_name: Optional[str] = None, offset: Optional[int] = None) -> Optional[RecoveryRecord]:
+        """
+        The most recent record of an email, or None if the log doesn't have it.
+        Without a location, every file is scanned.
+        """
+        if file_name is None or offset is None:
+            found = None
+            for record in self:
+                if record.get('id') == email_id:
+                    found = record
+            return found
+        if self._cached_block != (file_name, offset):
+            self._cached_block = (file_name, offset)
+            self._cached_records = {}
+            for record in self._read_lines(file_name, offset, single_block=True):
+                self._cached_records[record.get('id')] = record
+        return self._cached_records.get(email_id)
+
+    def _read_lines(self, file_name: str, offset: int, single_block: bool = False) -> Iterator[RecoveryRecord]:
+        path = os.path.join(self.directory, file_name)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as file:
+            file.seek(offset)
+            lines = _block_lines(file) if single_block else gzip.GzipFile(fileobj=file, mode='rb')
+            try:
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+            except (EOFError, OSError, zlib.error, json.JSONDecodeError):
+                # The last block of a run that crashed may be cut short
+                print(f"Recovery log {file_name} ends with an incomplete block")
+
+
+def _block_lines(file) -> Iterator[bytes]:
+    # Decompress exactly one gzip member, streaming its lines
+    decompressor = zlib.decompressobj(wbits=31)
+    pending = b''
+    while not decompressor.eof:
+        chunk = file.read(64 * 1024)
+        if not chunk:
+            raise EOFError("Gzip member ends early")
+        data = pending + decompressor.decompress(chunk)
+        *lines, pending = data.split(b'\n')
+        yield from lines
+    if pending:
+        yield pending
+
+
+def log_files(directory: str) -> List[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name for name in os.listdir(directory) if FILE_PATTERN.match(name))
@@ -0,0 +1,152 @@
+import re
+import threading
+from email.utils import parseaddr
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+# Bits of a SimHash fingerprint
+FINGERPRINT_BITS = 64
+# Fingerprints this many bits apart or fewer are taken as the same template
+MAX_TEMPLATE_DISTANCE = 3
+# Characters of the subject and body a fingerprint is computed from; templates differ early
+FINGERPRINT_TEXT_LENGTH = 2000
+# Emails of a cluster classified by the model before its verdict is applied to the rest
+SAMPLE_SIZE = 3
+
+# Order numbers, prices, dates and tracking IDs change from one email of a template to the next
+VARIABLE_TOKEN = re.compile(r'\d+')
+WORD = re.compile(r'[^\W_]+')
+
+
+def template_tokens(text: str) -> List[str]:
+    return WORD.findall(VARIABLE_TOKEN.sub('0', text.lower()))
+
+
+def simhash(text: str) -> int:
+    """
+    SimHash of the word pairs of a text: texts sharing most of their words get
+    fingerprints that differ in only a few bits.
+    """
+    tokens = template_tokens(text)
+    features = set(zip(tokens, tokens[1:])) if len(tokens) > 1 else set((token,) for token in tokens)
+    if not features:
+        return 0
+    # Python's string hash is seeded per process, which is fine as clusters live for one run
+    hashes = np.fromiter((hash(feature) for feature in features), dtype=np.int64, count=len(features))
+    # One row of bits per feature; a fingerprint bit is set where most features have it set
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(len(features), FINGERPRINT_BITS // 8), axis=1)
+    majority = bits.sum(axis=0) * 2 > len(features)
+    return int.from_bytes(np.packbits(majority).tobytes(), 'big')
+
+
+def email_fingerprint(email_data: Dict[str, Union[str, List[str]]]) -> Tuple[str, int]:
+    sender = parseaddr(email_data.get('from') or '')[1].lower()
+    text = f"{email_data.get('subject') or ''}\n{email_data.get('body') or email_data.get('snippet') or ''}"
+    return sender, simhash(text[:FINGERPRINT_TEXT_LENGTH])
+
+
+class _Cluster:
+    def __init__(self, fingerprint: int):
+        self.fingerprint = fingerprint
+        self.promotional = 0
+        self.verdicts = 0
+
+    def add(self, verdict: bool) -> None:
+        self.promotional += verdict
+        self.verdicts += 1
+
+    def verdict(self, sample_size: int) -> Optional[bool]:
+        # A cluster with disagreeing verdicts is never settled, its emails are classified one by one
+        if self.verdicts < sample_size or 0 < self.promotional < self.verdicts:
+            return None
+        return self.promotional == self.verdicts
+
+
+class SenderClusters:
+    """
+    Groups emails by sender address and SimHash template fingerprint, so a
+    promotional backlog of thousands of near-identical emails costs the model
+    a few samples per template instead of one call per email.
+
+    classify() takes the emails of a chunk and returns a verdict for each, or
+    None for the emails to classify one by one. Once sample_size emails of a
+    cluster have been classified and agree, every later email of the cluster
+    gets their verdict without a model call. When a chunk holds more emails
+    of an unsettled cluster than it still needs samples, the samples are
+    classified right away with classify_samples and settle the rest of the
+    chunk. Emails classified one by one count as samples through record().
+    Clusters are kept for the whole run, so a template seen on the first page
+    is settled for all the pages after it.
+    """
+
+    def __init__(self, classify_samples: Callable[[List[Dict[str, Union[str, List[str]]]]], List[Optional[bool]]], sample_size: int = SAMPLE_SIZE, max_distance: int = MAX_TEMPLATE_DISTANCE):
+        self.classify_samples = classify_samples
+        self.sample_size = max(1, sample_size)
+        self.max_distance = max_distance
+        self.clusters: Dict[str, List[_Cluster]] = {}
+        self.samples_classified = 0
+        self.settled_by_cluster = 0
+        self._lock = threading.Lock()
+
+    def classify(self, emails: List[Dict[str, Union[str, List[str]]]]) -> List[Optional[bool]]:
+        verdicts: List[Optional[bool]] = [None] * len(emails)
+        fingerprints = [email_fingerprint(email_data) if email_data else None for email_data in emails]
+        members: Dict[_Cluster, List[int]] = {}
+        with self._lock:
+            for index, fingerprint in enumerate(fingerprints):
+                if fingerprint is not None:
+                    members.setdefault(self._find(*fingerprint), []).append(index)
+
+            samples: List[Tuple[int, _Cluster]] = []
+            for cluster, indices in members.items():
+                needed = self.sample_size - cluster.verdicts
+                if cluster.verdict(self.sample_size) is None and 0 < needed < len(indices):
+                    samples += [(index, cluster) for index in indices[:needed]]
+        if samples:
+            sample_verdicts = self.classify_samples([emails[index] for index, _ in samples])
+            with self._lock:
+                self.samples_classified += len(samples)
+                for (index, cluster), verdict in zip(samples, sample_verdicts):
+                    # A sample the model could not answer for is classified again on its own
+                    if verdict is not None:
+                        verdicts[index] = verdict
+                        cluster.add(verdict)
+
+        with self._lock:
+            for cluster, indices in members.items():
+                verdict = cluster.verdict(self.sample_size)
+                if verdict is None:
+                    continue
+                for index in indices:
+                    if verdicts[index] is None:
+                        verdicts[index] = verdict
+                        self.settled_by_cluster += 1
+        return verdicts
+
+    def record(self, email_data: Dict[str, Union[str, List[str]]], verdict: Optional[bool]) -> None:
+        """Count the verdict of an email classified on its own towards its cluster."""
+        if not email_data or verdict is None:
+            return
+        fingerprint = email_fingerprint(email_data)
+        with self._lock:
+            self._find(*fingerprint).add(verdict)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            clusters = [cluster for sender_clusters in self.clusters.values() for cluster in sender_clusters]
+            settled = sum(1 for cluster in clusters if cluster.verdict(self.sample_size) is not None)
+        return {
+            'Sender clusters': f"{len(clusters)} from {len(self.clusters)} senders ({settled} settled)",
+            'Cluster samples classified': self.samples_classified,
+            'Emails settled by cluster': self.settled_by_cluster,
+        }
+
+    def _find(self, sender: str, fingerprint: int) -> _Cluster:
+        sender_clusters = self.clusters.setdefault(sender, [])
+        for cluster in sender_clusters:
+            if bin(cluster.fingerprint ^ fingerprint).count('1') <= self.max_distance:
+                return cluster
+        cluster = _Cluster(fingerprint)
+        sender_clusters.append(cluster)
+        return cluster
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from src.metrics import metrics
+
+# Evict after this many writes, so eviction cost is spread over the run
+EVICTION_INTERVAL = 1000
+# Seconds a write waits for another process's lock, e.g. the daemon's other accounts sharing the file
+BUSY_TIMEOUT_SECONDS = 30.0
+
+
+def normalize(text: Optional[str]) -> str:
+    # Case and whitespace differences don't change what the model sees in any meaningful way
+    return re.sub(r'\s+', ' ', text or '').strip().lower()
+
+
+class VerdictCache:
+    """
+    On-disk cache of classification verdicts, stored in SQLite.
+
+    Entries are keyed on a hash of the normalized sender, subject and truncated
+    body, together with the model name and prompt version, so a change of
+    model or prompt never serves stale verdicts. Verdicts of a batched prompt
+    are stored under that prompt's own version. Entries older than
+    max_age_days are dropped, and the least recently used entries go once the
+    cache holds more than max_entries.
+    """
+
+    def __init__(self, path: str, model_name: str, prompt_version: str, max_entries: int = 200000, max_age_days: float = 90, body_length: int = 3000):
+        self.path = path
+        self.model_name = model_name
+        self.prompt_version = prompt_version
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.body_length = body_length
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Shared by the classifier threads, access is serialized by self._lock; other connections
+        # to the file, one per daemon account, take turns through SQLite's lock
+        self._connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts ("
+            " key TEXT PRIMARY KEY,"
+            " model TEXT NOT NULL,"
+            " prompt_version TEXT NOT NULL,"
+            " verdict INTEGER NOT NULL,"
+            " sender TEXT,"
+            " subject TEXT,"
+            " labels TEXT,"
+            " body TEXT,"
+            " created_at REAL NOT NULL,"
+            " last_used_at REAL NOT NULL)"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS verdicts_last_used_at ON verdicts (last_used_at)")
+        self._connection.commit()
+        self.evict()
+
+    def key(self, email_data: Dict[str, Union[str, List[str]]], prompt_version: Optional[str] = None) -> str:
+        parts = [
+            self.model_name,
+            prompt_version or self.prompt_version,
+            normalize(email_data.get('from')),
+            normalize(email_data.get('subject')),
+            normalize((email_data.get('body') or '')[:self.body_length]),
+        ]
+        return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, email_data: Dict[str, Union[str, List[str]]], prompt_versions: Optional[Sequence[str]] = None) -> Optional[bool]:
+        """The cached verdict of the email under the cache's prompt version, or under any of prompt_versions if given."""
+        keys = [self.key(email_data, version) for version in prompt_versions or [self.prompt_version]]
+        with self._lock:
+            row = self._connection.execute(f"SELECT verdict, key FROM verdicts WHERE key IN ({', '.join('?' * len(keys))}) LIMIT 1", keys).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.increment('verdict_cache_misses')
+                return None
+            self.hits += 1
+            metrics.increment('verdict_cache_hits')
+            self._connection.execute("UPDATE verdicts SET last_used_at = ? WHERE key = ?", (time.time(), row[1]))
+            self._connection.commit()
+        return bool(row[0])
+
+    def put(self, email_data: Dict[str, Union[str, List[str]]], verdict: bool, prompt_version: Optional[str] = None) -> None:
+        """Cache a verdict given by the cache's prompt, or by the prompt of prompt_version, e.g. a batched one."""
+        prompt_version = prompt_version or self.prompt_version
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO verdicts (key, model, prompt_version, verdict, sender, subject, labels, body, created_at, last_used_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.key(email_data, prompt_version),
+                    self.model_name,
+                    prompt_version,
+                    int(verdict),
+                    email_data.get('from'),
+                    email_data.get('subject'),
+                    json.dumps(email_data.get('labels') or []),
+                    (email_data.get('body') or '')[:self.body_length],
+                    now,
+                    now,
+                )
+            )
+            self._connection.commit()
+            self._writes += 1
+            evict_now = self._writes % EVICTION_INTERVAL == 0
+        if evict_now:
+            self.evict()
+
+    def evict(self) -> int:
+        """
+        Drop expired entries, then the least recently used ones above max_entries.
+        Returns:
+            int: The number of entries removed.
+        """
+        with self._lock:
+            removed = self._connection.execute(
+                "DELETE FROM verdicts WHERE last_used_at < ?", (time.time() - self.max_age_days * 86400,)
+            ).rowcount
+            count = self._connection.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+            if count > self.max_entries:
+                removed += self._connection.execute(
+                    "DELETE FROM verdicts WHERE key IN (SELECT key FROM verdicts ORDER BY last_used_at LIMIT ?)",
+                    (count - self.max_entries,)
+                ).rowcount
+            self._connection.commit()
+        return removed
+
+    def iter_verdicts(self, chunk_size: int = 1000) -> Iterator[Dict[str, Union[str, List[str], bool]]]:
+        """Stream every cached verdict with the email fields it was given for."""
+        last_rowid = 0
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT rowid, sender, subject, labels, body, verdict FROM verdicts WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (last_rowid, chunk_size)
+                ).fetchall()
+            if not rows:
+                return
+            for last_rowid, sender, subject, labels, body, verdict in rows:
+                yield {'from': sender, 'subject': subject, 'labels': json.loads(labels or '[]'), 'body': body or '', 'verdict': bool(verdict)}
+
+    def sender_verdict_counts(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Returns:
+            Dict[str, Tuple[int, int]]: For every sender, the number of promotional verdicts and of all verdicts.
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT sender, SUM(verdict), COUNT(*) FROM verdicts GROUP BY sender").fetchall()
+        return {sender: (promotional, total) for sender, promotional, total in rows if sender}
+
+    def stats(self) -> Dict[str, object]:
+        lookups = self.hits + self.misses
+        return {
+            'Verdict cache hits': self.hits,
+            'Verdict cache misses': self.misses,
+            'Verdict cache hit rate': f"{self.hits / lookups:.1%}" if lookups else "n/a",
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,107 @@
+import json
+import tracemalloc
+import unittest
+from unittest.mock import patch
+
+from src.benchmark import FakeGmail, StubLanguageModelClient, generate_mailbox
+from src.email_text import clean_body, extract_body
+from src.gmail_service import _parse_message, parse_email_batch
+from run import run_benchmark
+
+
+class TestFakeGmail(unittest.TestCase):
+
+    def test_lists_pages_of_unread_messages(self):
+        gmail = FakeGmail(generate_mailbox(250))
+
+        first = gmail.users().messages().list(userId='me', labelIds=['UNREAD']).execute()
+        gmail.users().messages().batchModify(userId='me', body={'ids': [m['id'] for m in first['messages']], 'removeLabelIds': ['UNREAD']}).execute()
+        second = gmail.users().messages().list(userId='me', labelIds=['UNREAD'], pageToken=first['nextPageToken']).execute()
+
+        self.assertEqual(len(first['messages']), 100)
+        self.assertEqual(second['messages'][0]['id'], f'{100:012x}')
+        self.assertEqual(len(gmail.actioned_ids()), 100)
+        self.assertEqual(gmail.calls['messages.list'], 2)
+
+    def test_lists_by_category_search(self):
+        mailbox = generate_mailbox(100, seed=2)
+        gmail = FakeGmail(mailbox)
+
+        promotions = gmail.users().messages().list(userId='me', labelIds=['UNREAD'], maxResults=500, q='category:promotions').execute()['messages']
+        rest = gmail.users().messages().list(userId='me', labelIds=['UNREAD'], maxResults=500, q='newer_than:30d -category:promotions').execute()['messages']
+
+        self.assertTrue(promotions)
+        self.assertTrue(all('CATEGORY_PROMOTIONS' in mailbox[message['id']]['labelIds'] for message in promotions))
+        self.assertEqual(len(promotions) + len(rest), 100)
+
+    def test_messages_parse_like_gmail_ones(self):
+        mailbox = generate_mailbox(40, seed=3)
+        gmail = FakeGmail(mailbox)
+
+        parsed = parse_email_batch(gmail, [{'id': message_id} for message_id in mailbox])
+
+        self.assertEqual(gmail.calls['messages.get'], 40)
+        self.assertEqual(gmail.http_requests, 1)
+        for message_id, message in mailbox.items():
+            self.assertTrue(parsed[message_id]['body'])
+            self.assertEqual(message['promotional'], StubLanguageModelClient._verdict(clean_body(extract_body(message['payload']))))
+
+    @patch('src.gmail_service.time.sleep')
+    def test_throttled_calls_are_retried(self, mock_sleep):
+        mailbox = generate_mailbox(50)
+        gmail = FakeGmail(mailbox, throttle_rate=0.3, seed=1)
+
+        parsed = parse_email_batch(gmail, [{'id': message_id} for message_id in mailbox])
+
+        self.assertTrue(all(parsed.values()))
+        self.assertGreater(gmail.http_requests, 1)
+
+
+class TestRunBenchmark(unittest.TestCase):
+
+    def test_pipeline_actions_exactly_the_promotional_emails(self):
+        results = run_benchmark(300, gmail_latency=0.0, throttle_rate=0.0, model_delay=0.0, model_concurrency=None)
+
+        promotional_actioned, promotional = results['Promotional emails actioned'].split('/')
+        self.assertEqual(promotional_actioned, promotional)
+        self.assertEqual(results['Other emails actioned'], 0)
+        self.assertEqual(results['Emails'], 300)
+
+
+def traced_bytes(build):
+    tracemalloc.start()
+    try:
+        kept = build()
+        return tracemalloc.get_traced_memory()[0], kept
+    finally:
+        tracemalloc.stop()
+
+
+class TestEmailMemory(unittest.TestCase):
+
+    def test_parsed_emails_are_smaller_than_dicts(self):
+        # Every email is parsed from its own copy of the response, as it would come from Gmail
+        responses = [json.dumps({key: value for key, value in message.items() if key != 'promotional'}) for message in generate_mailbox(500).values()]
+
+        def parse(keep):
+            emails = []
+            for response in responses:
+                email = _parse_message(json.loads(response))
+                email.get('body')
+                emails.append(keep(email))
+            return emails
+
+        def released(email):
+            email.release()
+            return email
+
+        dict_bytes, _ = traced_bytes(lambda: parse(dict))
+        message_bytes, _ = traced_bytes(lambda: parse(lambda email: email))
+        released_bytes, _ = traced_bytes(lambda: parse(released))
+
+        self.assertLess(message_bytes, dict_bytes)
+        self.assertLess(released_bytes, message_bytes / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,213 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from run import open_ledger, process_account
+from src import gmail_service
+from src.benchmark import FakeGmail, StubLanguageModelClient, generate_mailbox
+from src.checkpoint import CheckpointedLister
+from src.ledger import Ledger
+
+PAGES = {
+    None: ([{'id': 'id1'}, {'id': 'id2'}], '0:page2'),
+    '0:page2': ([{'id': 'id3'}, {'id': 'id4'}], '0:page3'),
+    '0:page3': ([{'id': 'id5'}], None),
+}
+
+
+def make_lister(pages=PAGES):
+    return MagicMock(side_effect=lambda gmail, page_token: pages[page_token], start_history_id=None, searches=['is:unread'], full_scan=True, complete=True)
+
+
+def page_ids(page):
+    return [message_info['id'] for message_info in page[0]], page[1]
+
+
+class TestCheckpointedLister(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'ledger.sqlite3')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_interrupted_run_resumes_from_its_last_page(self):
+        ledger = Ledger(self.path)
+        lister = CheckpointedLister(make_lister(), ledger, '100')
+        self.assertEqual(page_ids(lister(None, None)), (['id1', 'id2'], '0:page2'))
+        self.assertEqual(page_ids(lister(None, '0:page2')), (['id3', 'id4'], '0:page3'))
+        # id1 was kept, id3 classified as promotional, then the run crashed
+        ledger.mark_processed('id1', False)
+        ledger.mark_classified('id3', True)
+        self.assertFalse(lister.complete)
+        ledger.close()
+
+        ledger = Ledger(self.path)
+        inner = make_lister()
+        lister = CheckpointedLister(inner, ledger, '200')
+        self.assertEqual(lister.unfinished_actions(), ['id3'])
+        self.assertEqual(page_ids(lister(None, None)), (['id2', 'id4'], '0:page3'))
+        self.assertEqual(page_ids(lister(None, '0:page3')), (['id5'], None))
+        inner.assert_called_once_with(None, '0:page3')
+        self.assertTrue(lister.complete)
+
+        lister.finish()
+        self.assertEqual(ledger.get_state('history_id'), '100')
+        self.assertIsNone(ledger.get_state('page_cursor'))
+        ledger.close()
+
+    def test_in_flight_emails_are_not_listed_twice(self):
+        ledger = Ledger(self.path)
+        ledger.mark_listed(['id2'])
+        ledger.mark_processed('id1', False)
+        lister = CheckpointedLister(make_lister(), ledger, '100')
+
+        self.assertEqual(page_ids(lister(None, None)), (['id2'], 'first-page'))
+        # Processed emails are left to the pipeline's skip check
+        self.assertEqual(page_ids(lister(None, 'first-page')), (['id1'], '0:page2'))
+        ledger.close()
+
+    def test_cursor_of_a_different_listing_is_ignored(self):
+        ledger = Ledger(self.path)
+        CheckpointedLister(make_lister(), ledger, '100')(None, None)
+
+        inner = make_lister()
+        inner.searches = ['is:unread category:promotions']
+        lister = CheckpointedLister(inner, ledger, '200')
+        self.assertEqual(lister.history_id, '200')
+        lister(None, None)
+        # id1 and id2 are still in flight, so they are handed out before listing starts over
+        inner.assert_not_called()
+        ledger.close()
+
+    def test_rejected_page_token_drops_the_cursor(self):
+        ledger = Ledger(self.path)
+        CheckpointedLister(make_lister(), ledger, '100')(None, None)
+        ledger.mark_processed_many(['id1', 'id2'], False)
+
+        inner = make_lister()
+        inner.side_effect = lambda gmail, page_token: ([], None)
+        inner.complete = False
+        lister = CheckpointedLister(inner, ledger, '200')
+        self.assertEqual(lister(None, None), ([], None))
+
+        self.assertFalse(lister.complete)
+        self.assertIsNone(ledger.get_state('page_cursor'))
+        ledger.close()
+
+
+class TestProcessAccountResume(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.working_directory = os.getcwd()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.working_directory)
+        self.directory.cleanup()
+
+    def test_emails_that_failed_to_download_are_retried_by_the_next_run(self):
+        user_email = 'resume@example.com'
+        mailbox = generate_mailbox(200, user_email, 'Smith', seed=3)
+        gmail = FakeGmail(mailbox, user_email)
+        execute_get_batch = gmail_service._execute_get_batch
+        dropped = set()
+
+        def flaky_get_batch(gmail_handle, message_ids, **kwargs):
+            # Gmail gives up on the first five messages of every batch
+            fetched = execute_get_batch(gmail_handle, message_ids, **kwargs)
+            for message_id in message_ids[:5]:
+                if fetched.pop(message_id, None) is not None:
+                    dropped.add(message_id)
+            return fetched
+
+        with patch('src.gmail_service._execute_get_batch', side_effect=flaky_get_batch):
+            process_account(gmail, lambda: gmail, user_email, StubLanguageModelClient(), 'read', 'Ann', 'Smith')
+
+        ledger = open_ledger(user_email)
+        self.assertTrue(dropped)
+        self.assertEqual(set(ledger.in_flight()), dropped)
+        self.assertEqual(len(ledger), 200 - len(dropped))
+        self.assertIsNone(ledger.get_state('history_id'))
+        ledger.close()
+
+        process_account(gmail, lambda: gmail, user_email, StubLanguageModelClient(), 'read', 'Ann', 'Smith')
+
+        ledger = open_ledger(user_email)
+        self.assertEqual(ledger.in_flight(), [])
+        self.assertEqual(len(ledger), 200)
+        self.assertIsNotNone(ledger.get_state('history_id'))
+        ledger.close()
+        promotional = {message_id for message_id, message in mailbox.items() if message['promotional']}
+        self.assertEqual(set(gmail.actioned_ids()), promotional)
+
+    def test_emails_the_model_could_not_classify_wait_for_it(self):
+        user_email = 'outage@example.com'
+        mailbox = generate_mailbox(30, user_email, 'Smith', seed=5)
+        gmail = FakeGmail(mailbox, user_email)
+        failing_client = StubLanguageModelClient()
+        failing_client.create_chat_completion = MagicMock(side_effect=RuntimeError('429 Too Many Requests'))
+
+        # An outage longer than the retry limit on downloads
+        for _ in range(4):
+            process_account(gmail, lambda: gmail, user_email, failing_client, 'read', 'Ann', 'Smith')
+        ledger = open_ledger(user_email)
+        waiting = set(ledger.in_flight())
+        ledger.close()
+        self.assertTrue(waiting)
+        self.assertFalse(waiting & set(gmail.actioned_ids()))
+
+        process_account(gmail, lambda: gmail, user_email, StubLanguageModelClient(), 'read', 'Ann', 'Smith')
+
+        ledger = open_ledger(user_email)
+        self.assertEqual(ledger.in_flight(), [])
+        verdicts = dict(ledger._connection.execute("SELECT id, verdict FROM processed").fetchall())
+        ledger.close()
+        self.assertEqual(len(verdicts), 30)
+        self.assertNotIn(None, [verdicts[email_id] for email_id in waiting])
+        promotional = {message_id for message_id, message in mailbox.items() if message['promotional']}
+        self.assertEqual(set(gmail.actioned_ids()), promotional)
+
+    def test_emails_that_keep_failing_are_given_up_on(self):
+        ledger = Ledger(os.path.join(self.directory.name, 'ledger.sqlite3'))
+        ledger.mark_listed(['gone'])
+        for _ in range(3):
+            CheckpointedLister(make_lister(), ledger, '100')(None, None)
+
+        lister = CheckpointedLister(make_lister(), ledger, '100')
+
+        self.assertIn('gone', ledger)
+        self.assertEqual(ledger.in_flight(), [])
+        self.assertEqual(page_ids(lister(None, None)), (['id1', 'id2'], '0:page2'))
+        ledger.close()
+
+    def test_downloaded_emails_stay_in_flight_until_classified(self):
+        ledger = Ledger(os.path.join(self.directory.name, 'ledger.sqlite3'))
+        ledger.mark_listed(['unclassified'])
+        for _ in range(5):
+            CheckpointedLister(make_lister(), ledger, '100')(None, None)
+            # Downloaded every run, but the model could not be asked
+            ledger.mark_fetched(['unclassified'])
+
+        CheckpointedLister(make_lister(), ledger, '100')
+
+        self.assertNotIn('unclassified', ledger)
+        self.assertEqual(ledger.in_flight('fetched'), ['unclassified'])
+        ledger.close()
+
+    def test_actions_that_keep_failing_are_given_up_on(self):
+        ledger = Ledger(os.path.join(self.directory.name, 'ledger.sqlite3'))
+        ledger.mark_classified('gone', True)
+        for _ in range(3):
+            self.assertEqual(CheckpointedLister(make_lister(), ledger, '100').unfinished_actions(), ['gone'])
+
+        self.assertEqual(CheckpointedLister(make_lister(), ledger, '100').unfinished_actions(), [])
+        self.assertIn('gone', ledger)
+        ledger.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
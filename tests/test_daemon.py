@@ -0,0 +1,139 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from src.daemon import Account, Daemon, FairScheduler, ScheduledClient, load_daemon_config
+
+
+class TestFairScheduler(unittest.TestCase):
+
+    def test_waiting_accounts_take_turns(self):
+        scheduler = FairScheduler(slots=1)
+        order = []
+        started = []
+
+        def call(account):
+            started.append(account)
+            with scheduler.turn(account):
+                order.append(account)
+
+        with scheduler.turn('big'):
+            threads = []
+            # Four queued calls of the big account, then one of the small account
+            for account in ['big', 'big', 'big', 'big', 'small']:
+                thread = threading.Thread(target=call, args=(account,))
+                thread.start()
+                threads.append(thread)
+                while len(started) < len(threads):
+                    time.sleep(0.001)
+                time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(order[:2], ['big', 'small'])
+        self.assertEqual(sorted(order), ['big', 'big', 'big', 'big', 'small'])
+
+    def test_scheduled_client_shares_the_slots(self):
+        lock = threading.Lock()
+        active = [0]
+        peak = [0]
+
+        def create_chat_completion(messages, max_tokens):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+
+        client = MagicMock(model_name='model', max_concurrency=None)
+        client.create_chat_completion.side_effect = create_chat_completion
+        scheduler = FairScheduler(slots=2)
+        clients = [ScheduledClient(client, scheduler, name) for name in ('a', 'b', 'c')]
+        threads = [threading.Thread(target=c.create_chat_completion, args=([], 1)) for c in clients for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(client.create_chat_completion.call_count, 9)
+        self.assertLessEqual(peak[0], 2)
+
+    def test_scheduled_client_shares_the_slots_between_async_calls(self):
+        active = [0]
+        peak = [0]
+
+        async def acreate_chat_completion(messages, max_tokens):
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+            await asyncio.sleep(0.01)
+            active[0] -= 1
+            return 'completion'
+
+        client = MagicMock(model_name='model', max_concurrency=None)
+        client.acreate_chat_completion = AsyncMock(side_effect=acreate_chat_completion)
+        client.stats.return_value = {'Requests': 6}
+        scheduler = FairScheduler(slots=2)
+        clients = [ScheduledClient(client, scheduler, name) for name in ('a', 'b')]
+
+        async def run_all():
+            return await asyncio.gather(*(c.acreate_chat_completion([], 1) for c in clients for _ in range(3)))
+
+        self.assertEqual(asyncio.run(run_all()), ['completion'] * 6)
+        self.assertLessEqual(peak[0], 2)
+        self.assertEqual(clients[0].stats(), {'Requests': 6})
+        clients[0].close()
+        client.close.assert_not_called()
+
+    def test_scheduled_client_keeps_the_context_size(self):
+        client = MagicMock(model_name='model', max_concurrency=1, max_body_tokens=750, context_tokens=3584)
+
+        self.assertEqual(ScheduledClient(client, FairScheduler(slots=1), 'a').context_tokens, 3584)
+
+
+class TestDaemon(unittest.TestCase):
+
+    def test_polls_every_account_and_stops_running_pipelines(self):
+        accounts = [Account('a', 'a.json', 'Ann', 'Smith'), Account('b', 'b.json', 'Bob', 'Jones')]
+        processed = []
+        pipeline = MagicMock()
+        daemon = None
+
+        def process(account, on_pipeline):
+            processed.append(account.name)
+            on_pipeline(pipeline)
+            if len(processed) == 2:
+                daemon.stop()
+
+        daemon = Daemon(accounts, process)
+        daemon.run()
+
+        self.assertEqual(sorted(processed), ['a', 'b'])
+        pipeline.stop.assert_called()
+
+    def test_load_daemon_config(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'accounts.json')
+            with open(path, 'w') as file:
+                json.dump({'client_type': 'llama-2-7B', 'accounts': [
+                    {'name': 'a', 'token_path': 'a.json', 'user_first_name': 'Ann', 'user_last_name': 'Smith', 'poll_interval_minutes': 5}
+                ]}, file)
+            client_type, model_path_or_key, accounts = load_daemon_config(path)
+
+        self.assertEqual(client_type, 'llama-2-7B')
+        self.assertIsNone(model_path_or_key)
+        self.assertEqual(accounts[0].poll_interval_seconds, 300)
+        self.assertEqual(accounts[0].action, 'read')
+
+    def test_rejects_unknown_actions(self):
+        with self.assertRaises(ValueError):
+            Account('a', 'a.json', 'Ann', 'Smith', action='archive')
+
+
+if __name__ == '__main__':
+    unittest.main()
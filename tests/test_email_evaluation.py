@@ -0,0 +1,137 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from src.email_evaluation import BatchEvaluator, evaluate_email, evaluate_many, parse_batch_verdicts, prompt_version
+from src.metrics import metrics
+from src.verdict_cache import VerdictCache
+
+
+def make_email(subject):
+    return {'subject': subject, 'to': 'me@example.com', 'from': 'shop@example.com', 'cc': '', 'labels': ['INBOX'], 'body': f"Body of {subject}"}
+
+
+def completion(content):
+    return {'choices': [{'message': {'role': 'assistant', 'content': content}}]}
+
+
+class TestParseBatchVerdicts(unittest.TestCase):
+
+    def test_reads_numbered_lines_and_json(self):
+        self.assertEqual(parse_batch_verdicts("1: True\n2: false\nEmail 3: True", 3), {1: True, 2: False, 3: True})
+        self.assertEqual(parse_batch_verdicts('{"1": true, "2": false}', 2), {1: True, 2: False})
+
+    def test_drops_out_of_range_and_contradicted_numbers(self):
+        self.assertEqual(parse_batch_verdicts("1: True\n2: True\n2: False\n4: True", 3), {1: True})
+
+
+class TestEvaluateEmail(unittest.TestCase):
+
+    def test_failed_call_gives_no_verdict(self):
+        client = MagicMock()
+        client.create_chat_completion.side_effect = RuntimeError("429 Too Many Requests")
+        verdict_cache = MagicMock()
+        verdict_cache.get.return_value = None
+
+        self.assertIsNone(evaluate_email(make_email("a"), 'Ann', 'Smith', client, verdict_cache))
+        verdict_cache.put.assert_not_called()
+
+
+class TestEvaluateMany(unittest.TestCase):
+
+    def test_verdicts_keep_the_order_of_the_emails(self):
+        replies = {'a': "True", 'b': RuntimeError("429 Too Many Requests"), 'c': "False"}
+        # Later emails are answered first
+        delays = {'a': 0.03, 'b': 0.02, 'c': 0.0}
+
+        async def acreate_chat_completion(messages, max_tokens):
+            subject = messages[1]['content'].splitlines()[0].split(': ')[1]
+            await asyncio.sleep(delays[subject])
+            if isinstance(replies[subject], Exception):
+                raise replies[subject]
+            return completion(replies[subject])
+
+        client = MagicMock(model_name='gpt-test')
+        client.acreate_chat_completion = AsyncMock(side_effect=acreate_chat_completion)
+        verdict_cache = MagicMock()
+        verdict_cache.get.side_effect = lambda email_data: True if email_data['subject'] == 'cached' else None
+        emails = [make_email("a"), make_email("b"), make_email("cached"), make_email("c")]
+        completions_before = metrics.snapshot()['stages'].get('model_completion', {}).get('count', 0)
+
+        verdicts = asyncio.run(evaluate_many(emails, 'Ann', 'Smith', client, verdict_cache))
+
+        self.assertEqual(verdicts, [True, None, True, False])
+        self.assertEqual(client.acreate_chat_completion.await_count, 3)
+        self.assertEqual(sorted(call.args[0]['subject'] for call in verdict_cache.put.call_args_list), ['a', 'c'])
+        self.assertEqual(metrics.snapshot()['stages']['model_completion']['count'], completions_before + 2)
+
+
+class TestBatchEvaluator(unittest.TestCase):
+
+    def test_one_request_per_group(self):
+        client = MagicMock(context_tokens=None)
+        client.create_chat_completion.return_value = completion("1: True\n2: False\n3: True")
+        evaluator = BatchEvaluator('Ann', 'Smith', client, max_emails=3)
+
+        verdicts = evaluator.evaluate([make_email(f"email {i}") for i in range(3)])
+
+        self.assertEqual(verdicts, [True, False, True])
+        self.assertEqual(client.create_chat_completion.call_count, 1)
+        self.assertIn("Email 3:", client.create_chat_completion.call_args.kwargs['messages'][1]['content'])
+
+    def test_batch_verdicts_are_cached_apart_from_single_prompt_ones(self):
+        client = MagicMock(context_tokens=None, model_name='model')
+        client.create_chat_completion.side_effect = [completion("1: True\n2: maybe"), completion("False")]
+        with tempfile.TemporaryDirectory() as directory:
+            verdict_cache = VerdictCache(os.path.join(directory, 'verdicts.sqlite3'), model_name='model', prompt_version=prompt_version('Ann', 'Smith'))
+            emails = [make_email("a"), make_email("b")]
+            BatchEvaluator('Ann', 'Smith', client, verdict_cache, max_emails=2).evaluate(emails)
+
+            # A later single-email run only trusts the verdict the single-email prompt gave
+            self.assertIsNone(verdict_cache.get(emails[0]))
+            self.assertFalse(verdict_cache.get(emails[1]))
+            # A batch run reuses both
+            self.assertEqual(BatchEvaluator('Ann', 'Smith', client, verdict_cache, max_emails=2).evaluate(emails), [True, False])
+            self.assertEqual(client.create_chat_completion.call_count, 2)
+            verdict_cache.close()
+
+    def test_missing_verdicts_are_evaluated_on_their_own(self):
+        client = MagicMock(context_tokens=None)
+        client.create_chat_completion.side_effect = [completion("1: True\n2: maybe"), completion("False")]
+        evaluator = BatchEvaluator('Ann', 'Smith', client, max_emails=2)
+
+        verdicts = evaluator.evaluate([make_email("a"), make_email("b")])
+
+        self.assertEqual(verdicts, [True, False])
+        self.assertEqual(evaluator.fallback_emails, 1)
+        single_prompt = client.create_chat_completion.call_args_list[1].kwargs['messages'][1]['content']
+        self.assertTrue(single_prompt.startswith("Subject: b"))
+
+    def test_groups_stay_within_the_token_budget(self):
+        client = MagicMock(context_tokens=None)
+        client.create_chat_completion.return_value = completion("1: False\n2: False")
+        emails = [dict(make_email(str(i)), body="x" * 400) for i in range(4)]
+        evaluator = BatchEvaluator('Ann', 'Smith', client, max_emails=10, token_budget=250)
+
+        evaluator.evaluate(emails)
+
+        self.assertEqual(client.create_chat_completion.call_count, 2)
+
+    def test_groups_fit_the_context_of_a_local_model(self):
+        client = MagicMock(context_tokens=1024 + 250)
+        client.create_chat_completion.return_value = completion("1: False\n2: False")
+        emails = [dict(make_email(str(i)), body="x" * 400) for i in range(4)]
+        evaluator = BatchEvaluator('Ann', 'Smith', client, max_emails=10, token_budget=8000)
+
+        evaluator.evaluate(emails)
+
+        self.assertEqual(evaluator.token_budget, 250)
+        self.assertEqual(client.create_chat_completion.call_count, 2)
+        # Room for every verdict line of the group
+        self.assertEqual(client.create_chat_completion.call_args.kwargs['max_tokens'], 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
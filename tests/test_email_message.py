@@ -0,0 +1,61 @@
+import unittest
+from unittest.mock import patch
+
+from src.benchmark import generate_mailbox
+from src.email_message import EmailMessage
+from src.email_text import clean_body, extract_body
+
+
+class TestEmailMessage(unittest.TestCase):
+
+    def make_message(self, payload=None):
+        return EmailMessage('Weekly deals', 'me@example.com', 'Shop <news@shop.example>', labels=['UNREAD', 'CATEGORY_PROMOTIONS'], list_unsubscribe='<https://shop.example/u>', payload=payload)
+
+    def test_reads_like_the_parsed_dict(self):
+        email = self.make_message()
+
+        self.assertEqual(email['from'], 'Shop <news@shop.example>')
+        self.assertEqual(email.get('precedence'), None)
+        self.assertEqual(email.get('body', 'none'), 'none')
+        self.assertNotIn('body', email)
+        self.assertEqual(email, {
+            'subject': 'Weekly deals', 'to': 'me@example.com', 'from': 'Shop <news@shop.example>', 'cc': None,
+            'labels': ['UNREAD', 'CATEGORY_PROMOTIONS'], 'list_unsubscribe': '<https://shop.example/u>', 'precedence': None,
+        })
+        self.assertFalse(hasattr(email, '__dict__'))
+
+    def test_body_is_decoded_on_first_read(self):
+        message = next(iter(generate_mailbox(1, seed=4).values()))
+        email = self.make_message(payload=message['payload'])
+
+        with patch('src.email_message.clean_body', wraps=clean_body) as mock_clean_body:
+            self.assertIn('body', email)
+            mock_clean_body.assert_not_called()
+            self.assertEqual(email['body'], clean_body(extract_body(message['payload'])))
+            self.assertEqual(email['body'], clean_body(extract_body(message['payload'])))
+        mock_clean_body.assert_called_once()
+
+    def test_slim_payload_gives_the_same_body(self):
+        for message in generate_mailbox(40, seed=5).values():
+            self.assertEqual(self.make_message(payload=message['payload']).body, clean_body(extract_body(message['payload'])))
+
+    def test_body_can_be_set_as_text_or_payload(self):
+        email = self.make_message()
+        email['body'] = 'Plain text'
+        self.assertEqual(email['body'], 'Plain text')
+
+        email['body'] = {'mimeType': 'text/plain', 'body': {'data': 'SGVsbG8gdGhlcmU='}}
+        self.assertEqual(email['body'], 'Hello there')
+
+    def test_release_drops_the_body(self):
+        email = self.make_message()
+        email['body'] = 'Plain text'
+
+        email.release()
+
+        self.assertNotIn('body', email)
+        self.assertEqual(email['subject'], 'Weekly deals')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from src.benchmark import FakeGmail, generate_mailbox
+from src.email_processing import ActionQueue, apply_verdict, restore_emails
+from src.ledger import Ledger
+
+
+class TestActionQueue(unittest.TestCase):
+
+    def test_flushes_when_chunk_fills(self):
+        gmail = MagicMock()
+        queue = ActionQueue(gmail, 'read', chunk_size=2)
+
+        queue.add('id1')
+        gmail.users().messages().batchModify.assert_not_called()
+        queue.add('id2')
+
+        gmail.users().messages().batchModify.assert_called_once_with(
+            userId='me', body={'ids': ['id1', 'id2'], 'removeLabelIds': ['UNREAD']})
+        self.assertEqual(queue.succeeded, ['id1', 'id2'])
+
+    @patch('src.email_processing.time.monotonic')
+    def test_flushes_on_time_limit(self, mock_monotonic):
+        gmail = MagicMock()
+        queue = ActionQueue(gmail, 'delete', max_wait_seconds=10)
+
+        mock_monotonic.return_value = 100.0
+        queue.add('id1')
+        mock_monotonic.return_value = 105.0
+        queue.flush_if_due()
+        gmail.users().messages().batchDelete.assert_not_called()
+
+        mock_monotonic.return_value = 111.0
+        queue.flush_if_due()
+        gmail.users().messages().batchDelete.assert_called_once_with(userId='me', body={'ids': ['id1']})
+
+    def test_close_reports_failed_ids(self):
+        gmail = MagicMock()
+        gmail.users().messages().batchModify().execute.side_effect = HttpError(httplib2.Response({'status': 400}), b'bad request')
+        queue = ActionQueue(gmail, 'read')
+
+        queue.add('id1')
+        queue.add('id2')
+        succeeded, failed = queue.close()
+
+        self.assertEqual(succeeded, [])
+        self.assertEqual(failed, ['id1', 'id2'])
+
+    def test_reports_chunks_that_went_through(self):
+        gmail = MagicMock()
+        gmail.users().messages().batchModify().execute.side_effect = [{}, HttpError(httplib2.Response({'status': 400}), b'bad request')]
+        on_success = MagicMock()
+        queue = ActionQueue(gmail, 'read', chunk_size=2, on_success=on_success)
+
+        for message_id in ('id1', 'id2', 'id3'):
+            queue.add(message_id)
+        queue.close()
+
+        on_success.assert_called_once_with(['id1', 'id2'])
+
+    def test_a_bad_id_only_fails_itself(self):
+        gmail = MagicMock()
+
+        def batch_modify(userId, body):
+            request = MagicMock()
+            if 'gone' in body['ids']:
+                request.execute.side_effect = HttpError(httplib2.Response({'status': 400}), b'invalid id')
+            return request
+
+        gmail.users().messages().batchModify.side_effect = batch_modify
+        on_success = MagicMock()
+        queue = ActionQueue(gmail, 'read', on_success=on_success)
+
+        for message_id in ('id1', 'id2', 'gone', 'id3', 'id4'):
+            queue.add(message_id)
+        succeeded, failed = queue.close()
+
+        self.assertEqual(sorted(succeeded), ['id1', 'id2', 'id3', 'id4'])
+        self.assertEqual(failed, ['gone'])
+        self.assertEqual(sorted(message_id for call in on_success.call_args_list for message_id in call.args[0]), ['id1', 'id2', 'id3', 'id4'])
+
+
+class TestApplyVerdict(unittest.TestCase):
+
+    def test_queued_actions_are_recorded_once_their_bulk_call_went_through(self):
+        gmail = MagicMock()
+        gmail.users().messages().batchDelete().execute.side_effect = [{}, HttpError(httplib2.Response({'status': 400}), b'bad request')]
+        with tempfile.TemporaryDirectory() as directory:
+            ledger = Ledger(os.path.join(directory, 'ledger.sqlite3'))
+            queue = ActionQueue(gmail, 'delete', chunk_size=2, on_success=ledger.confirm_actions)
+            for message_id in ('id1', 'id2', 'id3', 'id4'):
+                apply_verdict(gmail, {'id': message_id}, {'from': 'shop', 'subject': 'Sale', 'body': ''}, True, 'delete', ledger, queue)
+            queue.close()
+            recorded = [details['id'] for details in ledger.iter_actions(with_contents=False)]
+            ledger.close()
+
+        self.assertEqual(recorded, ['id1', 'id2'])
+
+
+class TestRestoreEmails(unittest.TestCase):
+
+    def test_restores_in_chunks_and_resumes(self):
+        mailbox = generate_mailbox(2500)
+        gmail = FakeGmail(mailbox)
+        message_ids = list(mailbox)
+        gmail.users().messages().batchModify(userId='me', body={'ids': message_ids, 'removeLabelIds': ['UNREAD']}).execute()
+        with tempfile.TemporaryDirectory() as directory:
+            ledger = Ledger(os.path.join(directory, 'ledger.sqlite3'))
+            for message_id in message_ids:
+                ledger.record_action(message_id, 'read', 'shop', 'Sale', '')
+
+            restored, failed = restore_emails(lambda: gmail, ledger, message_ids[:1200], chunk_size=500)
+            pending = [details['id'] for details in ledger.iter_actions(action='read', restored=False, with_contents=False)]
+            ledger.close()
+
+        self.assertEqual((restored, failed), (1200, 0))
+        self.assertEqual(gmail.calls['messages.batchModify'], 1 + 3)
+        self.assertEqual(len(gmail.actioned_ids()), 1300)
+        self.assertEqual(pending, message_ids[1200:])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import base64
+import unittest
+
+from src.email_text import clean_body, extract_body, html_to_text, truncate_to_tokens
+
+
+def encoded(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+class TestExtractBody(unittest.TestCase):
+
+    def test_finds_plain_text_in_nested_multipart(self):
+        payload = {
+            'mimeType': 'multipart/mixed',
+            'parts': [
+                {'mimeType': 'multipart/alternative', 'parts': [
+                    {'mimeType': 'text/plain', 'body': {'data': encoded("Hi Ann, lunch on Friday?")}},
+                    {'mimeType': 'text/html', 'body': {'data': encoded("<p>Hi Ann, lunch on <b>Friday</b>?</p>")}},
+                ]},
+                {'mimeType': 'text/plain', 'filename': 'notes.txt', 'body': {'attachmentId': 'a1'}},
+            ]
+        }
+        self.assertEqual(extract_body(payload), "Hi Ann, lunch on Friday?")
+
+    def test_converts_html_only_mail(self):
+        html = "<html><head><style>p {color: red}</style></head><body><p>50% off&nbsp;today</p><div>Shop now</div></body></html>"
+        payload = {'mimeType': 'text/html', 'body': {'data': encoded(html)}}
+        self.assertEqual(clean_body(extract_body(payload)), "50% off today\n\nShop now")
+
+    def test_decodes_the_declared_charset(self):
+        payload = {
+            'mimeType': 'text/plain',
+            'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset="iso-8859-1"'}],
+            'body': {'data': base64.urlsafe_b64encode("Café".encode('iso-8859-1')).decode('ascii')},
+        }
+        self.assertEqual(extract_body(payload), "Café")
+
+
+class TestCleanBody(unittest.TestCase):
+
+    def test_drops_quotes_signatures_and_footers(self):
+        body = (
+            "Sounds good, see you then.\n"
+            "Track it here: https://click.example.com/ls/click?upn=abcdef123456\n"
+            "\n\n\n"
+            "On Mon, Jan 1, 2024 at 9:00 AM Bob <bob@example.com> wrote:\n"
+            "> Lunch on Friday?\n"
+        )
+        self.assertEqual(clean_body(body), "Sounds good, see you then.\nTrack it here: <click.example.com>")
+
+        promo = "Big sale this weekend\n--\nThe Shop team\n"
+        self.assertEqual(clean_body(promo), "Big sale this weekend")
+
+        footer = "New arrivals are in\nUnsubscribe | Privacy Policy\n© 2024 Shop Inc. All rights reserved."
+        self.assertEqual(clean_body(footer), "New arrivals are in\n[Unsubscribe link]")
+
+    def test_html_block_elements_become_lines(self):
+        self.assertEqual(html_to_text("<p>one</p><p>two<br>three</p>").split(), ["one", "two", "three"])
+
+
+class TestTruncateToTokens(unittest.TestCase):
+
+    def test_cuts_at_a_word_boundary_within_budget(self):
+        text = " ".join(f"word{i}" for i in range(1000))
+        truncated = truncate_to_tokens(text, 100, count_tokens=lambda t: len(t.split()))
+        self.assertTrue(truncated.endswith("..."))
+        self.assertLessEqual(len(truncated[:-3].split()), 100)
+        self.assertTrue(truncated[:-3].split()[-1].startswith("word"))
+
+    def test_body_starting_with_blank_lines(self):
+        text = " \n" * 500 + "Big sale " * 100
+        truncated = truncate_to_tokens(text, 50)
+        self.assertTrue(truncated.endswith("..."))
+        self.assertLessEqual(len(truncated), 50 * 4 + 3)
+
+    def test_short_text_is_unchanged(self):
+        self.assertEqual(truncate_to_tokens("short body", 100), "short body")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import base64
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+import httplib2
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpMockSequence
+
+from src.email_message import EmailMessage
+from src.gmail_service import FetchStats, IncrementalLister, SearchQuery, fetch_email_bodies, get_gmail_service, gmail_discovery_document, parse_email_batch
+
+
+def make_message(message_id, body='Hello there'):
+    return {
+        'id': message_id,
+        'labelIds': ['UNREAD', 'INBOX'],
+        'payload': {
+            'headers': [
+                {'name': 'Subject', 'value': f'Subject {message_id}'},
+                {'name': 'To', 'value': 'me@example.com'},
+                {'name': 'From', 'value': 'sender@example.com'},
+            ],
+            'parts': [
+                {'mimeType': 'text/plain', 'body': {'data': base64.urlsafe_b64encode(body.encode()).decode()}},
+            ],
+        },
+    }
+
+
+def http_error(status):
+    return HttpError(httplib2.Response({'status': status}), b'error')
+
+
+class FakeBatch:
+    def __init__(self, gmail, callback):
+        self.gmail = gmail
+        self.callback = callback
+        self.request_ids = []
+
+    def add(self, request, request_id=None):
+        self.request_ids.append(request_id)
+
+    def execute(self):
+        self.gmail.batches.append(list(self.request_ids))
+        for request_id in self.request_ids:
+            failures = self.gmail.failures.get(request_id, [])
+            if failures:
+                self.callback(request_id, None, http_error(failures.pop(0)))
+            else:
+                self.callback(request_id, make_message(request_id), None)
+
+
+def make_fake_gmail(failures=None):
+    gmail = MagicMock()
+    gmail.failures = failures or {}
+    gmail.batches = []
+    gmail.new_batch_http_request = lambda callback: FakeBatch(gmail, callback)
+    return gmail
+
+
+class TestParseEmailBatch(unittest.TestCase):
+
+    def test_parses_page_in_one_batch(self):
+        gmail = make_fake_gmail()
+        messages = [{'id': f'id{i}'} for i in range(3)]
+
+        parsed = parse_email_batch(gmail, messages)
+
+        self.assertEqual(len(gmail.batches), 1)
+        self.assertEqual(parsed['id1']['subject'], 'Subject id1')
+        self.assertEqual(parsed['id2']['body'], 'Hello there')
+
+    def test_splits_at_batch_size(self):
+        gmail = make_fake_gmail()
+        messages = [{'id': f'id{i}'} for i in range(5)]
+
+        parse_email_batch(gmail, messages, batch_size=2)
+
+        self.assertEqual([len(batch) for batch in gmail.batches], [2, 2, 1])
+
+    @patch('src.gmail_service.time.sleep')
+    def test_retries_only_throttled_items(self, mock_sleep):
+        gmail = make_fake_gmail(failures={'id1': [429, 503], 'id2': [404]})
+        messages = [{'id': f'id{i}'} for i in range(3)]
+
+        parsed = parse_email_batch(gmail, messages)
+
+        self.assertEqual(gmail.batches, [['id0', 'id1', 'id2'], ['id1'], ['id1']])
+        self.assertEqual(parsed['id1']['subject'], 'Subject id1')
+        self.assertNotIn('id2', parsed)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    def test_metadata_format_leaves_out_the_body(self):
+        gmail = make_fake_gmail()
+        messages = [{'id': f'id{i}'} for i in range(3)]
+        stats = FetchStats()
+
+        parsed = parse_email_batch(gmail, messages, format='metadata', stats=stats)
+
+        self.assertEqual(parsed['id1']['subject'], 'Subject id1')
+        self.assertNotIn('body', parsed['id1'])
+        get_kwargs = gmail.users().messages().get.call_args.kwargs
+        self.assertEqual(get_kwargs['format'], 'metadata')
+        self.assertIn('List-Unsubscribe', get_kwargs['metadataHeaders'])
+        self.assertEqual(stats.phases['metadata'][0], 3)
+
+    def test_fetches_bodies_of_the_given_messages(self):
+        gmail = make_fake_gmail()
+        stats = FetchStats()
+
+        payloads = fetch_email_bodies(gmail, ['id0', 'id2'], stats=stats)
+        email = EmailMessage('Subject', 'me@example.com', 'sender@example.com')
+        email['body'] = payloads['id2']
+
+        self.assertEqual(sorted(payloads), ['id0', 'id2'])
+        self.assertEqual(email['body'], 'Hello there')
+        self.assertEqual(gmail.batches, [['id0', 'id2']])
+        self.assertIn('fields', gmail.users().messages().get.call_args.kwargs)
+        self.assertEqual(stats.phases['bodies'][0], 2)
+
+    def test_records_the_size_of_the_batch_responses(self):
+        parts = [
+            f"--batch_boundary\r\nContent-Type: application/http\r\nContent-ID: <response-batch + {message_id}>\r\n\r\n"
+            f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{json.dumps(make_message(message_id))}\r\n"
+            for message_id in ('id0', 'id1')
+        ]
+        content = ("".join(parts) + "--batch_boundary--\r\n").encode()
+        http = HttpMockSequence([({'status': '200', 'content-type': 'multipart/mixed; boundary=batch_boundary'}, content)])
+        gmail = build_from_document(gmail_discovery_document(), http=http)
+        stats = FetchStats()
+
+        parsed = parse_email_batch(gmail, [{'id': 'id0'}, {'id': 'id1'}], stats=stats)
+
+        self.assertEqual(parsed['id1']['subject'], 'Subject id1')
+        self.assertEqual(stats.phases['full'][:2], [2, len(content)])
+
+
+class TestGetGmailService(unittest.TestCase):
+
+    @patch('googleapiclient.discovery_cache.get_static_doc', wraps=discovery_cache.get_static_doc)
+    @patch('google.oauth2.credentials.Credentials.from_authorized_user_file')
+    @patch('src.gmail_service.os.path.exists', return_value=True)
+    def test_builds_from_the_bundled_discovery_document_once(self, mock_exists, mock_from_file, mock_get_static_doc):
+        mock_from_file.return_value = MagicMock(valid=True, universe_domain='googleapis.com')
+
+        with patch('src.gmail_service._discovery_document', None):
+            first = get_gmail_service('token.json')
+            second = get_gmail_service('token.json')
+
+        self.assertTrue(hasattr(first.users(), 'messages'))
+        self.assertIsNot(first, second)
+        mock_get_static_doc.assert_called_once_with('gmail', 'v1')
+
+
+class TestSearchQuery(unittest.TestCase):
+
+    def test_without_terms_lists_everything(self):
+        self.assertEqual(SearchQuery().segments(), [None])
+
+    def test_categories_come_first_then_the_rest(self):
+        query = SearchQuery(max_age_days=90, exclude_labels=['Receipts', 'Work Stuff'], categories=['promotions', 'social'], extra='-from:me')
+
+        self.assertEqual(query.segments(), [
+            'newer_than:90d -label:Receipts -label:Work-Stuff -from:me category:promotions',
+            'newer_than:90d -label:Receipts -label:Work-Stuff -from:me category:social',
+            'newer_than:90d -label:Receipts -label:Work-Stuff -from:me -category:promotions -category:social',
+        ])
+
+
+class TestIncrementalLister(unittest.TestCase):
+
+    def test_lists_unread_messages_added_since_history_id(self):
+        gmail = MagicMock()
+        gmail.users().history().list().execute.return_value = {
+            'history': [
+                {'messagesAdded': [{'message': {'id': 'new', 'threadId': 't1', 'labelIds': ['UNREAD', 'INBOX']}}]},
+                {'messagesAdded': [{'message': {'id': 'sent', 'threadId': 't2', 'labelIds': ['SENT']}}]},
+            ],
+            'nextPageToken': 'next',
+        }
+        lister = IncrementalLister('100')
+
+        messages, page_token = lister(gmail, None)
+
+        self.assertEqual(messages, [{'id': 'new', 'threadId': 't1'}])
+        self.assertEqual(page_token, 'next')
+        self.assertTrue(lister.complete)
+        gmail.users().messages().list.assert_not_called()
+
+    def test_falls_back_to_full_scan_when_history_expired(self):
+        gmail = MagicMock()
+        gmail.users().history().list().execute.side_effect = http_error(404)
+        gmail.users().messages().list().execute.return_value = {'messages': [{'id': 'old'}]}
+        lister = IncrementalLister('100')
+
+        messages, page_token = lister(gmail, 'history-page-token')
+
+        self.assertEqual(messages, [{'id': 'old'}])
+        self.assertIsNone(page_token)
+        self.assertTrue(lister.full_scan)
+        self.assertTrue(lister.complete)
+        self.assertIsNone(gmail.users().messages().list.call_args.kwargs['pageToken'])
+
+    def test_history_skips_spam_and_trash(self):
+        gmail = MagicMock()
+        gmail.users().history().list().execute.return_value = {
+            'history': [{'messagesAdded': [{'message': {'id': 'spam', 'threadId': 't1', 'labelIds': ['UNREAD', 'SPAM']}}]}],
+        }
+
+        messages, _ = IncrementalLister('100')(gmail, None)
+
+        self.assertEqual(messages, [])
+
+    def test_full_scan_runs_each_search_in_order(self):
+        gmail = MagicMock()
+        gmail.users().messages().list().execute.side_effect = [
+            {'messages': [{'id': 'promo1'}], 'nextPageToken': 'p2'},
+            {'messages': [{'id': 'promo2'}]},
+            {'messages': [{'id': 'other'}]},
+        ]
+        gmail.users().messages().list.reset_mock()
+        lister = IncrementalLister(None, search_query=SearchQuery(max_age_days=30, categories=['promotions']))
+
+        pages = []
+        page_token = None
+        while True:
+            messages, page_token = lister(gmail, page_token)
+            pages.append([message['id'] for message in messages])
+            if not page_token:
+                break
+
+        self.assertEqual(pages, [['promo1'], ['promo2'], ['other']])
+        calls = [call.kwargs for call in gmail.users().messages().list.call_args_list]
+        self.assertEqual([call['q'] for call in calls], ['newer_than:30d category:promotions'] * 2 + ['newer_than:30d -category:promotions'])
+        self.assertEqual([call['pageToken'] for call in calls], [None, 'p2', None])
+        self.assertTrue(all(call['maxResults'] == 500 for call in calls))
+
+    def test_failed_listing_is_not_complete(self):
+        gmail = MagicMock()
+        gmail.users().messages().list().execute.side_effect = http_error(500)
+        lister = IncrementalLister(None)
+
+        self.assertEqual(lister(gmail, None), ([], None))
+        self.assertFalse(lister.complete)
+
+
+if __name__ == '__main__':
+    unittest.main()
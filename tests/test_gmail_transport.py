@@ -0,0 +1,74 @@
+import datetime
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from google.oauth2.credentials import Credentials
+
+from src.gmail_transport import GmailConnections, SharedCredentials
+
+
+def expired_credentials():
+    credentials = SharedCredentials(token='old', refresh_token='refresh', token_uri='https://oauth2.example/token', client_id='id', client_secret='secret')
+    credentials.expiry = datetime.datetime(2000, 1, 1)
+    return credentials
+
+
+def fake_refresh(credentials, request):
+    # A slow token endpoint, so every worker asks while the first refresh is under way
+    time.sleep(0.05)
+    credentials.token = 'new'
+    credentials.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+
+class TestSharedCredentials(unittest.TestCase):
+
+    @patch.object(Credentials, 'refresh', autospec=True, side_effect=fake_refresh)
+    def test_workers_share_one_refresh(self, mock_refresh):
+        with tempfile.TemporaryDirectory() as directory:
+            credentials = expired_credentials()
+            credentials.token_path = os.path.join(directory, 'token.json')
+            headers = []
+
+            def request():
+                request_headers = {}
+                credentials.before_request(MagicMock(), 'GET', 'https://gmail.googleapis.com/', request_headers)
+                headers.append(request_headers['authorization'])
+
+            workers = [threading.Thread(target=request) for _ in range(8)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            mock_refresh.assert_called_once()
+            self.assertEqual(credentials.refreshes, 1)
+            self.assertEqual(headers, ['Bearer new'] * 8)
+            with open(credentials.token_path) as token:
+                self.assertIn('"token": "new"', token.read())
+
+
+class TestGmailConnections(unittest.TestCase):
+
+    def test_one_handle_per_thread(self):
+        credentials = expired_credentials()
+        connections = GmailConnections(credentials, timeout=5)
+
+        first = connections()
+        self.assertIs(connections(), first)
+        handles = []
+        worker = threading.Thread(target=lambda: handles.append(connections()))
+        worker.start()
+        worker.join()
+
+        self.assertIsNot(handles[0], first)
+        self.assertIs(first._http.credentials, credentials)
+        self.assertIs(handles[0]._http.credentials, credentials)
+        self.assertEqual(first._http.http.timeout, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from openai import RateLimitError
+
+from concurrent.futures import ThreadPoolExecutor
+
+from src.language_model_client import PROMPT_OVERHEAD_TOKENS, AsyncOpenAIClient, HermesClient, LlamaClient, LlamaProcessPool, PromptPrefixCache, RateLimiter
+
+
+def rate_limit_error(retry_after):
+    response = MagicMock(status_code=429, headers={'retry-after': retry_after})
+    return RateLimitError("rate limited", response=response, body=None)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_waits_when_request_budget_is_spent(self):
+        async def scenario():
+            limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=100000)
+            limiter._request_allowance = 0
+            started = time.monotonic()
+            await limiter.acquire(10)
+            return time.monotonic() - started
+
+        # 600 requests per minute refill one request every 0.1s
+        self.assertGreaterEqual(asyncio.run(scenario()), 0.09)
+
+    def test_penalize_lowers_the_request_rate(self):
+        limiter = RateLimiter(requests_per_minute=100, tokens_per_minute=1000)
+        limiter.penalize(0.0)
+        self.assertEqual(limiter.requests_per_minute, 80)
+        limiter.reward()
+        self.assertEqual(limiter.requests_per_minute, 81)
+
+
+class TestAsyncOpenAIClient(unittest.TestCase):
+
+    @patch('openai.AsyncOpenAI')
+    def test_retries_after_rate_limit(self, mock_async_openai):
+        completion = MagicMock()
+        create = AsyncMock(side_effect=[rate_limit_error('0.05'), completion])
+        mock_async_openai.return_value.chat.completions.create = create
+        mock_async_openai.return_value.close = AsyncMock()
+
+        client = AsyncOpenAIClient(api_key='key')
+        started = time.monotonic()
+        result = client.create_chat_completion(messages=[{'role': 'user', 'content': 'hi'}], max_tokens=1)
+        elapsed = time.monotonic() - started
+        client.close()
+
+        self.assertIs(result, completion)
+        self.assertEqual(create.await_count, 2)
+        self.assertGreaterEqual(elapsed, 0.05)
+
+    @patch('openai.AsyncOpenAI')
+    def test_concurrency_is_bounded(self, mock_async_openai):
+        active = [0]
+        peak = [0]
+
+        async def create(**kwargs):
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+            await asyncio.sleep(0.01)
+            active[0] -= 1
+            return MagicMock()
+
+        mock_async_openai.return_value.chat.completions.create = create
+        mock_async_openai.return_value.close = AsyncMock()
+
+        client = AsyncOpenAIClient(api_key='key', max_concurrency=3)
+
+        async def run_many():
+            return await asyncio.gather(*(
+                client.acreate_chat_completion(messages=[{'role': 'user', 'content': 'hi'}], max_tokens=1)
+                for _ in range(10)
+            ))
+
+        results = asyncio.run(run_many())
+        client.close()
+
+        self.assertEqual(len(results), 10)
+        self.assertLessEqual(peak[0], 3)
+
+
+class FakeState:
+    def __init__(self, n_tokens):
+        self.n_tokens = n_tokens
+
+
+class FakeLlama:
+    """Renders 'system tokens + [0] + user tokens' and records what the cache does with it."""
+
+    def __init__(self):
+        self.input_ids = []
+        self.n_tokens = 0
+        self.completions = 0
+        self.loaded_state = None
+
+    def create_chat_completion(self, messages, max_tokens, temperature):
+        self.completions += 1
+        self.input_ids = [ord(c) for c in messages[0]['content']] + [0] + [ord(c) for c in messages[1]['content']] + [1]
+        self.n_tokens = len(self.input_ids)
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens):
+        self.n_tokens = len(tokens)
+
+    def save_state(self):
+        return FakeState(self.n_tokens)
+
+    def load_state(self, state):
+        self.loaded_state = state
+
+
+class TestPromptPrefixCache(unittest.TestCase):
+
+    def test_prefix_is_evaluated_once_and_restored_on_the_next_start(self):
+        with tempfile.TemporaryDirectory() as directory:
+            llama = FakeLlama()
+            cache = PromptPrefixCache(directory, 'model.gguf', 'chatml')
+            cache.prepare(llama, 'system')
+            cache.prepare(llama, 'system')
+
+            self.assertEqual(cache.prefix_length, len('system') + 1)
+            self.assertEqual(llama.completions, 2)
+            self.assertEqual(len(os.listdir(directory)), 1)
+
+            restarted_llama = FakeLlama()
+            restarted = PromptPrefixCache(directory, 'model.gguf', 'chatml')
+            restarted.prepare(restarted_llama, 'system')
+
+            self.assertEqual(restarted_llama.completions, 0)
+            self.assertEqual(restarted_llama.loaded_state.n_tokens, len('system') + 1)
+
+    def test_changed_prompt_is_not_served_from_the_saved_state(self):
+        with tempfile.TemporaryDirectory() as directory:
+            PromptPrefixCache(directory, 'model.gguf', 'chatml').prepare(FakeLlama(), 'Hello Ann')
+
+            llama = FakeLlama()
+            cache = PromptPrefixCache(directory, 'model.gguf', 'chatml')
+            cache.prepare(llama, 'Hello Bob')
+
+            self.assertIsNone(llama.loaded_state)
+            self.assertEqual(llama.completions, 2)
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+
+class TestLlamaClients(unittest.TestCase):
+
+    def test_completion_length_follows_the_request(self):
+        # llama_cpp is optional, the clients only need its Llama class
+        llama_cpp = MagicMock()
+        mock_llama = llama_cpp.Llama
+        with patch.dict(sys.modules, {'llama_cpp': llama_cpp}):
+            self._check_completion_length(mock_llama)
+
+    def _check_completion_length(self, mock_llama):
+        for client_class, single_verdict_tokens in ((HermesClient, 3), (LlamaClient, 2)):
+            with tempfile.TemporaryDirectory() as directory:
+                client = client_class('model.gguf', n_ctx=2048, n_batch=512, chat_format='chatml', verbose=False, prefix_cache_dir=directory)
+            client.prefix_cache = MagicMock()
+            messages = [{'role': 'system', 'content': 'system'}, {'role': 'user', 'content': 'email'}]
+
+            client.create_chat_completion(messages, max_tokens=1)
+            self.assertEqual(mock_llama.return_value.create_chat_completion.call_args.kwargs['max_tokens'], single_verdict_tokens)
+            client.create_chat_completion(messages, max_tokens=64)
+            self.assertEqual(mock_llama.return_value.create_chat_completion.call_args.kwargs['max_tokens'], 64)
+            self.assertEqual(client.context_tokens, 2048)
+            self.assertEqual(client.max_body_tokens, min(750, 2048 - PROMPT_OVERHEAD_TOKENS))
+
+
+class EchoClient:
+    """Stands in for a llama.cpp client inside the pool's worker processes."""
+
+    def __init__(self, crash_marker, n_threads):
+        self.crash_marker = crash_marker
+        self.n_threads = n_threads
+
+    def create_chat_completion(self, messages, max_tokens):
+        content = messages[-1]['content']
+        # Dies on the first 'crash' request only, so the retry after the restart succeeds
+        if content == 'crash' and not os.path.exists(self.crash_marker):
+            open(self.crash_marker, 'w').close()
+            os._exit(1)
+        return {'content': content, 'pid': os.getpid(), 'n_threads': self.n_threads}
+
+
+class TestLlamaProcessPool(unittest.TestCase):
+
+    def test_results_match_their_requests(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pool = LlamaProcessPool(EchoClient, 'echo', 2, {'crash_marker': os.path.join(directory, 'crashed')})
+            with ThreadPoolExecutor(max_workers=4) as threads:
+                results = list(threads.map(
+                    lambda i: pool.create_chat_completion([{'role': 'user', 'content': str(i)}], max_tokens=1),
+                    range(20)
+                ))
+            pool.close()
+
+        self.assertEqual([result['content'] for result in results], [str(i) for i in range(20)])
+        self.assertEqual(results[0]['n_threads'], max(1, (os.cpu_count() or 1) // 2))
+        self.assertEqual(pool.max_concurrency, 2)
+
+    def test_pool_is_restarted_after_a_worker_dies(self):
+        with tempfile.TemporaryDirectory() as directory:
+            pool = LlamaProcessPool(EchoClient, 'echo', 2, {'crash_marker': os.path.join(directory, 'crashed')})
+            result = pool.create_chat_completion([{'role': 'user', 'content': 'crash'}], max_tokens=1)
+            pool.close()
+
+        self.assertEqual(result['content'], 'crash')
+        self.assertEqual(pool.restarts, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import json
+import os
+import tempfile
+import unittest
+
+from src.ledger import Ledger
+
+
+class TestLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'ledger.sqlite3')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_processed_ids_survive_reopen(self):
+        ledger = Ledger(self.path)
+        ledger.mark_processed('id1', True)
+        ledger.mark_processed('id2', False)
+        ledger.close()
+
+        ledger = Ledger(self.path)
+        self.assertIn('id1', ledger)
+        self.assertIn('id2', ledger)
+        self.assertNotIn('id3', ledger)
+        self.assertEqual(len(ledger), 2)
+        ledger.close()
+
+    def test_emails_stay_in_flight_until_processed(self):
+        ledger = Ledger(self.path)
+        ledger.mark_processed('id0', False)
+        self.assertEqual(ledger.mark_listed(['id0', 'id1', 'id2', 'id3', 'id1']), ['id1', 'id2', 'id3'])
+        self.assertEqual(ledger.mark_listed(['id1']), [])
+        ledger.mark_fetched(['id2', 'id3'])
+        ledger.mark_classified('id3', True)
+        ledger.mark_processed('id2', False)
+        ledger.close()
+
+        ledger = Ledger(self.path)
+        self.assertEqual(ledger.in_flight('listed'), ['id1'])
+        self.assertEqual(ledger.in_flight('fetched'), [])
+        self.assertEqual(ledger.in_flight('classified'), ['id3'])
+        self.assertTrue(ledger.is_in_flight('id3'))
+        self.assertNotIn('id3', ledger)
+
+        ledger.mark_processed_many(['id1', 'id3'], True)
+        self.assertEqual(ledger.in_flight(), [])
+        self.assertIn('id3', ledger)
+        ledger.close()
+
+    def test_actions_can_be_queried(self):
+        ledger = Ledger(self.path, run_id='run1')
+        ledger.record_action('id1', 'read', 'Shop <deals@shop.example>', 'Sale', 'Everything must go')
+        ledger.record_action('id2', 'read', 'Friend <friend@mail.example>', 'Hi', 'Lunch?')
+
+        actions = list(ledger.iter_actions(sender_pattern='%@shop.example%'))
+        self.assertEqual([action['id'] for action in actions], ['id1'])
+        self.assertEqual(actions[0]['email_contents'], 'Everything must go')
+        self.assertEqual(len(list(ledger.iter_actions(run_id='run1'))), 2)
+        self.assertEqual(list(ledger.iter_actions(run_id='run2')), [])
+        ledger.close()
+
+    def test_lists_the_runs_that_actioned_emails(self):
+        ledger = Ledger(self.path, run_id='run1')
+        ledger.record_action('id1', 'read', 'shop', 'Sale', '')
+        ledger.record_action('id2', 'delete', 'shop', 'Sale', '')
+        ledger.record_action('id3', 'read', 'shop', 'Sale', '', run_id='run2')
+        ledger.record_action('id4', 'read', 'shop', 'Sale', '', run_id='run2', pending=True)
+        ledger.mark_restored(['id1'])
+
+        runs = ledger.runs()
+        ledger.close()
+
+        self.assertEqual([(run['run_id'], run['read'], run['deleted'], run['restored']) for run in runs], [('run1', 1, 1, 1), ('run2', 1, 0, 0)])
+
+    def test_pending_actions_count_once_confirmed(self):
+        ledger = Ledger(self.path, run_id='run1')
+        ledger.record_action('id1', 'delete', 'shop', 'Sale', 'Body', pending=True)
+        ledger.record_action('id2', 'delete', 'shop', 'Sale', 'Body', pending=True)
+        self.assertEqual(list(ledger.iter_actions()), [])
+
+        ledger.confirm_actions(['id2'])
+        ledger.close()
+
+        ledger = Ledger(self.path)
+        self.assertEqual([action['id'] for action in ledger.iter_actions(action='delete')], ['id2'])
+        ledger.close()
+
+    def test_migrates_legacy_json_files_once(self):
+        processed_file = os.path.join(self.directory.name, 'processed_emails.json')
+        details_file = os.path.join(self.directory.name, 'processed_emails_details.json')
+        with open(processed_file, 'w') as file:
+            json.dump({'id1': True, 'id2': True}, file)
+        with open(details_file, 'w') as file:
+            json.dump([{'id': 'id1', 'subject': 'Sale', 'from': 'shop', 'email_contents': 'Body', 'action': 'read'}], file)
+
+        ledger = Ledger(self.path)
+        ledger.migrate_legacy_files(processed_file, details_file)
+        ledger.migrate_legacy_files(processed_file, details_file)
+
+        self.assertIn('id2', ledger)
+        self.assertEqual([action['email_contents'] for action in ledger.iter_actions()], ['Body'])
+        self.assertFalse(os.path.exists(processed_file))
+        self.assertTrue(os.path.exists(processed_file + '.migrated'))
+        ledger.close()
+
+    def test_migration_keeps_verdicts_and_drops_the_old_marker(self):
+        verdicts = {}
+        for name, processed_emails in (('verdicts', {'id1': True, 'id2': False}), ('markers', {'id3': True, 'id4': True})):
+            processed_file = os.path.join(self.directory.name, f'processed_emails_{name}.json')
+            details_file = os.path.join(self.directory.name, f'processed_emails_details_{name}.json')
+            with open(processed_file, 'w') as file:
+                json.dump(processed_emails, file)
+            with open(details_file, 'w') as file:
+                json.dump([{'id': 'id4', 'subject': 'Sale', 'from': 'shop', 'email_contents': 'Body', 'action': 'read'}] if name == 'markers' else [], file)
+            ledger = Ledger(os.path.join(self.directory.name, f'ledger_{name}.sqlite3'))
+            ledger.migrate_legacy_files(processed_file, details_file)
+            verdicts.update(ledger._connection.execute("SELECT id, verdict FROM processed").fetchall())
+            ledger.close()
+
+        # Files with verdicts keep them; in the oldest files True only means the email was looked at,
+        # unless it was actioned
+        self.assertEqual(verdicts, {'id1': 1, 'id2': 0, 'id3': None, 'id4': 1})
+
+    def test_bodies_go_to_the_recovery_log(self):
+        recovery_dir = os.path.join(self.directory.name, 'recovery')
+        ledger = Ledger(self.path, run_id='run1', recovery_dir=recovery_dir)
+        for i in range(200):
+            ledger.record_action(f'id{i}', 'read', 'Shop <deals@shop.example>', f'Sale {i}', f'Body {i}')
+        ledger.close()
+
+        ledger = Ledger(self.path, recovery_dir=recovery_dir)
+        actions = list(ledger.iter_actions())
+        self.assertEqual(len(actions), 200)
+        self.assertEqual(actions[150]['email_contents'], 'Body 150')
+        self.assertNotIn('email_contents', next(ledger.iter_actions(with_contents=False)))
+        self.assertIsNone(ledger._connection.execute("SELECT body FROM actions LIMIT 1").fetchone()[0])
+        self.assertTrue(os.listdir(recovery_dir)[0].endswith('.jsonl.gz'))
+        ledger.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
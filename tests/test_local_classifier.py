@@ -0,0 +1,65 @@
+import os
+import random
+import tempfile
+import unittest
+
+from src.local_classifier import LinearEmailClassifier, parse_prompt_email
+
+PROMOTIONAL_WORDS = "sale discount offer deal save unsubscribe shop now limited coupon".split()
+PERSONAL_WORDS = "hey lunch tomorrow dinner call weekend photos thanks see you".split()
+
+
+def make_samples(count, seed=0):
+    rng = random.Random(seed)
+    emails, verdicts = [], []
+    for _ in range(count):
+        promotional = rng.random() < 0.5
+        words = PROMOTIONAL_WORDS if promotional else PERSONAL_WORDS
+        emails.append({
+            'from': f'Shop <deals@shop{rng.randint(0, 9)}.example>' if promotional else f'Friend <friend{rng.randint(0, 99)}@gmail.com>',
+            'subject': ' '.join(rng.choices(words, k=4)),
+            'body': ' '.join(rng.choices(words, k=40)),
+            'labels': ['UNREAD', 'CATEGORY_PROMOTIONS'] if promotional else ['UNREAD'],
+        })
+        verdicts.append(promotional)
+    return emails, verdicts
+
+
+class TestLinearEmailClassifier(unittest.TestCase):
+
+    def test_learns_verdicts_and_survives_save_and_load(self):
+        emails, verdicts = make_samples(600)
+        classifier = LinearEmailClassifier(n_features=2 ** 16).fit(emails[:500], verdicts[:500])
+
+        metrics = classifier.evaluate(emails[500:], verdicts[500:])
+        self.assertGreater(metrics['agreement'], 0.95)
+        self.assertGreater(metrics['coverage'], 0.5)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'classifier.npz')
+            classifier.save(path)
+            loaded = LinearEmailClassifier.load(path)
+        self.assertEqual(loaded.predict(emails[500:520]), classifier.predict(emails[500:520]))
+
+    def test_untrained_classifier_is_never_confident(self):
+        emails, _ = make_samples(10)
+        self.assertEqual(LinearEmailClassifier(n_features=2 ** 16).predict(emails), [None] * 10)
+
+    def test_parse_prompt_email(self):
+        content = (
+            "Subject: Big sale\n"
+            "To: me@example.com\n"
+            "From: Shop <deals@shop.example>\n"
+            "Cc: None\n"
+            "Gmail labels: ['UNREAD', 'CATEGORY_PROMOTIONS']\n"
+            "Body: Everything\nmust go"
+        )
+        email_data = parse_prompt_email(content)
+        self.assertEqual(email_data['subject'], 'Big sale')
+        self.assertEqual(email_data['from'], 'Shop <deals@shop.example>')
+        self.assertEqual(email_data['labels'], ['UNREAD', 'CATEGORY_PROMOTIONS'])
+        self.assertEqual(email_data['body'], 'Everything\nmust go')
+
+
+if __name__ == '__main__':
+    unittest.main()
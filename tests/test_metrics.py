@@ -0,0 +1,98 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+import urllib.request
+
+from src.metrics import Histogram, Metrics, MetricsServer, in_current_run
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles_fall_in_the_right_bucket(self):
+        histogram = Histogram()
+        for _ in range(90):
+            histogram.observe(0.004)
+        for _ in range(10):
+            histogram.observe(2.0)
+
+        self.assertTrue(0.0025 <= histogram.percentile(0.5) <= 0.005)
+        self.assertTrue(1.0 <= histogram.percentile(0.95) <= 2.0)
+        self.assertEqual(histogram.percentile(0.99), 2.0)
+        self.assertEqual(histogram.count, 100)
+
+    def test_empty_histogram(self):
+        self.assertEqual(Histogram().percentile(0.5), 0.0)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        with self.metrics.time('parse'):
+            pass
+        self.metrics.observe('model_completion', 0.3)
+        self.metrics.increment('verdict_cache_hits', 2)
+        self.metrics.record_tokens('gpt-4-1106-preview', 120, 1)
+        self.metrics.record_tokens('gpt-4-1106-preview', 80, 1)
+
+    def test_report_and_json(self):
+        report = self.metrics.report()
+        self.assertIn('model_completion p50/p95/p99', report)
+        self.assertEqual(report['Tokens in/out (gpt-4-1106-preview)'], "200/2 in 2 requests")
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics', 'metrics.json')
+            self.metrics.write_json(path, {'emails_processed': 3})
+            with open(path) as file:
+                data = json.load(file)
+        self.assertEqual(data['stages']['parse']['count'], 1)
+        self.assertEqual(data['counters']['verdict_cache_hits'], 2)
+        self.assertEqual(data['report']['emails_processed'], 3)
+
+    def test_prometheus_endpoint(self):
+        server = MetricsServer(self.metrics, 0).start()
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.port}/metrics') as response:
+                text = response.read().decode('utf-8')
+        finally:
+            server.close()
+
+        self.assertIn('zinbo_stage_seconds_bucket{stage="model_completion",le="0.5"} 1', text)
+        self.assertIn('zinbo_stage_seconds_count{stage="parse"} 1', text)
+        self.assertIn('zinbo_events_total{event="verdict_cache_hits"} 2', text)
+        self.assertIn('zinbo_model_tokens_total{backend="gpt-4-1106-preview",direction="in"} 200', text)
+
+    def test_runs_of_concurrent_accounts_are_kept_apart(self):
+        runs = {}
+
+        def account_run(name, completions):
+            with self.metrics.run() as run_metrics:
+                def worker():
+                    for _ in range(completions):
+                        self.metrics.observe('model_completion', 0.1)
+                        self.metrics.record_tokens('model', 10, 1)
+                workers = [threading.Thread(target=in_current_run(worker)) for _ in range(2)]
+                for thread in workers:
+                    thread.start()
+                for thread in workers:
+                    thread.join()
+            runs[name] = run_metrics.snapshot()
+
+        accounts = [threading.Thread(target=account_run, args=('a', 3)), threading.Thread(target=account_run, args=('b', 5))]
+        for thread in accounts:
+            thread.start()
+        for thread in accounts:
+            thread.join()
+
+        self.assertEqual(runs['a']['stages']['model_completion']['count'], 6)
+        self.assertEqual(runs['b']['tokens']['model']['requests'], 10)
+        self.assertNotIn('parse', runs['a']['stages'])
+        # The process-wide metrics keep everything, setUp's observation included
+        self.assertEqual(self.metrics.snapshot()['stages']['model_completion']['count'], 1 + 16)
+        self.assertGreaterEqual(runs['a']['started_at'], self.metrics.started_at)
+
+
+if __name__ == '__main__':
+    unittest.main()
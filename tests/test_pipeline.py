@@ -0,0 +1,293 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from src.email_message import EmailMessage
+from src.email_processing import ActionQueue
+from src.pipeline import EmailPipeline
+
+
+def make_pages(page_count, page_size):
+    pages = {}
+    for page in range(page_count):
+        token = None if page == 0 else f'token{page}'
+        next_token = f'token{page + 1}' if page + 1 < page_count else None
+        pages[token] = ([{'id': f'id{page}-{i}'} for i in range(page_size)], next_token)
+    return pages
+
+
+class TestEmailPipeline(unittest.TestCase):
+
+    def test_processes_every_unprocessed_email(self):
+        pages = make_pages(3, 10)
+        acted = {}
+
+        pipeline = EmailPipeline(
+            gmail_factory=MagicMock,
+            list_page=lambda gmail, token: pages[token],
+            fetch_messages=lambda gmail, messages: {m['id']: {'subject': m['id']} for m in messages},
+            classify=lambda email: email['subject'].endswith('0'),
+            act=lambda message_info, email, verdict: acted.__setitem__(message_info['id'], verdict),
+            is_processed=lambda email_id: email_id.startswith('id1-'),
+            fetch_workers=3,
+            classify_workers=3,
+            queue_size=4,
+            fetch_chunk_size=4,
+        )
+        pipeline.run()
+
+        self.assertEqual(pipeline.total_pages_fetched, 3)
+        self.assertEqual(pipeline.total_unread_emails, 30)
+        self.assertEqual(len(acted), 20)
+        self.assertTrue(acted['id0-0'])
+        self.assertFalse(acted['id2-1'])
+        self.assertNotIn('id1-0', acted)
+
+    def test_classifier_concurrency_is_bounded(self):
+        pages = make_pages(1, 20)
+        lock = threading.Lock()
+        active = [0]
+        peak = [0]
+
+        def classify(email):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+            return False
+
+        pipeline = EmailPipeline(
+            gmail_factory=MagicMock,
+            list_page=lambda gmail, token: pages[token],
+            fetch_messages=lambda gmail, messages: {m['id']: {} for m in messages},
+            classify=classify,
+            act=lambda message_info, email, verdict: None,
+            classify_workers=2,
+        )
+        pipeline.run()
+
+        self.assertEqual(pipeline.total_emails_processed, 20)
+        self.assertLessEqual(peak[0], 2)
+
+    def test_queued_actions_go_out_while_the_classifiers_are_slow(self):
+        flushed = threading.Event()
+        gmail = MagicMock()
+        action_queue = ActionQueue(gmail, 'read', max_wait_seconds=0.05, on_success=lambda message_ids: flushed.set())
+
+        def classify(email):
+            if email['subject'] == 'promo':
+                return True
+            # Only an idle flush can send the promotional email while this one is being classified
+            return not flushed.wait(timeout=2)
+
+        pipeline = EmailPipeline(
+            gmail_factory=MagicMock,
+            list_page=lambda gmail, token: ([{'id': 'promo'}, {'id': 'slow'}], None),
+            fetch_messages=lambda gmail, messages: {m['id']: {'subject': m['id']} for m in messages},
+            classify=classify,
+            act=lambda message_info, email, verdict: action_queue.add(message_info['id']) if verdict else None,
+            on_idle=action_queue.flush_if_due,
+            idle_seconds=0.01,
+            classify_workers=1,
+        )
+        pipeline.run()
+
+        self.assertTrue(flushed.is_set())
+        self.assertEqual(action_queue.succeeded, ['promo'])
+        self.assertEqual(action_queue.pending, [])
+
+    def test_failed_items_do_not_stop_the_pipeline(self):
+        pages = make_pages(1, 5)
+
+        def classify(email):
+            raise RuntimeError("model unavailable")
+
+        acted = []
+        pipeline = EmailPipeline(
+            gmail_factory=MagicMock,
+            list_page=lambda gmail, token: pages[token],
+            fetch_messages=lambda gmail, messages: {m['id']: {} for m in messages},
+            classify=classify,
+            act=lambda message_info, email, verdict: acted.append(verdict),
+        )
+        pipeline.run()
+
+        self.assertEqual(acted, [])
+        self.assertEqual(pipeline.unfinished_emails, 5)
+        self.assertEqual(len(pipeline.errors), 5)
+
+    def test_emails_that_failed_to_download_are_left_unfinished(self):
+        pages = make_pages(1, 6)
+        acted = []
+        pipeline = EmailPipeline(
+            gmail_factory=MagicMock,
+            list_page=lambda gmail, token: pages[token],
+            fetch_messages=lambda gmail, messages: {m['id']: {'subject': m['id']} for m in messages if m['id'] != 'id0-1'},
+            classify=lambda email: None if email['subject'] == 'id0-5' else False,
+            act=lambda message_info, email, verdict: acted.append(message_info['id']),
+            classify_metadata=lambda emails: [None] * len(emails),
+            fetch_bodies=lambda gmail, message_ids: {message_id: 'Body' for message_id in message_ids if message_id != 'id0-3'},
+        )
+        pipeline.run()
+
+        self.assertEqual(sorted(acted), ['id0-0', 'id0-2', 'id0-4'])
+        self.assertEqual(pipeline.unfinished_emails, 3)
+
+    def test_confident_batch_verdicts_skip_the_classifiers(self):
+        pages = make_pages(1, 6)
+        classified = []
+        acted = {}
+
+        def classify(email):
+            classified.append(email['subject'])
+            return False
+
+        pipeline = EmailPipeline(
+            gmail_factory=MagicMock,
+            list_page=lambda gmail, token: pages[token],
+            fetch_messages=lambda gmail, messages: {m['id']: {'subject': m['id']} for m in messages},
+            classify=classify,
+            act=lambda message_info, email, verdict: acted.__setitem__(message_info['id'], verdict),
+            classify_batch=lambda emails: [True if email['subject'] in ('id0-0', 'id0-1') else None for email in emails],
+        )
+        pipeline.run()
+
+        self.assertEqual(sorted(classified), ['id0-2', 'id0-3', 'id0-4', 'id0-5'])
+        self.assertTrue(acted['id0-0'])
+        self.assertEqual(len(acted), 6)
+
+    def test_classify_many_receives_groups(self):
+        pages = make_pages(1, 12)
+        group_sizes = []
+
+        def classify_many(emails):
+            group_sizes.append(len(emails))
+            return [True] * len(emails)
+
+        acted = {}
+        pipeline = EmailPipeline(
+            gmail_factory=MagicMock,
+            list_page=lambda gmail, token: pages[token],
+            fetch_messages=lambda gmail, messages: {m['id']: {'subject': m['id']} for m in messages},
+            classify=lambda email: self.fail("classify_many should be used"),
+            act=lambda message_info, email, verdict: acted.__setitem__(message_info['id'], verdict),
+            classify_many=classify_many,
+            classify_group_size=5,
+            classify_workers=1,
+        )
+        pipeline.run()
+
+        self.assertEqual(len(acted), 12)
+        self.assertTrue(all(acted.values()))
+        self.assertEqual(sum(group_sizes), 12)
+        self.assertLessEqual(max(group_sizes), 5)
+
+    def test_bodies_are_fetched_only_for_unsettled_emails(self):
+        pages = make_pages(1, 6)
+        body_requests = []
+        classified = {}
+        acted = {}
+
+        def fetch_bodies(gmail, message_ids):
+            body_requests.extend(message_ids)
+            return {message_id: f'body of {message_id}' for message_id in message_ids}
+
+        pipeline = EmailPipeline(
+            gmail_factory=MagicMock,
+            list_page=lambda gmail, token: pages[token],
+            fetch_messages=lambda gmail, messages: {m['id']: {'subject': m['id']} for m in messages},
+            classify=lambda email: classified.setdefault(email['subject'], email.get('body')) is None,
+            act=lambda message_info, email, verdict: acted.__setitem__(message_info['id'], verdict),
+            classify_metadata=lambda emails: [True if email['subject'] == 'id0-0' else None for email in emails],
+            fetch_bodies=fetch_bodies,
+        )
+        pipeline.run()
+
+        self.assertEqual(sorted(body_requests), [f'id0-{i}' for i in range(1, 6)])
+        self.assertEqual(classified['id0-3'], 'body of id0-3')
+        self.assertNotIn('id0-0', classified)
+        self.assertTrue(acted['id0-0'])
+        self.assertEqual(len(acted), 6)
+
+    def test_cluster_verdicts_skip_the_classifiers(self):
+        pages = make_pages(1, 6)
+        classified = []
+        acted = {}
+
+        pipeline = EmailPipeline(
+            gmail_factory=MagicMock,
+            list_page=lambda gmail, token: pages[token],
+            fetch_messages=lambda gmail, messages: {m['id']: {'subject': m['id']} for m in messages},
+            classify=lambda email: classified.append(email['subject']) or False,
+            act=lambda message_info, email, verdict: acted.__setitem__(message_info['id'], verdict),
+            classify_batch=lambda emails: [False if email['subject'] == 'id0-0' else None for email in emails],
+            classify_clusters=lambda emails: [True if email['subject'] != 'id0-5' else None for email in emails],
+        )
+        pipeline.run()
+
+        self.assertEqual(classified, ['id0-5'])
+        self.assertFalse(acted['id0-0'])
+        self.assertTrue(acted['id0-3'])
+        self.assertEqual(len(acted), 6)
+
+    def test_bodies_are_released_when_no_longer_needed(self):
+        pages = make_pages(1, 2)
+        bodies_at_action = {}
+        emails = {}
+
+        def fetch_messages(gmail, messages):
+            for m in messages:
+                emails[m['id']] = EmailMessage(m['id'], 'me@example.com', 'sender@example.com')
+                emails[m['id']]['body'] = f'body of {m["id"]}'
+            return dict(emails)
+
+        pipeline = EmailPipeline(
+            gmail_factory=MagicMock,
+            list_page=lambda gmail, token: pages[token],
+            fetch_messages=fetch_messages,
+            classify=lambda email: email['subject'] == 'id0-0',
+            act=lambda message_info, email, verdict: bodies_at_action.__setitem__(message_info['id'], email.get('body')),
+        )
+        pipeline.run()
+
+        # The recovery log needs the body of a promotional email, a kept one is released at once
+        self.assertEqual(bodies_at_action, {'id0-0': 'body of id0-0', 'id0-1': None})
+        self.assertNotIn('body', emails['id0-0'])
+
+    def test_next_page_is_listed_while_the_fetchers_are_busy(self):
+        pages = make_pages(2, 15)
+        second_page_listed = threading.Event()
+        waited = []
+
+        def list_page(gmail, token):
+            if token == 'token1':
+                second_page_listed.set()
+            return pages[token]
+
+        def fetch_messages(gmail, messages):
+            if not waited:
+                # The fetch queue holds one chunk, so the producer is stuck queueing the first page
+                waited.append(second_page_listed.wait(timeout=5))
+            return {m['id']: {'subject': m['id']} for m in messages}
+
+        pipeline = EmailPipeline(
+            gmail_factory=MagicMock,
+            list_page=list_page,
+            fetch_messages=fetch_messages,
+            classify=lambda email: False,
+            act=lambda message_info, email, verdict: None,
+            fetch_workers=1,
+            queue_size=5,
+            fetch_chunk_size=5,
+        )
+        pipeline.run()
+
+        self.assertEqual(waited, [True])
+        self.assertEqual(pipeline.total_unread_emails, 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+from src.prefilter import PreFilter
+
+
+def make_email(sender='Shop <deals@email.shop.example>', labels=None, list_unsubscribe=None, precedence=None):
+    return {
+        'from': sender,
+        'subject': 'Subject',
+        'body': 'Body',
+        'labels': labels if labels is not None else ['UNREAD'],
+        'list_unsubscribe': list_unsubscribe,
+        'precedence': precedence,
+    }
+
+
+class TestPreFilter(unittest.TestCase):
+
+    def test_promotions_category_with_bulk_headers_is_promotional(self):
+        prefilter = PreFilter('Doe')
+        email = make_email(labels=['UNREAD', 'CATEGORY_PROMOTIONS'], list_unsubscribe='<mailto:unsubscribe@shop.example>')
+        self.assertTrue(prefilter.decide(email))
+
+    def test_promotions_category_alone_is_unknown(self):
+        prefilter = PreFilter('Doe')
+        email = make_email(sender='Jane Smith <jane@smith.example>', labels=['UNREAD', 'CATEGORY_PROMOTIONS'])
+        self.assertIsNone(prefilter.decide(email))
+
+    def test_family_member_is_kept(self):
+        prefilter = PreFilter('Doe')
+        self.assertFalse(prefilter.decide(make_email(sender='Mary Doe <mary@gmail.com>')))
+        # The same name behind a mailing list is not a family member
+        self.assertIsNone(prefilter.decide(make_email(sender='Doe Hardware <deals@doe.example>', list_unsubscribe='<https://doe.example/u>')))
+
+    def test_sender_domain_reputation(self):
+        prefilter = PreFilter('Doe', sender_verdict_counts={
+            'Shop <news@shop.example>': (9, 10),
+            'Shop <offers@email.shop.example>': (10, 10),
+            'Bank <alerts@bank.example>': (0, 12),
+            'Friend <friend@gmail.com>': (0, 3),
+        })
+        self.assertTrue(prefilter.decide(make_email(sender='Shop <other@mail.shop.example>')))
+        self.assertFalse(prefilter.decide(make_email(sender='Bank <alerts@bank.example>')))
+        # Too few verdicts, and a public mail domain doesn't share reputation between addresses
+        self.assertIsNone(prefilter.decide(make_email(sender='Friend <friend@gmail.com>')))
+        self.assertIsNone(prefilter.decide(make_email(sender='Stranger <stranger@gmail.com>')))
+
+    def test_stats_report_avoided_model_calls(self):
+        prefilter = PreFilter('Doe')
+        prefilter.decide(make_email(sender='Mary Doe <mary@gmail.com>'))
+        prefilter.decide(make_email(sender='Someone <someone@gmail.com>'))
+        self.assertEqual(prefilter.stats()['Model calls avoided'], '50.0%')
+
+    def test_shadow_mode_tracks_agreement(self):
+        prefilter = PreFilter('Doe', mode='shadow')
+        prefilter.record_model_verdict(True, True)
+        prefilter.record_model_verdict(False, True)
+        prefilter.record_model_verdict(None, True)
+        self.assertEqual(prefilter.stats()['Pre-filter agreement with model'], '50.0% of 2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+
+from src.recovery_log import RecoveryLogReader, RecoveryLogWriter, log_files
+
+
+class TestRecoveryLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, count, **kwargs):
+        writer = RecoveryLogWriter(self.path, **kwargs)
+        locations = [writer.write({'id': f'id{i}', 'email_contents': f'Body {i} ' * 20}) for i in range(count)]
+        writer.close()
+        return locations
+
+    def test_records_stream_back_in_order(self):
+        self.write(100)
+        self.write(5)
+
+        records = list(RecoveryLogReader(self.path))
+
+        self.assertEqual(len(records), 105)
+        self.assertEqual(records[99]['id'], 'id99')
+        self.assertEqual(records[100]['id'], 'id0')
+
+    def test_finds_a_record_by_location_or_by_scanning(self):
+        locations = self.write(100, block_records=8)
+        reader = RecoveryLogReader(self.path)
+
+        self.assertEqual(reader.find('id42', *locations[42])['email_contents'], 'Body 42 ' * 20)
+        self.assertEqual(reader.find('id43')['id'], 'id43')
+        self.assertIsNone(reader.find('missing'))
+
+    def test_files_rotate(self):
+        locations = self.write(300, max_file_bytes=1000, block_records=4)
+
+        self.assertGreater(len(log_files(self.path)), 1)
+        reader = RecoveryLogReader(self.path)
+        self.assertEqual(reader.find('id299', *locations[299])['id'], 'id299')
+        self.assertEqual(len(list(reader)), 300)
+
+    def test_truncated_block_is_skipped(self):
+        self.write(10, block_records=4)
+        path = os.path.join(self.path, log_files(self.path)[-1])
+        with open(path, 'rb') as file:
+            data = file.read()
+        with open(path, 'wb') as file:
+            file.write(data[:-30])
+
+        records = list(RecoveryLogReader(self.path))
+        self.assertGreaterEqual(len(records), 8)
+        self.assertLess(len(records), 10)
+        self.assertEqual(records[7]['id'], 'id7')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,54 +1,81 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import ANY, patch, MagicMock
 from run import main, LanguageModelClientFactory, get_user_name, choose_language_model_client
 
 class TestEmailProcessingProgram(unittest.TestCase):
 
-    @patch('run.get_gmail_service')
+    @patch('run.LOCAL_CLASSIFIER', 'off')
+    @patch('run.METRICS_PATH', '')
+    @patch('run.gmail_connections')
     @patch('run.get_user_email')
     @patch('run.os.path.exists')
     @patch('run.os.makedirs')
-    @patch('run.open', new_callable=unittest.mock.mock_open, read_data='{"email_id": true}')
-    @patch('run.json.load')
+    @patch('run.Ledger')
+    @patch('run.load_user_settings', return_value=None)
+    @patch('run.save_user_settings')
     @patch('run.choose_language_model_client')
+    @patch('run.get_user_action', return_value='read')
     @patch('run.LanguageModelClientFactory.get_client')
     @patch('run.get_user_name')
-    @patch('run.fetch_emails')
-    @patch('run.parse_email_data')
-    @patch('run.process_email')
+    @patch('run.IncrementalLister')
+    @patch('run.get_history_id', return_value='12345')
+    @patch('run.parse_email_batch')
+    @patch('run.fetch_email_bodies', return_value={'email_id': 'Test body'})
+    @patch('run.evaluate_email')
+    @patch('run.apply_verdict')
+    @patch('run.VerdictCache')
     @patch('run.report_statistics')
-    def test_main_flow(self, mock_report_statistics, mock_process_email, mock_parse_email_data, mock_fetch_emails, mock_get_user_name, mock_get_client, mock_choose_client, mock_json_load, mock_open, mock_makedirs, mock_path_exists, mock_get_user_email, mock_get_gmail_service):
+    def test_main_flow(self, mock_report_statistics, mock_verdict_cache, mock_apply_verdict, mock_evaluate_email, mock_fetch_email_bodies, mock_parse_email_batch, mock_get_history_id, mock_incremental_lister, mock_get_user_name, mock_get_client, mock_get_user_action, mock_choose_client, mock_save_user_settings, mock_load_user_settings, mock_ledger, mock_makedirs, mock_path_exists, mock_get_user_email, mock_gmail_connections):
         # Setup mock return values and side effects
-        mock_get_gmail_service.return_value = MagicMock()
+        mock_gmail_connections.return_value.return_value = MagicMock()
         mock_get_user_email.return_value = 'test@example.com'
         mock_path_exists.return_value = True
-        mock_json_load.return_value = {}
+        mock_ledger.return_value.__contains__.return_value = False
+        mock_ledger.return_value.get_state.return_value = None
+        mock_ledger.return_value.in_flight.return_value = []
+        mock_ledger.return_value.mark_listed.side_effect = lambda email_ids: email_ids
         mock_choose_client.return_value = ('gpt-4-1106-preview', 'api_key')
-        mock_get_client.return_value = MagicMock()
+        mock_get_client.return_value = MagicMock(max_concurrency=None, context_tokens=None)
         mock_get_user_name.return_value = ('Test', 'User')
-        mock_fetch_emails.return_value = ([{'id': 'email_id'}], None)
-        mock_parse_email_data.return_value = {'subject': 'Test Subject'}
+        mock_incremental_lister.return_value.return_value = ([{'id': 'email_id'}], None)
+        mock_incremental_lister.return_value.complete = True
+        mock_incremental_lister.return_value.full_scan = True
+        mock_incremental_lister.return_value.start_history_id = None
+        mock_incremental_lister.return_value.searches = [None]
+        mock_parse_email_batch.return_value = {'email_id': {'subject': 'Test Subject'}}
+        mock_evaluate_email.return_value = True
+        mock_verdict_cache.return_value.stats.return_value = {}
+        mock_verdict_cache.return_value.sender_verdict_counts.return_value = {}
 
         # Call the main function
         main()
 
         # Assertions to ensure each function was called
-        mock_get_gmail_service.assert_called_once()
+        mock_gmail_connections.assert_called_once_with(timeout=60.0)
+        mock_gmail_connections.return_value.assert_called()
         mock_get_user_email.assert_called_once()
         mock_path_exists.assert_called()
         mock_makedirs.assert_not_called()
-        mock_open.assert_called()
-        mock_json_load.assert_called()
+        mock_ledger.return_value.migrate_legacy_files.assert_called_once()
         mock_choose_client.assert_called_once()
         mock_get_client.assert_called_once_with('gpt-4-1106-preview', api_key='api_key', model_path=None)
         mock_get_user_name.assert_called_once()
-        mock_fetch_emails.assert_called()
-        mock_parse_email_data.assert_called()
-        mock_process_email.assert_called()
+        mock_incremental_lister.assert_called_once_with(None, search_query=ANY)
+        mock_incremental_lister.return_value.assert_called()
+        mock_parse_email_batch.assert_called_once()
+        self.assertEqual(mock_parse_email_batch.call_args.kwargs['format'], 'metadata')
+        mock_fetch_email_bodies.assert_called_once()
+        mock_evaluate_email.assert_called_once()
+        mock_apply_verdict.assert_called_once()
+        self.assertTrue(mock_apply_verdict.call_args[0][3])
+        mock_ledger.return_value.mark_classified.assert_called_once_with('email_id', True)
+        mock_ledger.return_value.mark_processed.assert_not_called()
+        mock_ledger.return_value.set_state.assert_any_call('history_id', '12345')
+        mock_ledger.return_value.set_state.assert_called_with('page_cursor', None)
+        mock_ledger.return_value.close.assert_called_once()
         mock_report_statistics.assert_called_once()
 
 
-
 @patch('run.get_gmail_service')
 @patch('run.get_user_email')
 @patch('run.os.path.exists')
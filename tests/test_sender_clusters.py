@@ -0,0 +1,78 @@
+import unittest
+from unittest.mock import MagicMock
+
+from src.sender_clusters import SenderClusters, simhash
+
+TEMPLATE = (
+    "Hello, your weekly deals from Shop are here. This week only, save {percent}% off shoes, jackets and bags "
+    "across the whole store. Free delivery on orders over 50 pounds. Use code SAVE{percent} at checkout. "
+    "You have {points} reward points waiting. You are receiving this email because you signed up at shop.example."
+)
+
+
+def promotion(points, sender='Shop <news@shop.example>', percent=20):
+    return {'from': sender, 'subject': f'Save {percent}% this week', 'body': TEMPLATE.format(percent=percent, points=points)}
+
+
+def distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class TestSimhash(unittest.TestCase):
+
+    def test_numbers_do_not_change_the_fingerprint(self):
+        self.assertEqual(simhash(TEMPLATE.format(percent=20, points=120)), simhash(TEMPLATE.format(percent=35, points=9800)))
+
+    def test_different_texts_are_far_apart(self):
+        personal = "Hi, are we still on for dinner on Friday? Bring the photos from the trip, the kids want to see them."
+        self.assertGreater(distance(simhash(TEMPLATE), simhash(personal)), 10)
+
+
+class TestSenderClusters(unittest.TestCase):
+
+    def test_samples_settle_the_rest_of_the_cluster(self):
+        classify_samples = MagicMock(side_effect=lambda emails: [True] * len(emails))
+        clusters = SenderClusters(classify_samples, sample_size=3)
+
+        verdicts = clusters.classify([promotion(points) for points in range(10)])
+
+        self.assertEqual(verdicts, [True] * 10)
+        classify_samples.assert_called_once()
+        self.assertEqual(len(classify_samples.call_args[0][0]), 3)
+        self.assertEqual(clusters.settled_by_cluster, 7)
+
+        # Later chunks are settled without samples
+        self.assertEqual(clusters.classify([promotion(11), promotion(12)]), [True, True])
+        classify_samples.assert_called_once()
+
+    def test_disagreeing_samples_leave_the_cluster_to_the_model(self):
+        answers = iter([True, False, True])
+        clusters = SenderClusters(lambda emails: [next(answers) for _ in emails], sample_size=3)
+
+        verdicts = clusters.classify([promotion(points) for points in range(5)])
+
+        self.assertEqual(verdicts, [True, False, True, None, None])
+        self.assertEqual(clusters.classify([promotion(6)]), [None])
+
+    def test_lone_emails_are_classified_on_their_own_and_recorded(self):
+        classify_samples = MagicMock()
+        clusters = SenderClusters(classify_samples, sample_size=2)
+
+        self.assertEqual(clusters.classify([promotion(1)]), [None])
+        clusters.record(promotion(1), False)
+        self.assertEqual(clusters.classify([promotion(2)]), [None])
+        clusters.record(promotion(2), False)
+
+        self.assertEqual(clusters.classify([promotion(3)]), [False])
+        classify_samples.assert_not_called()
+
+    def test_senders_are_clustered_apart(self):
+        clusters = SenderClusters(lambda emails: [True] * len(emails), sample_size=1)
+        clusters.classify([promotion(1), promotion(2)])
+
+        self.assertEqual(clusters.classify([promotion(3, sender='Other <news@other.example>')]), [None])
+        self.assertEqual(len(clusters.clusters), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# `import run` took about a second while every backend was imported eagerly
+STARTUP_TARGET_SECONDS = 0.5
+LAZY_MODULES = ('llama_cpp', 'openai', 'google_auth_oauthlib', 'google.oauth2.credentials', 'googleapiclient.discovery', 'google_auth_httplib2', 'src.benchmark')
+
+MEASURE = f"""
+import json, sys, time
+started = time.perf_counter()
+import run
+elapsed = time.perf_counter() - started
+print(json.dumps({{'seconds': elapsed, 'loaded': [name for name in {LAZY_MODULES!r} if name in sys.modules]}}))
+"""
+
+
+def measure_startup():
+    output = subprocess.run([sys.executable, '-c', MEASURE], cwd=ROOT, env=os.environ.copy(), capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_backends_are_not_imported_by_the_cli(self):
+        self.assertEqual(measure_startup()['loaded'], [])
+
+    def test_startup_time(self):
+        # Best of three, as a fresh interpreter on a busy machine is noisy
+        seconds = min(measure_startup()['seconds'] for _ in range(3))
+        self.assertLess(seconds, STARTUP_TARGET_SECONDS, f"import run took {seconds:.2f}s")
+
+
+if __name__ == '__main__':
+    unittest.main()
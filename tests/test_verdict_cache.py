@@ -0,0 +1,76 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from src.verdict_cache import VerdictCache
+
+
+def make_email(subject='Big sale', body='Everything must go'):
+    return {'from': 'Shop <deals@shop.example>', 'subject': subject, 'body': body, 'labels': ['UNREAD']}
+
+
+class TestVerdictCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'verdicts.sqlite3')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_hit_after_put_and_across_instances(self):
+        cache = VerdictCache(self.path, model_name='model', prompt_version='v1')
+        self.assertIsNone(cache.get(make_email()))
+        cache.put(make_email(), True)
+        cache.close()
+
+        cache = VerdictCache(self.path, model_name='model', prompt_version='v1')
+        # Whitespace and case differences still hit
+        self.assertTrue(cache.get(make_email(subject='BIG   sale')))
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        cache.close()
+
+    def test_writers_of_other_accounts_are_waited_for(self):
+        first = VerdictCache(self.path, model_name='model', prompt_version='v1')
+        second = VerdictCache(self.path, model_name='model', prompt_version='v2')
+        first._connection.execute("BEGIN IMMEDIATE")
+        threading.Timer(0.2, first._connection.commit).start()
+
+        second.put(make_email(), True)
+
+        self.assertTrue(second.get(make_email()))
+        first.close()
+        second.close()
+
+    def test_model_and_prompt_version_are_part_of_the_key(self):
+        cache = VerdictCache(self.path, model_name='model', prompt_version='v1')
+        cache.put(make_email(), True)
+        cache.close()
+
+        self.assertIsNone(VerdictCache(self.path, model_name='other', prompt_version='v1').get(make_email()))
+        self.assertIsNone(VerdictCache(self.path, model_name='model', prompt_version='v2').get(make_email()))
+
+    def test_evicts_least_recently_used_above_max_entries(self):
+        cache = VerdictCache(self.path, model_name='model', prompt_version='v1', max_entries=2)
+        for i in range(3):
+            cache.put(make_email(subject=f'Sale {i}'), True)
+            time.sleep(0.01)
+        cache.get(make_email(subject='Sale 0'))
+
+        self.assertEqual(cache.evict(), 1)
+        self.assertIsNone(cache.get(make_email(subject='Sale 1')))
+        self.assertTrue(cache.get(make_email(subject='Sale 0')))
+
+    def test_evicts_expired_entries(self):
+        cache = VerdictCache(self.path, model_name='model', prompt_version='v1', max_age_days=1)
+        cache.put(make_email(), False)
+        with patch('src.verdict_cache.time.time', return_value=time.time() + 2 * 86400):
+            self.assertEqual(cache.evict(), 1)
+        self.assertIsNone(cache.get(make_email()))
+
+
+if __name__ == '__main__':
+    unittest.main()